@@ -0,0 +1,225 @@
+"""The analyzere-extras command.
+
+    analyzere-extras combine MANIFEST --catalog-id UUID [options]
+
+combines the ELTs of each job in MANIFEST into one combined ELT LossSet per
+job, as a single ELTCombiner.combine_batch(). A manifest is either a CSV
+file with name and uuid columns (one row per UUID, so a job spans as many
+rows as it has UUIDs), or a YAML file mapping each job name to a list of
+UUIDs. YAML manifests need PyYAML.
+
+One line is printed for each job, with its combined LossSet id (or its
+error) and how long its upload took. The exit status is 1 if any job
+failed.
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import analyzere
+
+from .combine_elts import (
+    DEFAULT_RESOLVE_CONCURRENCY,
+    DEFAULT_UPLOAD_CONCURRENCY,
+    MULTIPLICITY_POLICIES,
+    ELTCombiner,
+)
+from .downloads import DEFAULT_DOWNLOAD_CONCURRENCY
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+UUID_TYPE_CHOICES = ('all', 'Portfolio', 'PortfolioView', 'Layer',
+                     'LayerView', 'LossSet')
+
+
+def read_manifest(path):
+    """Returns an OrderedDict mapping the job names in the manifest at path
+    to their lists of UUIDs, in the order they first appear.
+    """
+    if path.endswith(('.yaml', '.yml')):
+        return _read_yaml_manifest(path)
+    return _read_csv_manifest(path)
+
+
+def _read_csv_manifest(path):
+    jobs = OrderedDict()
+    with io.open(path, encoding='utf-8', newline='') as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        fieldnames = [name.strip() for name in reader.fieldnames or []]
+        if 'name' not in fieldnames or 'uuid' not in fieldnames:
+            raise ValueError(
+                "Manifest {} must have 'name' and 'uuid' columns.".format(
+                    path))
+        reader.fieldnames = fieldnames
+        for row in reader:
+            name = (row['name'] or '').strip()
+            if name:
+                jobs.setdefault(name, []).append((row['uuid'] or '').strip())
+    return jobs
+
+
+def _read_yaml_manifest(path):
+    if yaml is None:
+        raise ValueError(
+            'Reading the YAML manifest {} requires PyYAML.'.format(path))
+
+    with io.open(path, encoding='utf-8') as manifest_file:
+        manifest = yaml.safe_load(manifest_file) or {}
+    if not isinstance(manifest, dict):
+        raise ValueError(
+            'Manifest {} must map job names to lists of UUIDs.'.format(path))
+
+    jobs = OrderedDict()
+    for name, uuids in manifest.items():
+        if isinstance(uuids, str):
+            uuids = uuids.split()
+        jobs[str(name)] = [str(uuid) for uuid in uuids or []]
+    return jobs
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='analyzere-extras',
+        description='Tools for working with the Analyze Re API.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    combine = commands.add_parser(
+        'combine', help='combine the ELTs of each job in a manifest',
+        description='Combines the ELTs of each job in a CSV (name,uuid) or '
+                    'YAML (name: [uuids]) manifest into one combined ELT '
+                    'LossSet per job.')
+    combine.add_argument('manifest')
+    combine.add_argument('--catalog-id', required=True)
+    combine.add_argument('--uuid-type', choices=UUID_TYPE_CHOICES,
+                         default='all')
+    combine.add_argument(
+        '--description',
+        default='analyzere-python-extras: Combined ELT {name}',
+        help='description of the combined LossSets, in which {name} is '
+             'replaced by the job name')
+    combine.add_argument('--aggregate', action='store_true')
+    combine.add_argument('--sort', action='store_true')
+    combine.add_argument('--multiplicity', choices=MULTIPLICITY_POLICIES,
+                         default='loss_set')
+    combine.add_argument('--reuse', action='store_true')
+    combine.add_argument('--filter-events', action='store_true')
+    combine.add_argument('--resolve-concurrency', type=int,
+                         default=DEFAULT_RESOLVE_CONCURRENCY)
+    combine.add_argument('--download-concurrency', type=int,
+                         default=DEFAULT_DOWNLOAD_CONCURRENCY)
+    combine.add_argument('--parse-processes', type=int, default=1)
+    combine.add_argument('--upload-concurrency', type=int,
+                         default=DEFAULT_UPLOAD_CONCURRENCY)
+    combine.add_argument('--compress-upload', action='store_true')
+    combine.add_argument('--cache-dir')
+    combine.add_argument('--spool-dir')
+    combine.add_argument('--output',
+                         help='also write the results to this CSV file')
+    combine.add_argument(
+        '--base-url', default=os.environ.get('ANALYZERE_BASE_URL'),
+        help='defaults to $ANALYZERE_BASE_URL')
+    combine.add_argument(
+        '--username', default=os.environ.get('ANALYZERE_USERNAME'),
+        help='defaults to $ANALYZERE_USERNAME')
+    combine.add_argument(
+        '--password', default=os.environ.get('ANALYZERE_PASSWORD'),
+        help='defaults to $ANALYZERE_PASSWORD')
+    combine.add_argument('--report', action='store_true',
+                         help='print the time spent in each phase')
+    return parser
+
+
+def combine(args):
+    """Runs the combine command, and returns the exit status."""
+    if args.base_url:
+        analyzere.base_url = args.base_url
+    if args.username:
+        analyzere.username = args.username
+    if args.password:
+        analyzere.password = args.password
+
+    try:
+        jobs = read_manifest(args.manifest)
+    except (IOError, ValueError) as e:
+        print('analyzere-extras: {}'.format(e), file=sys.stderr)
+        return 1
+
+    upload_seconds = {}
+
+    def on_event(event):
+        if event.name == 'upload_finished':
+            upload_seconds[event.attributes['loss_set_id']] = \
+                event.attributes['seconds']
+
+    start = time.time()
+    with ELTCombiner(spool_dir=args.spool_dir, cache_dir=args.cache_dir,
+                     resolve_concurrency=args.resolve_concurrency,
+                     download_concurrency=args.download_concurrency,
+                     compress_upload=args.compress_upload,
+                     parse_processes=args.parse_processes,
+                     on_event=on_event) as elt_combiner:
+        try:
+            results = elt_combiner.combine_batch(
+                jobs, args.catalog_id,
+                uuid_type=args.uuid_type,
+                description=args.description,
+                aggregate=args.aggregate,
+                multiplicity=args.multiplicity,
+                sort=args.sort,
+                reuse=args.reuse,
+                filter_events=args.filter_events,
+                upload_concurrency=args.upload_concurrency,
+                return_exceptions=True)
+        except Exception as e:
+            # Failures that affect every job, e.g. a failed download
+            print('analyzere-extras: {}'.format(e), file=sys.stderr)
+            return 1
+
+    rows = []
+    for name, result in results.items():
+        if isinstance(result, Exception):
+            rows.append((name, '', '', str(result).replace('\n', ' ')))
+        else:
+            seconds = upload_seconds.get(result.id)
+            rows.append((name, result.id,
+                         '' if seconds is None else '{:.3f}'.format(seconds),
+                         ''))
+
+    for name, loss_set_id, seconds, error in rows:
+        print('{}\t{}\t{}'.format(name, loss_set_id or 'FAILED',
+                                  seconds or error))
+    if args.report:
+        print(elt_combiner.report, file=sys.stderr)
+    failed = sum(1 for row in rows if row[3])
+    print('{} of {} jobs combined in {:.1f}s'.format(
+        len(rows) - failed, len(rows), time.time() - start), file=sys.stderr)
+
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8',
+                     newline='') as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(['name', 'loss_set_id', 'upload_seconds',
+                             'error'])
+            writer.writerows(rows)
+
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    if args.command == 'combine':
+        return combine(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,22 @@
-from __future__ import print_function
 import analyzere
-import multiprocessing
+import asyncio
+import copy
+import hashlib
+import io
+import json
+import os
+import shutil
 import ssl
-import csv
+import tempfile
+import threading
+import time
 import warnings
+import weakref
+import zlib
+import aiohttp
 import certifi
+import numpy as np
 
-from six.moves.http_client import IncompleteRead
 from uuid import UUID
 from analyzere import (
     Portfolio,
@@ -17,11 +27,143 @@ from analyzere import (
     EventCatalog,
     InvalidRequestError,
 )
-
-from six.moves import urllib
-from concurrent.futures import ThreadPoolExecutor
+from analyzere.base_resources import Reference, load_reference
+from analyzere.utils import parse_href
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from collections import OrderedDict
+
+from .downloads import (
+    DEFAULT_DOWNLOAD_CONCURRENCY,
+    DEFAULT_DOWNLOAD_SEGMENTS,
+    RESUMABLE_ERRORS,
+    EventLoopThread,
+    download_file,
+    download_timeout,
+)
+from .elt_cache import DEFAULT_MAX_BYTES, ELTCache
+from .elts import (
+    AGGREGATE_DTYPE,
+    CHUNK_ROWS,
+    ELT_HEADER,
+    ELTAggregator,
+    ELTMerger,
+    ELT_FILE_SUFFIX,
+    aggregated_elt,
+    convert_elt_csv,
+    filter_elt,
+    format_elt,
+    iter_elt_chunks,
+    iter_elt_text,
+    open_elt_file,
+    parse_elt_files,
+    read_event_ids,
+)
+from .metrics import CombineEvent, CombineReport, Span
 warnings.simplefilter('always', UserWarning)
 
+# Ways of counting an ELT that is found more than once in the resources
+MULTIPLICITY_POLICIES = ('loss_set', 'reference', 'data')
+
+# Number of UUIDs in uuid_list looked up at once
+DEFAULT_RESOLVE_CONCURRENCY = 16
+
+# Number of combined ELTs of a batch built and uploaded at once
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+# Resource types a UUID is looked up as when uuid_type='all'
+UUID_TYPES = (Portfolio, Layer, LossSet, PortfolioView, LayerView)
+
+# meta_data key of the hash of a combined LossSet's inputs
+COMBINE_HASH_KEY = 'analyzere_extras_combine_hash'
+
+# Number of leading hex digits of the hash of a combined LossSet's inputs
+# that are added to its description, where LossSet searches can find them
+COMBINE_HASH_SEARCH_DIGITS = 16
+
+# Number of LossSets listed per request when searching for a combine to
+# reuse
+SEARCH_PAGE_SIZE = 100
+
+
+class StreamReader(object):
+    """Read-only file-like view of an iterable of str or bytes.
+
+    LossSet.upload_data() uploads any object with a read(size) method in
+    chunks. StreamReader deliberately has no seek() so that the upload is
+    streamed without first measuring the length of the data.
+
+    position is the number of characters or bytes read so far. If on_read
+    is given, it is called with position after each read.
+    """
+
+    def __init__(self, iterable, on_read=None):
+        self._iterator = iter(iterable)
+        self._buffer = None
+        self._on_read = on_read
+        self.position = 0
+
+    def read(self, size=-1):
+        parts = [] if self._buffer is None else [self._buffer]
+        length = sum(len(part) for part in parts)
+
+        while size < 0 or length < size:
+            try:
+                part = next(self._iterator)
+            except StopIteration:
+                break
+            parts.append(part)
+            length += len(part)
+
+        if not parts:
+            return ''
+
+        # Join with an empty str or bytes to match the iterable
+        data = parts[0][:0].join(parts)
+        if size < 0:
+            self._buffer = data[:0]
+        else:
+            self._buffer = data[size:]
+            data = data[:size]
+        self.position += len(data)
+        if self._on_read is not None:
+            self._on_read(self.position)
+        return data
+
+
+def gzip_chunks(chunks, encoding='utf-8'):
+    """Yields the gzip compression of an iterable of strings as bytes,
+    compressing each string as it is consumed.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode(encoding))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _close_downloads(event_loop, session):
+    """Closes the aiohttp session (if any) on event_loop, and stops the
+    loop's thread.
+    """
+    if session is not None and not session.closed:
+        event_loop.run(session.close())
+    event_loop.close()
+
+
+def _retrieve_reference(href):
+    """Retrieves the resource that an analyzere Reference to href refers
+    to.
+    """
+    collection_name, id_ = parse_href(href)
+    return load_reference(collection_name, id_)
+
 
 class ELTCombiner():
     """Functionality for combining multiple ELTs into one ELT.
@@ -30,33 +172,131 @@ class ELTCombiner():
         analyzere.base_url
         analyzere.username
         analyzere.password
+
+    Downloaded ELTs are streamed to a temporary spool directory rather than
+    held in memory. spool_dir sets where that directory is created (defaults
+    to the system temporary directory); it is removed once the combined ELT
+    has been uploaded.
+
+    If cache_dir is set, downloaded ELTs are kept there between combines and
+    only re-downloaded when their LossSet's data has been modified. The
+    cache is limited to cache_max_bytes, evicting the least recently used
+    ELTs.
+
+    The resources in uuid_list are looked up and expanded into their ELTs
+    resolve_concurrency at a time. ELTs are downloaded download_concurrency
+    at a time by an asyncio event loop running in a background thread, over
+    a pool of keep-alive connections that is reused by later combines; call
+    close() (or use the combiner as a context manager) to close the
+    connections and stop the thread. ELTs of 64 MiB or more are each
+    downloaded over download_segments connections. ELTs are downloaded
+    gzip or deflate compressed where the server supports it, and the
+    combined ELT is uploaded gzip compressed if compress_upload is True.
+
+    If parse_processes is more than 1, the downloaded ELTs are parsed in a
+    pool of that many processes, which pass the parsed records back in
+    shared memory, or are converted into the cache in such a pool if there
+    is a cache.
+
+    After each combine, report holds a CombineReport of how long its phases
+    took and how many bytes and rows they handled. If on_span is given, it
+    is called with each of the report's Spans as it finishes.
+
+    Progress (downloads starting and finishing, ELTs combined, and the
+    upload) is reported as CombineEvents passed to on_event, which is
+    either a callable or a queue (anything with a put_nowait() method, such
+    as a queue.Queue). Without on_event the combiner is silent.
     """
 
-    def __init__(self):
+    def __init__(self, spool_dir=None, cache_dir=None,
+                 cache_max_bytes=DEFAULT_MAX_BYTES,
+                 resolve_concurrency=DEFAULT_RESOLVE_CONCURRENCY,
+                 download_concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+                 download_segments=DEFAULT_DOWNLOAD_SEGMENTS,
+                 compress_upload=False, parse_processes=1, on_span=None,
+                 on_event=None):
         self._elt_loss_sets = []
+        self._loss_sets = {}
         self._downloaded_elts = {}
-
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        context.verify_mode = ssl.CERT_REQUIRED
-
-        context.load_verify_locations(certifi.where())
-        httpsHandler = urllib.request.HTTPSHandler(context=context)
-
-        manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        manager.add_password(None, analyzere.base_url,
-                             analyzere.username, analyzere.password)
-        authHandler = urllib.request.HTTPBasicAuthHandler(manager)
-
-        opener = urllib.request.build_opener(httpsHandler, authHandler)
-
-        urllib.request.install_opener(opener)
-
-        self._urllib_request = urllib.request
+        self._elt_multiplicity = {}
+        self._multiplicity = 'loss_set'
+        self._uuid_types = {}
+        self._resolve_concurrency = resolve_concurrency
+        self._processing = threading.local()
+        self._references = {}
+        self._references_lock = threading.Lock()
+        self._references_executor = None
+        self._spool_dir = spool_dir
+        self._spool = None
+        self._aggregate = False
+        self._sort = False
+        self._previous = None
+        self._reuse = False
+        self._aggregator = None
+        self._combine_hash = None
+        self._combined_rows = 0
+        self._filter_events = False
+        self._event_ids = None
+        self._event_index = None
+        self._on_span = on_span
+        self._on_event = on_event
+        self._downloads = (0, 0)
+        self.report = CombineReport(on_span)
+
+        self._cache = None
+        if cache_dir is not None:
+            self._cache = ELTCache(cache_dir, cache_max_bytes)
+
+        self._download_concurrency = download_concurrency
+        self._download_segments = download_segments
+        self._compress_upload = compress_upload
+        self._parse_processes = parse_processes
+        self._convert_pool = None
+        self._event_loop = EventLoopThread()
+        self._ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self._session = None
+        self._finalizer = weakref.finalize(
+            self, _close_downloads, self._event_loop, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the pooled download connections and stops the background
+        threads used for downloading ELTs and retrieving resources.
+
+        A combiner that is not closed is closed when it is garbage collected.
+        """
+        if self._references_executor is not None:
+            self._references_executor.shutdown()
+            self._references_executor = None
+        self._finalizer()
+        self._session = None
+        # The combiner can still be used, which restarts the thread
+        self._finalizer = weakref.finalize(
+            self, _close_downloads, self._event_loop, None)
+
+    def _emit(self, name, **attributes):
+        """Passes a CombineEvent to on_event, if the combiner has one."""
+        if self._on_event is None:
+            return
+        event = CombineEvent(name, **attributes)
+        put = getattr(self._on_event, 'put_nowait', self._on_event)
+        put(event)
 
     def combine_elts_from_resources(
             self, uuid_list, catalog_id,
             uuid_type='all',
-            description='analyzere-python-extras: Combined ELT'):
+            description='analyzere-python-extras: Combined ELT',
+            aggregate=False,
+            multiplicity='loss_set',
+            sort=False,
+            previous=None,
+            reuse=False,
+            filter_events=False):
         """Combine ELTs from multiple resources into one ELT.
 
         Parameters:
@@ -80,63 +320,233 @@ class ELTCombiner():
                         - LossSet
 
            description  A description to be used for the combined loss set.
-        """
-        self._elt_loss_sets = []
-        self._description = description
 
-        self._catalog = EventCatalog.retrieve(catalog_id)
+           aggregate    If True, the combined ELT has one row per EventId:
+                        Loss, EXPVALUE and STDDEVC are summed across the
+                        ELTs and STDDEVI is added in quadrature. Otherwise
+                        the rows of the ELTs are concatenated.
+
+           multiplicity How many times an ELT that is found more than once
+                        in the resources is included in the combined ELT.
+                        Each ELT file is only downloaded once regardless.
+                        Valid options:
+                        - loss_set: once per distinct LossSet (default)
+                        - reference: once per reference to a LossSet, e.g.
+                          a LossSet shared by 3 Layers is included 3 times
+                        - data: once per distinct ELT file, even if several
+                          LossSets refer to the same file
+
+           sort         If True, the combined ELT is sorted by EventId. The
+                        ELTs are sorted into run files in the spool
+                        directory and merged from there, so combines larger
+                        than memory can be sorted (and aggregated). With a
+                        cache_dir, an aggregated combine's sums are kept in
+                        memory as they are merged, so that it can later be
+                        used as previous.
+
+           previous     A combined LossSet (or its id) created by an earlier
+                        aggregated combine (sorted or not) using the same
+                        cache_dir, whose upload was processed successfully.
+                        Only the ELTs that have been added, removed or
+                        modified since are downloaded, and their losses are
+                        added to or subtracted from that combine's result
+                        rather than all the ELTs being combined again.
+                        Requires cache_dir and aggregate=True.
+
+           reuse        If True, and a combined LossSet has already been
+                        made from the same versions of the same ELTs with
+                        the same options, that LossSet is returned instead
+                        of downloading, combining and uploading the ELTs
+                        again. Every combined LossSet records a hash of its
+                        inputs in its meta_data for this lookup, and the
+                        start of the hash in its description, so that it
+                        can be searched for.
+
+           filter_events If True, rows for events that are not in the
+                        EventCatalog are left out of the combined ELT, with
+                        a warning. The catalog's event ids are downloaded
+                        once and kept (in the cache, if there is one) until
+                        its data changes.
+        """
+        self._start(catalog_id, description, aggregate, multiplicity, sort,
+                    previous, reuse, filter_events)
 
         # remove any empty strings (if someone had as extra comma)
-        uuid_list = [uuid for uuid in uuid_list if uuid is not '']
+        uuid_list = [uuid for uuid in uuid_list if uuid != '']
 
-        errors = []
+        process_uuid = self._uuid_processor(uuid_type)
 
-        if uuid_type == 'Layer':
-            for uuid in uuid_list:
-                try:
-                    self._process_layer_uuid(uuid)
-                except ValueError as e:
-                    errors.append(e)
+        with self.report.span('resolve', uuids=len(uuid_list)) as span:
+            errors = self._process_uuids(process_uuid, uuid_list)
+            span.attributes['elts'] = len(self._elt_loss_sets)
 
-        elif uuid_type == 'LayerView':
-            for uuid in uuid_list:
-                try:
-                    self._process_layer_view_uuid(uuid)
-                except ValueError as e:
-                    errors.append(e)
+        if len(errors) > 0:
+            raise ValueError('\n'.join([str(error) for error in errors]))
 
-        elif uuid_type == 'Portfolio':
-            for uuid in uuid_list:
-                try:
-                    self._process_portfolio_uuid(uuid)
-                except ValueError as e:
-                    errors.append(e)
+        return self._combine_elts()
 
-        elif uuid_type == 'PortfolioView':
-            for uuid in uuid_list:
-                try:
-                    self._process_portfolio_view_uuid(uuid)
-                except ValueError as e:
-                    errors.append(e)
+    def combine_batch(
+            self, jobs, catalog_id,
+            uuid_type='all',
+            description='analyzere-python-extras: Combined ELT {name}',
+            aggregate=False,
+            multiplicity='loss_set',
+            sort=False,
+            reuse=False,
+            filter_events=False,
+            upload_concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+            return_exceptions=False):
+        """Combine the ELTs of several lists of resources into one combined
+        ELT for each list.
 
-        elif uuid_type == 'LossSet':
-            for uuid in uuid_list:
-                try:
-                    self._process_loss_set_uuid(uuid)
-                except ValueError as e:
-                    errors.append(e)
+        Parameters:
 
-        else:
-            for uuid in uuid_list:
-                try:
-                    self._process_uuid(uuid)
-                except ValueError as e:
-                    errors.append(e)
+           jobs         A mapping of output names to lists of UUIDs, each
+                        list as the uuid_list of combine_elts_from_resources.
+
+           description  The description of each combined LossSet, in which
+                        {name} is replaced by the output name.
+
+           upload_concurrency
+                        The number of combined ELTs built and uploaded at
+                        once.
+
+           return_exceptions
+                        If False, an output whose UUIDs cannot all be
+                        looked up (e.g. an invalid UUID) raises its error
+                        straight away, before anything is downloaded, and
+                        otherwise the first error (in jobs order) building
+                        or uploading an output is raised once every other
+                        output has been uploaded. If True, errors are
+                        returned in place of their outputs' LossSets
+                        instead.
+
+        catalog_id, uuid_type, aggregate, multiplicity, sort, reuse and
+        filter_events apply to every output, as for
+        combine_elts_from_resources.
+
+        Every distinct UUID is looked up once and every distinct ELT is
+        downloaded once, however many outputs include it. Returns an
+        OrderedDict mapping each output name, in jobs order, to its
+        combined LossSet.
+        """
+        self._start(catalog_id, description, aggregate, multiplicity, sort,
+                    None, reuse, filter_events)
+
+        jobs = OrderedDict(
+            (name, [uuid for uuid in uuid_list if uuid != ''])
+            for name, uuid_list in jobs.items())
+        distinct_uuids = list(OrderedDict.fromkeys(
+            uuid for uuid_list in jobs.values() for uuid in uuid_list))
+
+        process_uuid = self._uuid_processor(uuid_type)
+        with self.report.span('resolve', uuids=len(distinct_uuids)) as span:
+            resolved = dict(zip(distinct_uuids, self._resolve_uuids(
+                process_uuid, distinct_uuids)))
+            span.attributes['elts'] = len(self._loss_sets)
+
+        results = OrderedDict((name, None) for name in jobs)
+        plans = OrderedDict()
+        # Shared by every plan, so that an ELT file that several outputs
+        # reach through different LossSets is downloaded for the same one
+        representatives = {}
+        for name, uuid_list in jobs.items():
+            errors = [resolved[uuid][1] for uuid in uuid_list
+                      if resolved[uuid][1] is not None]
+            if errors:
+                error = ValueError('\n'.join(str(e) for e in errors))
+                if not return_exceptions:
+                    raise error
+                results[name] = error
+                continue
 
-        if len(errors) > 0:
-            raise ValueError('\n'.join([str(error) for error in errors]))
+            self._elt_loss_sets = [elt_id for uuid in uuid_list
+                                   for elt_id in resolved[uuid][0]]
+            plans[name] = self._plan_downloads(representatives)
+
+        combined = self._combine_batch(plans, upload_concurrency)
+        for name, result in combined.items():
+            if isinstance(result, Exception) and not return_exceptions:
+                raise result
+            results[name] = result
+        return results
+
+    def _start(self, catalog_id, description, aggregate, multiplicity, sort,
+               previous, reuse, filter_events):
+        """Validates and sets the options of a combine, and retrieves its
+        EventCatalog.
+        """
+        if multiplicity not in MULTIPLICITY_POLICIES:
+            raise ValueError(
+                "'{}' is not a valid multiplicity. Valid options are: "
+                "{}.".format(multiplicity, ', '.join(MULTIPLICITY_POLICIES)))
 
-        return self._combine_elts()
+        if previous is not None and (self._cache is None or not aggregate):
+            raise ValueError(
+                'Combining from a previous combine requires a cache_dir '
+                'and aggregate=True.')
+
+        self._elt_loss_sets = []
+        self._loss_sets = {}
+        self._references = {}
+        self._description = description
+        self._aggregate = aggregate
+        self._multiplicity = multiplicity
+        self._sort = sort
+        self._previous = getattr(previous, 'id', previous)
+        self._reuse = reuse
+        self._filter_events = filter_events
+        self.report = CombineReport(self._on_span)
+
+        self._catalog = EventCatalog.retrieve(catalog_id)
+
+    def _uuid_processor(self, uuid_type):
+        """Returns the _process_*uuid method for uuid_type."""
+        return {
+            'Layer': self._process_layer_uuid,
+            'LayerView': self._process_layer_view_uuid,
+            'Portfolio': self._process_portfolio_uuid,
+            'PortfolioView': self._process_portfolio_view_uuid,
+            'LossSet': self._process_loss_set_uuid,
+        }.get(uuid_type, self._process_uuid)
+
+    def _process_uuids(self, process_uuid, uuid_list):
+        """Runs process_uuid (one of the _process_*uuid methods) on every UUID
+        in uuid_list using a pool of up to self._resolve_concurrency threads.
+
+        ELTs are added to self._elt_loss_sets in uuid_list order, as if the
+        UUIDs had been processed one after another. Returns the ValueErrors
+        raised for invalid UUIDs, also in uuid_list order.
+        """
+        errors = []
+        for elt_loss_sets, error in self._resolve_uuids(process_uuid,
+                                                        uuid_list):
+            self._elt_loss_sets.extend(elt_loss_sets)
+            if error is not None:
+                errors.append(error)
+        return errors
+
+    def _resolve_uuids(self, process_uuid, uuid_list):
+        """Runs process_uuid on every UUID in uuid_list as _process_uuids()
+        does, and returns a list of (ELT LossSet ids, ValueError or None)
+        for each UUID, in uuid_list order.
+        """
+        def process(uuid):
+            self._processing.elt_loss_sets = []
+            try:
+                process_uuid(uuid)
+                return self._processing.elt_loss_sets, None
+            except ValueError as e:
+                return [], e
+            finally:
+                self._processing.elt_loss_sets = None
+
+        if not uuid_list:
+            return []
+
+        workers = min(self._resolve_concurrency, len(uuid_list))
+        with ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(process, uuid_list))
 
     def _validate_uuid(self, uuid):
         try:
@@ -227,7 +637,7 @@ class ELTCombiner():
             raise ValueError(
                 "UUID '{}' is not a LossSet.".format(uuid))
 
-        self._add_loss_set_elts(loss_set)
+        self._add_loss_set_elt(loss_set)
 
     def _process_uuid(self, uuid):
         """Validates uuid as a UUID, and adds ELTs for that UUID to
@@ -238,129 +648,834 @@ class ELTCombiner():
         # Validate UUID - if invalid, let error bubble up
         self._validate_uuid(uuid)
 
-        portfolio = None
-        portfolio_view = None
-        layer = None
-        layer_view = None
-        loss_set = None
+        resource_type, resource = self._retrieve_any_type(uuid)
 
-        try:
-            portfolio = Portfolio.retrieve(uuid)
-        except InvalidRequestError:
+        if resource_type is Portfolio:
+            self._add_portfolio_elts(resource)
+
+        elif resource_type is Layer:
+            self._add_layer_elts(resource)
+
+        elif resource_type is LossSet:
+            self._add_loss_set_elt(resource)
+
+        elif resource_type is PortfolioView:
+            self._add_portfolio_view_elts(resource)
+
+        elif resource_type is LayerView:
+            self._add_layer_view_elts(resource)
+
+    def _retrieve_any_type(self, uuid):
+        """Retrieves uuid as whichever of the UUID_TYPES it is, returning the
+        type and the retrieved resource.
+
+        Every type is tried at once and the first successful retrieval wins.
+        The type is remembered so that later lookups of uuid take one request.
+        """
+        known_type = self._uuid_types.get(uuid)
+        if known_type is not None:
             try:
-                layer = Layer.retrieve(uuid)
+                return known_type, known_type.retrieve(uuid)
             except InvalidRequestError:
-                try:
-                    loss_set = LossSet.retrieve(uuid)
-                except InvalidRequestError:
+                self._uuid_types.pop(uuid, None)
+
+        executor = ThreadPoolExecutor(len(UUID_TYPES))
+        futures = dict((executor.submit(resource_type.retrieve, uuid),
+                        resource_type)
+                       for resource_type in UUID_TYPES)
+        try:
+            error = None
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
                     try:
-                        portfolio_view = PortfolioView.retrieve(uuid)
+                        resource = future.result()
                     except InvalidRequestError:
-                        try:
-                            layer_view = LayerView.retrieve(uuid)
-                        except InvalidRequestError:
-                            raise ValueError(
-                                "UUID '{}' is not a Portfolio, PortfolioView, "
-                                "Layer, LayerView, or LossSet.".format(
-                                    uuid))
+                        continue
+                    except Exception as e:
+                        # Only raised if no other type is found
+                        error = error or e
+                        continue
+
+                    self._uuid_types[uuid] = futures[future]
+                    return futures[future], resource
+        finally:
+            # Don't wait for the remaining (unsuccessful) retrievals
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if error is not None:
+            raise error
+
+        raise ValueError(
+            "UUID '{}' is not a Portfolio, PortfolioView, "
+            "Layer, LayerView, or LossSet.".format(uuid))
 
-        if portfolio is not None:
-            self._add_portfolio_elts(portfolio)
+    def _combine_elts(self):
+        """Downloads the ELTs in self._elt_loss_sets (a list of ELTLossSet ids)
+        and uploads a single combined ELT.
+        """
+        self._elt_multiplicity = self._plan_downloads()
+        self._downloaded_elts = {}
+        self._aggregator = None
 
-        elif layer is not None:
-            self._add_layer_elts(layer)
+        self._combine_hash = self._inputs_hash()
+        if self._reuse:
+            combined_loss_set = self._find_combined(self._combine_hash)
+            if combined_loss_set is not None:
+                self._emit('combine_reused', loss_set_id=combined_loss_set.id)
+                return combined_loss_set
 
-        elif loss_set is not None:
-            self._add_loss_set_elt(loss_set)
+        self._spool = tempfile.mkdtemp(prefix='analyzere-elts-',
+                                       dir=self._spool_dir)
+        try:
+            self._event_ids = None
+            if self._filter_events:
+                # Before any ELTs are downloaded, so that a missing or
+                # unreadable catalog fails fast
+                self._event_ids = self._catalog_event_ids()
+
+            elt_ids = None
+            if self._previous is not None:
+                elt_ids = self._start_from_previous()
+                if elt_ids is None:
+                    warnings.warn(
+                        'The result of combine {} is not in the cache; '
+                        'combining all ELTs again.'.format(self._previous))
+            if elt_ids is None:
+                elt_ids = list(self._elt_multiplicity)
+
+            with self.report.span('download', elts=len(elt_ids)):
+                self._event_loop.run(self._download_elts(elt_ids))
+            return self._upload_and_store()
+        finally:
+            shutil.rmtree(self._spool, ignore_errors=True)
+            self._spool = None
+            if self._cache is not None:
+                self._cache.evict()
+
+    def _combine_batch(self, plans, upload_concurrency):
+        """Downloads the ELTs of every plan (as returned by
+        _plan_downloads()) in plans once, and builds and uploads the
+        combined ELT of each plan, upload_concurrency at a time.
+
+        Returns an OrderedDict mapping each name in plans to its combined
+        LossSet, or to the exception raised while combining it.
+        """
+        results = OrderedDict((name, None) for name in plans)
+        combine_hashes = OrderedDict()
+        for name, plan in plans.items():
+            self._elt_multiplicity = plan
+            combine_hash = self._inputs_hash()
+            if self._reuse:
+                combined_loss_set = self._find_combined(combine_hash)
+                if combined_loss_set is not None:
+                    self._emit('combine_reused', output=name,
+                               loss_set_id=combined_loss_set.id)
+                    results[name] = combined_loss_set
+                    continue
+            combine_hashes[name] = combine_hash
+
+        if not combine_hashes:
+            return results
 
-        elif portfolio_view is not None:
-            self._add_portfolio_view_elts(portfolio_view)
+        self._downloaded_elts = {}
+        self._spool = tempfile.mkdtemp(prefix='analyzere-elts-',
+                                       dir=self._spool_dir)
+        try:
+            self._event_ids = None
+            if self._filter_events:
+                self._event_ids = self._catalog_event_ids()
+
+            elt_ids = list(OrderedDict.fromkeys(
+                elt_id for name in combine_hashes for elt_id in plans[name]))
+            with self.report.span('download', elts=len(elt_ids)):
+                self._event_loop.run(self._download_elts(elt_ids))
+
+            workers = min(upload_concurrency, len(combine_hashes))
+            with ThreadPoolExecutor(workers) as executor:
+                futures = OrderedDict(
+                    (name, executor.submit(self._batch_combiner(
+                        name, plans[name], combine_hash)._upload_and_store))
+                    for name, combine_hash in combine_hashes.items())
+                for name, future in futures.items():
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        results[name] = e
+            return results
+        finally:
+            shutil.rmtree(self._spool, ignore_errors=True)
+            self._spool = None
+            if self._cache is not None:
+                self._cache.evict()
+
+    def _batch_combiner(self, name, plan, combine_hash):
+        """Returns a copy of the combiner for combining the ELTs in plan,
+        once they have been downloaded, as the output name of a batch.
+
+        The copy shares the combiner's LossSets, downloaded ELTs, spool
+        directory, cache, connections and report, but has its own combine
+        state so that several outputs can be combined at once.
+        """
+        combiner = copy.copy(self)
+        # Only {name} is replaced, so that any other braces in the
+        # description are kept as they are
+        combiner._description = self._description.replace('{name}', name)
+        combiner._elt_multiplicity = plan
+        combiner._downloaded_elts = OrderedDict(
+            (elt_id, self._downloaded_elts[elt_id]) for elt_id in plan)
+        combiner._aggregator = None
+        combiner._combine_hash = combine_hash
+        return combiner
+
+    def _upload_and_store(self):
+        """Uploads the combined ELT and, if it was aggregated, there is a
+        cache and the upload was processed successfully, stores its state so
+        that it can be re-combined from later.
+        """
+        combined_loss_set = self._upload_combined_elt()
+
+        if self._cache is not None and self._aggregator is not None and \
+                getattr(combined_loss_set, 'status', None) == \
+                'processing_succeeded':
+            self._cache.put_combined(
+                combined_loss_set.id,
+                {
+                    'catalog_id': self._catalog.id,
+                    'filter_events': self._filter_events,
+                    'sources': self._sources(),
+                },
+                self._aggregator.state())
+        return combined_loss_set
+
+    def _sources(self):
+        """Returns the version and multiplicity of each ELT in the combine,
+        by ELT id, as recorded in the manifest of an aggregated combine.
+        """
+        return OrderedDict(
+            (elt_id, {
+                'version': ELTCache.key(self._loss_sets[elt_id]),
+                'multiplicity': multiplicity,
+            })
+            for elt_id, multiplicity in self._elt_multiplicity.items())
+
+    def _inputs_hash(self):
+        """Returns a hash of the versions of the ELTs in the combine and of
+        the options that affect the combined ELT.
+        """
+        inputs = {
+            'catalog_id': self._catalog.id,
+            'aggregate': self._aggregate,
+            'sort': self._sort,
+            'sources': sorted(
+                [elt_id, source['version'], source['multiplicity']]
+                for elt_id, source in self._sources().items()),
+        }
+        if self._filter_events:
+            # Only added when set, so that earlier hashes still match
+            inputs['filter_events'] = True
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _find_combined(self, combine_hash):
+        """Returns a successfully uploaded combined LossSet whose inputs
+        hash to combine_hash, or None if there is none.
+
+        LossSets are searched for by the start of the hash in their
+        descriptions, a page at a time, and matched by the whole hash in
+        their meta_data.
+        """
+        search = combine_hash[:COMBINE_HASH_SEARCH_DIGITS]
+        offset = 0
+        while True:
+            loss_sets = LossSet.list(search=search, offset=offset,
+                                     limit=SEARCH_PAGE_SIZE)
+            for loss_set in loss_sets:
+                meta_data = getattr(loss_set, 'meta_data', None)
+                if getattr(meta_data, COMBINE_HASH_KEY, None) == \
+                        combine_hash and getattr(loss_set, 'status', None) \
+                        == 'processing_succeeded':
+                    return loss_set
+            if len(loss_sets) < SEARCH_PAGE_SIZE:
+                return None
+            offset += len(loss_sets)
+
+    def _start_from_previous(self):
+        """Sets up self._aggregator to continue from the result of the
+        combine self._previous, subtracting the ELTs that have been removed
+        or modified since.
+
+        Returns the ids of the ELTs that still need to be downloaded and
+        added, or None if the previous combine's result (or any of the ELTs
+        it was made from) is no longer in the cache.
+        """
+        combined = self._cache.get_combined(self._previous)
+        if combined is None:
+            return None
+        manifest, state = combined
+        if manifest['catalog_id'] != self._catalog.id or \
+                manifest.get('filter_events', False) != self._filter_events:
+            return None
+
+        sources = self._sources()
+        previous_sources = manifest['sources']
+
+        removed = []
+        for elt_id, source in previous_sources.items():
+            if sources.get(elt_id) != source:
+                elt_path = self._cache.get(source['version'])
+                if elt_path is None:
+                    return None
+                removed.append((elt_path, source['multiplicity']))
+
+        # Removed ELTs are subtracted before downloading, which may replace
+        # their cached versions
+        self._aggregator = ELTAggregator(state=state)
+        for elt_path, multiplicity in removed:
+            elt = open_elt_file(elt_path)
+            for start in range(0, len(elt), CHUNK_ROWS):
+                chunk = elt[start:start + CHUNK_ROWS]
+                if self._event_ids is not None:
+                    chunk = filter_elt(chunk, self._event_ids)
+                self._aggregator.add(chunk, -multiplicity)
+
+        return [elt_id for elt_id, source in sources.items()
+                if previous_sources.get(elt_id) != source]
+
+    def _catalog_event_ids(self):
+        """Returns the sorted ids of the events in self._catalog, only
+        downloading and parsing the catalog if they are not already held by
+        the combiner or the cache for the current version of its data.
+        """
+        key = ELTCache.key(self._catalog)
+        with self.report.span('event_index', catalog_id=self._catalog.id,
+                              cached=True) as span:
+            event_ids = None
+            if self._event_index is not None and self._event_index[0] == key:
+                event_ids = self._event_index[1]
+            if event_ids is None and self._cache is not None:
+                event_ids = self._cache.get_event_ids(key)
+            if event_ids is None:
+                span.attributes['cached'] = False
+                event_ids = self._event_loop.run(
+                    self._download_event_ids())
+                if self._cache is not None:
+                    self._cache.put_event_ids(key, event_ids)
+            span.attributes['events'] = len(event_ids)
+
+        self._event_index = key, event_ids
+        return event_ids
+
+    async def _download_event_ids(self):
+        """Downloads self._catalog's data into the spool directory and
+        returns its sorted event ids.
+        """
+        catalog_path = os.path.join(
+            self._spool, 'catalog-{}.csv'.format(self._catalog.id))
+        catalog_url = '{}/uploads/files/{}'.format(analyzere.base_url,
+                                                   self._catalog.data.name)
+
+        max_attempts = 3
+        try:
+            await download_file(self._client_session(), catalog_url,
+                                catalog_path, max_attempts=max_attempts)
+        except RESUMABLE_ERRORS:
+            msg = '{} IncompleteRead errors received for EventCatalog ' \
+                '{}'.format(max_attempts, self._catalog.id)
+            raise RuntimeError(msg)
 
-        elif layer_view is not None:
-            self._add_layer_view_elts(layer_view)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self._read_event_ids, catalog_path)
 
-    def _combine_elts(self):
-        """Downloads the ELTs in self._elt_loss_sets (a list of ELTLossSet ids)
-        and uploads a single combined ELT.
+    def _read_event_ids(self, catalog_path):
+        try:
+            with io.open(catalog_path, encoding='utf-8') as catalog_file:
+                return read_event_ids(catalog_file)
+        finally:
+            os.remove(catalog_path)
+
+    def _plan_downloads(self, representatives=None):
+        """Collapses self._elt_loss_sets to one LossSet per ELT file.
+
+        Returns an OrderedDict mapping the id of the LossSet each ELT file is
+        downloaded for to the number of times the ELT is included in the
+        combined ELT, according to self._multiplicity.
+
+        representatives maps each ELT file to the LossSet it is downloaded
+        for, and is filled in with the first LossSet found for each new
+        file. Passing the same dict to several plans makes them download
+        each ELT file for the same LossSet.
+        """
+        if representatives is None:
+            representatives = {}
+        plan = OrderedDict()
+        planned_loss_sets = set()
+
+        for loss_set_id in self._elt_loss_sets:
+            loss_set = self._loss_sets.get(loss_set_id)
+            data_key = loss_set_id
+            if loss_set is not None:
+                data = getattr(loss_set, 'data', None)
+                data_key = getattr(data, 'ref_id', None) or \
+                    getattr(data, 'name', None) or loss_set_id
+
+            if data_key not in plan:
+                plan[data_key] = [
+                    representatives.setdefault(data_key, loss_set_id), 0]
+
+            if self._multiplicity == 'reference' or (
+                    self._multiplicity == 'loss_set' and
+                    loss_set_id not in planned_loss_sets):
+                plan[data_key][1] += 1
+            elif self._multiplicity == 'data':
+                plan[data_key][1] = 1
+
+            planned_loss_sets.add(loss_set_id)
+
+        return OrderedDict(plan.values())
+
+    def _client_session(self):
+        """Returns the aiohttp session ELT files are downloaded with, creating
+        it on first use.
+
+        The session belongs to the combiner and is kept open across combines,
+        so its keep-alive connections (at most self._download_concurrency,
+        all of which may go to the one file server) are reused rather than
+        each download opening a new TCP and TLS connection. It must only be
+        used on the combiner's event loop.
+        """
+        if self._session is None or self._session.closed:
+            auth = None
+            if analyzere.username:
+                auth = aiohttp.BasicAuth(analyzere.username,
+                                         analyzere.password)
+
+            connector = aiohttp.TCPConnector(
+                limit=self._download_concurrency,
+                limit_per_host=self._download_concurrency,
+                ssl=self._ssl_context)
+
+            # The encodings ELTs are accepted in are chosen per request by
+            # download_file()
+            self._session = aiohttp.ClientSession(
+                connector=connector, auth=auth, timeout=download_timeout(),
+                skip_auto_headers=['Accept-Encoding'])
+
+            # Close the new session, rather than the old one, if the
+            # combiner is garbage collected without being closed
+            self._finalizer.detach()
+            self._finalizer = weakref.finalize(
+                self, _close_downloads, self._event_loop, self._session)
+        return self._session
+
+    async def _download_elts(self, loss_set_ids):
+        """Downloads the ELTs of loss_set_ids, at most
+        self._download_concurrency at a time.
+
+        If there is a cache and self._parse_processes is more than 1, the
+        downloaded ELTs are converted into the cache in a pool of that many
+        processes, which is only started once an ELT needs converting.
         """
-        downloaded = 0
-        with ThreadPoolExecutor(multiprocessing.cpu_count()) as executor:
-            for loss_set in executor.map(self._download_loss_set,
-                                         self._elt_loss_sets):
-                downloaded += 1
-                print('\rELTLossSets downloaded: {}'.format(downloaded),
-                      end='')
+        semaphore = asyncio.Semaphore(self._download_concurrency)
 
-        print('\n')
-        return self._upload_combined_elt()
+        session = self._client_session()
+        self._downloads = (0, len(loss_set_ids))
 
-    def _download_loss_set(self, loss_set_id):
-        """Downloads loss_set_id's ELT
+        async def download(loss_set_id):
+            async with semaphore:
+                await self._download_loss_set(session, loss_set_id)
+
+        tasks = [asyncio.ensure_future(download(loss_set_id))
+                 for loss_set_id in loss_set_ids]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Stop any other downloads if one of them failed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if self._convert_pool is not None:
+                pool, self._convert_pool = self._convert_pool, None
+                await asyncio.get_event_loop().run_in_executor(
+                    None, pool.shutdown)
+
+    async def _download_loss_set(self, session, loss_set_id):
+        """Downloads loss_set_id's ELT into the spool directory, streaming
+        the response to disk.
+
+        If there is a cache, the ELT is parsed once into a binary ELT file
+        that is kept in the cache, and ELTs already in the cache are not
+        downloaded again.
+        """
+        self._emit('download_started', elt_id=loss_set_id)
+        with self.report.span('download_elt', elt_id=loss_set_id,
+                              bytes=0, cached=False) as span:
+            await self._download_elt(session, loss_set_id, span)
+
+        downloaded, total = self._downloads
+        self._downloads = downloaded + 1, total
+        self._emit('download_finished', seconds=span.seconds,
+                   downloaded=downloaded + 1, total=total, **span.attributes)
+
+    async def _download_elt(self, session, loss_set_id, span):
+        """Does the work of _download_loss_set(), adding the bytes
+        downloaded and whether the ELT was cached to span's attributes.
         """
-        loss_set = LossSet.retrieve(loss_set_id)
+        loss_set = self._loss_sets.get(loss_set_id)
+        if loss_set is None:
+            loss_set = await asyncio.get_event_loop().run_in_executor(
+                None, LossSet.retrieve, loss_set_id)
+
+        cache_key = None
+        if self._cache is not None:
+            cache_key = self._cache.key(loss_set)
+            cached_path = self._cache.get(cache_key)
+            if cached_path is not None:
+                span.attributes['cached'] = True
+                self._downloaded_elts[loss_set_id] = cached_path
+                return
+
+        elt_path = os.path.join(self._spool, '{}.csv'.format(loss_set_id))
+
         loss_set_filename = loss_set.data.name
         elt_url = '{}/uploads/files/{}'.format(analyzere.base_url,
                                                loss_set_filename)
 
-        elt_response_str_list = None
         max_attempts = 3
-        for _ in range(0, max_attempts):
-            try:
-                elt_response_str_list = self._urllib_request.urlopen(
-                    elt_url).read().decode('utf-8').splitlines()
-            except IncompleteRead:
-                continue
-
-        if elt_response_str_list is None:
+        try:
+            span.attributes['bytes'] = await download_file(
+                session, elt_url, elt_path, max_attempts=max_attempts,
+                segments=self._download_segments)
+        except RESUMABLE_ERRORS:
             msg = '{} IncompleteRead errors received for LossSet {}'.format(
                 max_attempts, loss_set_id)
             raise RuntimeError(msg)
 
-        self._downloaded_elts[loss_set_id] = elt_response_str_list
+        if cache_key is not None:
+            elt_path = await asyncio.get_event_loop().run_in_executor(
+                None, self._cache_elt, loss_set_id, cache_key, elt_path,
+                self._conversion_pool())
+
+        self._downloaded_elts[loss_set_id] = elt_path
+
+    def _conversion_pool(self):
+        """Returns the process pool that downloaded ELTs are converted into
+        the cache in, starting it on first use, or None if
+        self._parse_processes is 1. It must only be called on the combiner's
+        event loop, and is shut down by _download_elts().
+        """
+        if self._convert_pool is None and self._parse_processes > 1:
+            self._convert_pool = ProcessPoolExecutor(self._parse_processes)
+        return self._convert_pool
+
+    def _cache_elt(self, elt_id, cache_key, csv_path, pool=None):
+        """Parses the downloaded ELT CSV at csv_path into the cache as a
+        binary ELT file, and returns the path of the cached file.
+
+        The ELT is parsed in the process pool, if one is given.
+        """
+        partial_path = self._cache.partial_path(cache_key)
+        try:
+            with self.report.span('cache_elt', elt_id=elt_id) as span:
+                if pool is None:
+                    convert_elt_csv(csv_path, partial_path)
+                else:
+                    pool.submit(convert_elt_csv, csv_path,
+                                partial_path).result()
+                span.attributes['rows'] = len(open_elt_file(partial_path))
+            return self._cache.put(cache_key, partial_path)
+        except BaseException:
+            self._cache.discard(partial_path)
+            raise
+        finally:
+            os.remove(csv_path)
+
+    def _combined_elt_chunks(self):
+        """Generates the combined ELT as blocks of CSV text, header first,
+        parsing each downloaded ELT from the spool directory a chunk of rows
+        at a time. When aggregating or sorting, the rows are summed or
+        sorted by EventId and only written out once every ELT has been read.
+        When just concatenating, the rows are copied without being parsed.
+
+        Each ELT is included as many times as self._elt_multiplicity says.
+        """
+        yield ELT_HEADER
+
+        self._combined_rows = 0
+        if self._aggregator is None and not self._sort and \
+                not self._aggregate and self._event_ids is None:
+            for elt_id, text, rows in self._timed_parsed_elts(text=True):
+                multiplicity = self._elt_multiplicity.get(elt_id, 1)
+                self._combined_rows += rows * multiplicity
+                for _ in range(multiplicity):
+                    yield text
+            return
+
+        aggregator = self._aggregator
+        if aggregator is None:
+            if self._sort:
+                aggregator = ELTMerger(self._spool, reduce=self._aggregate)
+            elif self._aggregate:
+                aggregator = self._aggregator = ELTAggregator()
+
+        filtered_rows = {}
+        for elt_id, elt, _ in self._timed_parsed_elts():
+            if self._event_ids is not None:
+                rows = len(elt)
+                elt = filter_elt(elt, self._event_ids)
+                if len(elt) < rows:
+                    filtered_rows[elt_id] = \
+                        filtered_rows.get(elt_id, 0) + rows - len(elt)
+
+            multiplicity = self._elt_multiplicity.get(elt_id, 1)
+            if aggregator is not None:
+                aggregator.add(elt, multiplicity)
+                continue
+            self._combined_rows += len(elt) * multiplicity
+            for text in format_elt(elt):
+                for _ in range(multiplicity):
+                    yield text
+
+        if filtered_rows:
+            warnings.warn(
+                'Rows for events that are not in EventCatalog {} were left '
+                'out of the combined ELT: {}.'.format(
+                    self._catalog.id, ', '.join(
+                        '{} rows of LossSet {}'.format(rows, elt_id)
+                        for elt_id, rows in sorted(filtered_rows.items()))))
+
+        if isinstance(aggregator, ELTMerger) and self._aggregate and \
+                self._cache is not None:
+            # The merged sums are kept, so that the combine can be stored
+            # and re-combined from like one aggregated without sorting
+            states = [np.empty(0, dtype=AGGREGATE_DTYPE)]
+            for state in aggregator.merge_state():
+                states.append(state)
+                elt = aggregated_elt(state)
+                self._combined_rows += len(elt)
+                for text in format_elt(elt):
+                    yield text
+            self._aggregator = ELTAggregator(state=np.concatenate(states))
+        elif isinstance(aggregator, ELTMerger):
+            for elt in aggregator.merge():
+                self._combined_rows += len(elt)
+                for text in format_elt(elt):
+                    yield text
+        elif aggregator is not None:
+            elt = aggregator.result()
+            self._combined_rows += len(elt)
+            for text in format_elt(elt):
+                yield text
+
+    def _timed_combine(self, chunks):
+        """Yields the combined ELT chunks, recording the time spent
+        generating them (but not uploading them) as a 'combine' span.
+        """
+        span = Span('combine', time.time(), bytes=0)
+        seconds = 0.0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.time() - start
+                span.attributes['bytes'] += len(chunk)
+                yield chunk
+        finally:
+            span.seconds = seconds
+            span.attributes['rows'] = self._combined_rows
+            self.report.add(span)
+
+    def _timed_parsed_elts(self, text=False):
+        """Yields (ELT id, chunk, number of rows) for the chunks of records
+        from _parsed_elts(), or of CSV text from _elt_texts() if text is
+        True, recording the time spent reading each ELT as a 'parse_elt'
+        span, and emitting an 'elt_combined' event once each ELT has been
+        combined.
+        """
+        if text:
+            chunks = self._elt_texts()
+        else:
+            chunks = ((elt_id, elt, len(elt))
+                      for elt_id, elt in self._parsed_elts())
+        span = None
+        combined = 0
+        while True:
+            start = time.time()
+            elt_id, chunk, rows = next(chunks, (None, None, 0))
+            seconds = time.time() - start
+
+            if span is not None and elt_id != span.attributes['elt_id']:
+                # Every row of the ELT has been combined
+                self.report.add(span)
+                combined += 1
+                self._emit('elt_combined', combined=combined,
+                           total=len(self._downloaded_elts),
+                           **span.attributes)
+                span = None
+            if elt_id is None:
+                return
+            if span is None:
+                span = Span('parse_elt', start, 0.0, elt_id=elt_id, rows=0)
+            span.seconds += seconds
+            span.attributes['rows'] += rows
+            yield elt_id, chunk, rows
+
+    def _elt_texts(self):
+        """Yields (ELT id, CSV text, number of rows) for each downloaded ELT,
+        in order, a chunk of rows at a time.
+
+        The rows of ELT CSVs are copied as they are (see iter_elt_text()),
+        so that values are not changed by being parsed and formatted again.
+        Cached ELTs are formatted from their records.
+        """
+        for elt_id, elt_path in self._downloaded_elts.items():
+            if elt_path.endswith(ELT_FILE_SUFFIX):
+                elt = open_elt_file(elt_path)
+                for start in range(0, len(elt), CHUNK_ROWS):
+                    chunk = elt[start:start + CHUNK_ROWS]
+                    yield elt_id, ''.join(format_elt(chunk)), len(chunk)
+            else:
+                with io.open(elt_path, encoding='utf-8') as elt_file:
+                    for text, rows in iter_elt_text(elt_file):
+                        yield elt_id, text, rows
+
+    def _parsed_elts(self):
+        """Yields (ELT id, array of records) for each downloaded ELT, in
+        order. ELTs are parsed a chunk of rows at a time, or whole in worker
+        processes if self._parse_processes is more than 1.
+        """
+        csv_paths = [elt_path for elt_path in self._downloaded_elts.values()
+                     if not elt_path.endswith(ELT_FILE_SUFFIX)]
+        parsed_elts = None
+        if self._parse_processes > 1 and csv_paths:
+            parsed_elts = parse_elt_files(csv_paths, self._parse_processes)
+
+        for elt_id, elt_path in self._downloaded_elts.items():
+            if elt_path.endswith(ELT_FILE_SUFFIX):
+                # Cached ELTs are already parsed, and are read straight from
+                # the page cache
+                elt = open_elt_file(elt_path)
+                for start in range(0, len(elt), CHUNK_ROWS):
+                    yield elt_id, elt[start:start + CHUNK_ROWS]
+            elif parsed_elts is not None:
+                yield elt_id, next(parsed_elts)
+            else:
+                with io.open(elt_path, encoding='utf-8') as elt_file:
+                    for elt in iter_elt_chunks(elt_file):
+                        yield elt_id, elt
 
     def _upload_combined_elt(self):
-        # Append loss sets
-        combined_elt_data = ["EventId,Loss,STDDEVI,STDDEVC,EXPVALUE"]
-
-        for elt_id, elt_response_str_list in self._downloaded_elts.items():
-            reader = csv.DictReader(elt_response_str_list)
-
-            event_column = 'EventId'
-            if 'EventId' not in reader.fieldnames:
-                event_column = 'EventID'
-
-            for row in reader:
-                eventid = row[event_column]
-                loss = row['Loss']
-                stdevi = row.get('STDDEVI', '0.0')
-                stdevc = row.get('STDDEVC', '0.0')
-                expval = row.get('EXPVALUE', loss)
-                combined_elt_data.append(','.join([
-                    eventid, loss, stdevi, stdevc, expval]))
-
-        combined_elt_data = '\n'.join(combined_elt_data)
-        combined_elt_data += '\n'
-
-        # Upload as new loss set
-        combined_loss_set = LossSet(
-            type='ELTLossSet',
-            description=self._description,
-            loss_type='LossGross',
-            currency='USD',
-            event_catalogs=[self._catalog]
-        ).save()
-
-        combined_loss_set.upload_data(combined_elt_data)
-        print('Combined ELT LossSet Id: {}'.format(combined_loss_set.id))
+        description = self._description
+        meta_data = {}
+        if self._combine_hash is not None:
+            description = '{} (combine {})'.format(
+                description,
+                self._combine_hash[:COMBINE_HASH_SEARCH_DIGITS])
+            meta_data[COMBINE_HASH_KEY] = self._combine_hash
+
+        with self.report.span('upload') as span:
+            # Upload as new loss set
+            combined_loss_set = LossSet(
+                type='ELTLossSet',
+                description=description,
+                loss_type='LossGross',
+                currency='USD',
+                event_catalogs=[self._catalog],
+                meta_data=meta_data,
+            ).save()
+
+            # The combined ELT is generated (and compressed) while it is
+            # uploaded, so it is never held in memory in full.
+            chunks = self._timed_combine(self._combined_elt_chunks())
+            if self._compress_upload:
+                chunks = gzip_chunks(chunks)
+            reader = StreamReader(chunks, on_read=self._upload_progress)
+            combined_loss_set.upload_data(reader)
+            span.attributes['bytes'] = reader.position
+
+        self._emit('upload_finished', loss_set_id=combined_loss_set.id,
+                   seconds=span.seconds, **span.attributes)
         return combined_loss_set
 
+    def _upload_progress(self, position):
+        self._emit('upload_progress', bytes=position)
+
+    def _add_elt_loss_set(self, loss_set):
+        """Adds ELT loss_set to self._elt_loss_sets, remembering the LossSet
+        so that it does not need to be retrieved again to download it.
+
+        Within _process_uuids, loss_set is collected for the UUID being
+        processed by the current thread instead.
+        """
+        elt_loss_sets = getattr(self._processing, 'elt_loss_sets', None)
+        if elt_loss_sets is None:
+            elt_loss_sets = self._elt_loss_sets
+
+        elt_loss_sets.append(loss_set.id)
+        self._loss_sets[loss_set.id] = loss_set
+
+    def _retrieve_references(self, resources):
+        """Returns resources with each unresolved Reference replaced by the
+        resource it refers to.
+
+        Rather than being retrieved one at a time as they are used, the
+        referenced resources are retrieved at once, resolve_concurrency at a
+        time, and each only once per combine however often it is referenced.
+        Walking a tree of resources level by level with this takes one round
+        of requests per level.
+        """
+        resources = list(resources)
+        hrefs = [resource._href for resource in resources
+                 if type(resource) is Reference and not resource._resolved]
+        if not hrefs:
+            return resources
+
+        with self._references_lock:
+            if self._references_executor is None:
+                self._references_executor = ThreadPoolExecutor(
+                    self._resolve_concurrency)
+            for href in hrefs:
+                if href not in self._references:
+                    self._references[href] = \
+                        self._references_executor.submit(
+                            _retrieve_reference, href)
+            futures = dict((href, self._references[href]) for href in hrefs)
+
+        return [futures[resource._href].result()
+                if type(resource) is Reference and resource._href in futures
+                else resource for resource in resources]
+
+    def _retrieve_loss_sets(self, layers):
+        """Returns a list of the LossSets of each of layers, retrieving
+        them all at once.
+        """
+        counts = [len(layer.loss_sets) for layer in layers]
+        loss_sets = self._retrieve_references(
+            loss_set for layer in layers for loss_set in layer.loss_sets)
+
+        layer_loss_sets = []
+        start = 0
+        for count in counts:
+            layer_loss_sets.append(loss_sets[start:start + count])
+            start += count
+        return layer_loss_sets
+
     def _add_portfolio_elts(self, portfolio):
         """Adds ELTs from layers in portfolio to self._elt_loss_sets.
         """
-        for layer in portfolio.layers:
-            for loss_set in layer.loss_sets:
+        layers = self._retrieve_references(portfolio.layers)
+        for loss_sets in self._retrieve_loss_sets(layers):
+            for loss_set in loss_sets:
                 if loss_set.type == 'ELTLossSet':
-                    self._elt_loss_sets.append(loss_set.id)
+                    self._add_elt_loss_set(loss_set)
                 else:
                     warnings.warn('Portfolio {} contains non-ELT LossSet {}. '
                                   'Non-ELT LossSets are ignored.'.format(
@@ -369,36 +1484,30 @@ class ELTCombiner():
     def _add_portfolio_view_elts(self, portfolio_view):
         """Adds ELTs from layers in portfolio view to self._elt_loss_sets.
         """
-        if hasattr(portfolio_view, 'portfolio') and \
-                portfolio_view.portfolio is not None:
-            for layer in portfolio_view.portfolio.layers:
-                for loss_set in layer.loss_sets:
-                    if loss_set.type == 'ELTLossSet':
-                        self._elt_loss_sets.append(loss_set.id)
-                    else:
-                        warnings.warn(
-                            'PortfolioView {} contains non-ELT LossSet '
-                            '{}. Non-ELT LossSets are ignored.'.format(
-                                  portfolio_view.id, loss_set.id))
-
-        if hasattr(portfolio_view, 'layer_views') and \
-                portfolio_view.layer_views is not None:
-            for layer_view in portfolio_view.layer_views:
-                for loss_set in layer_view.layer.loss_sets:
-                    if loss_set.type == 'ELTLossSet':
-                        self._elt_loss_sets.append(loss_set.id)
-                    else:
-                        warnings.warn(
-                            'PortfolioView {} contains non-ELT LossSet '
-                            '{}. Non-ELT LossSets are ignored.'.format(
-                                  portfolio_view.id, loss_set.id))
+        portfolio = getattr(portfolio_view, 'portfolio', None)
+        layer_views = list(getattr(portfolio_view, 'layer_views', None) or [])
+        resources = self._retrieve_references([portfolio] + layer_views)
+        portfolio, layer_views = resources[0], resources[1:]
+
+        layers = [] if portfolio is None else list(portfolio.layers)
+        layers = self._retrieve_references(
+            layers + [layer_view.layer for layer_view in layer_views])
+        for loss_sets in self._retrieve_loss_sets(layers):
+            for loss_set in loss_sets:
+                if loss_set.type == 'ELTLossSet':
+                    self._add_elt_loss_set(loss_set)
+                else:
+                    warnings.warn(
+                        'PortfolioView {} contains non-ELT LossSet '
+                        '{}. Non-ELT LossSets are ignored.'.format(
+                            portfolio_view.id, loss_set.id))
 
     def _add_layer_elts(self, layer):
         """Adds ELTs from layer to self._elt_loss_sets.
         """
-        for loss_set in layer.loss_sets:
+        for loss_set in self._retrieve_references(layer.loss_sets):
             if loss_set.type == 'ELTLossSet':
-                self._elt_loss_sets.append(loss_set.id)
+                self._add_elt_loss_set(loss_set)
             else:
                 warnings.warn('Layer {} contains non-ELT LossSet {}. '
                               'Non-ELT LossSets are ignored.'.format(
@@ -407,9 +1516,10 @@ class ELTCombiner():
     def _add_layer_view_elts(self, layer_view):
         """Adds ELTs from layer in layer_view to self._elt_loss_sets.
         """
-        for loss_set in layer_view.layer.loss_sets:
+        layer = self._retrieve_references([layer_view.layer])[0]
+        for loss_set in self._retrieve_references(layer.loss_sets):
             if loss_set.type == 'ELTLossSet':
-                self._elt_loss_sets.append(loss_set.id)
+                self._add_elt_loss_set(loss_set)
             else:
                 warnings.warn(
                     'LayerView {} contains non-ELT LossSet {}. '
@@ -420,7 +1530,7 @@ class ELTCombiner():
         """Adds loss_set elt to self._elt_loss_sets.
         """
         if loss_set.type == 'ELTLossSet':
-            self._elt_loss_sets.append(loss_set.id)
+            self._add_elt_loss_set(loss_set)
         else:
             warnings.warn(
                 'LossSet {} is not an ELT LossSet. '
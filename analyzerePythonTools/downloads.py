@@ -0,0 +1,257 @@
+"""Asynchronous downloading of ELT files.
+
+Downloads run as coroutines on an asyncio event loop, so the number of
+transfers in flight is limited only by an explicit concurrency limit and not
+by the number of threads.
+"""
+import asyncio
+import threading
+
+import aiohttp
+
+# Size of the blocks ELT downloads are streamed to disk in
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds waited before resuming a truncated download, doubled for each
+# further attempt
+DOWNLOAD_RETRY_BACKOFF = 0.5
+
+# Number of ELTs downloaded at once
+DEFAULT_DOWNLOAD_CONCURRENCY = 16
+
+# Number of connections a single large ELT is downloaded over
+DEFAULT_DOWNLOAD_SEGMENTS = 4
+
+# Size in bytes from which an ELT is downloaded in segments
+SEGMENT_THRESHOLD = 64 * 1024 ** 2
+
+# Seconds allowed to open a connection to the file server
+DOWNLOAD_CONNECT_TIMEOUT = 60
+
+# Seconds a download may go without receiving any data before it is resumed
+DOWNLOAD_READ_TIMEOUT = 300
+
+# Errors after which a download is resumed from the last byte received
+RESUMABLE_ERRORS = (aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+def download_timeout():
+    """Returns the aiohttp.ClientTimeout for ELT download sessions.
+
+    Downloads have no total time limit, as large ELTs can take many minutes,
+    and the time spent waiting for a pooled connection is not limited
+    either. Only opening a connection and each read are.
+    """
+    return aiohttp.ClientTimeout(total=None,
+                                 sock_connect=DOWNLOAD_CONNECT_TIMEOUT,
+                                 sock_read=DOWNLOAD_READ_TIMEOUT)
+
+
+class EventLoopThread(object):
+    """An asyncio event loop running in a background daemon thread.
+
+    run() blocks until a coroutine has finished on the loop, which lets
+    synchronous code use coroutines even when it is itself called from a
+    running event loop (e.g. in a Jupyter notebook).
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name='analyzere-elt-downloads')
+                self._thread.daemon = True
+                self._thread.start()
+        return self._loop
+
+    def run(self, coroutine):
+        """Runs coroutine on the loop and returns its result."""
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def close(self):
+        """Stops the loop and waits for its thread to finish."""
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+
+def _validator(response):
+    """Returns the value to send as If-Range when resuming the download of
+    response, or None if it has no strong validator.
+
+    Resumed downloads ask for the file uncompressed, so the ETag of a
+    compressed response (which identifies the compressed bytes) is not
+    used.
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/') and \
+            'Content-Encoding' not in response.headers:
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+async def _download_range(session, url, path, start, end, validator,
+                          chunk_size, max_attempts, backoff):
+    """Downloads bytes start to end (exclusive) of url into the same offsets
+    of the existing file at path, resuming after truncated or stalled
+    responses.
+
+    Raises aiohttp.ClientPayloadError if the file at url no longer matches
+    validator.
+    """
+    position = start
+    with open(path, 'r+b') as elt_file:
+        elt_file.seek(position)
+        for attempt in range(max_attempts):
+            headers = {
+                'Accept-Encoding': 'identity',
+                'Range': 'bytes={}-{}'.format(position, end - 1),
+                'If-Range': validator,
+            }
+            try:
+                async with session.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    if response.status != 206:
+                        break
+                    async for chunk in response.content.iter_chunked(
+                            chunk_size):
+                        elt_file.write(chunk)
+                        position += len(chunk)
+                    return
+            except RESUMABLE_ERRORS:
+                if attempt + 1 == max_attempts:
+                    raise
+                await asyncio.sleep(backoff * 2 ** attempt)
+
+    # The whole file was sent instead of the range
+    raise aiohttp.ClientPayloadError(
+        '{} changed during download'.format(url))
+
+
+async def _download_segments(session, url, response, path, size, validator,
+                             segments, chunk_size, max_attempts, backoff):
+    """Downloads the size bytes of url into the file at path, which is
+    already size bytes long, over segments connections.
+
+    The first segment is read from response (the response to a GET of the
+    whole file) and the others are requested concurrently as byte ranges.
+    Each segment is written at its own offset, so the file is reassembled in
+    order however the segments arrive.
+    """
+    bounds = [size * i // segments for i in range(segments + 1)]
+
+    async def first_segment():
+        position = 0
+        try:
+            with open(path, 'r+b') as elt_file:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    chunk = chunk[:bounds[1] - position]
+                    elt_file.write(chunk)
+                    position += len(chunk)
+                    if position == bounds[1]:
+                        break
+        except RESUMABLE_ERRORS:
+            pass
+        finally:
+            # Drop the connection rather than read the rest of the file
+            response.close()
+
+        if position < bounds[1]:
+            await _download_range(session, url, path, position, bounds[1],
+                                  validator, chunk_size, max_attempts,
+                                  backoff)
+
+    tasks = [asyncio.ensure_future(first_segment())] + [
+        asyncio.ensure_future(_download_range(
+            session, url, path, bounds[i], bounds[i + 1], validator,
+            chunk_size, max_attempts, backoff))
+        for i in range(1, segments)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return size
+
+
+async def download_file(session, url, path, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                        max_attempts=3, backoff=DOWNLOAD_RETRY_BACKOFF,
+                        segments=1, segment_threshold=SEGMENT_THRESHOLD):
+    """Streams the response to a GET of url into the file at path, chunk_size
+    bytes at a time, and returns the number of bytes written.
+
+    A truncated response, or one that stops sending data for longer than
+    the session's read timeout, is resumed from the last byte received with
+    a Range request, after waiting backoff seconds (doubling for each
+    further attempt). If the server does not honour the range, or the file
+    has changed since the first response, the download starts again from
+    the beginning. After max_attempts requests in total the last of the
+    RESUMABLE_ERRORS is raised.
+
+    The file is requested compressed with gzip or deflate, and decompressed
+    as it is received; path always holds the uncompressed file. Byte ranges
+    refer to the uncompressed file, so resumed requests and segments ask for
+    it uncompressed.
+
+    If segments is more than 1, uncompressed files of at least
+    segment_threshold bytes (by their Content-Length) that the server
+    accepts byte ranges for are downloaded over segments concurrent
+    connections.
+    """
+    written = 0
+    validator = None
+    with open(path, 'wb') as elt_file:
+        for attempt in range(max_attempts):
+            headers = {'Accept-Encoding': 'gzip, deflate'}
+            if written:
+                headers['Accept-Encoding'] = 'identity'
+                headers['Range'] = 'bytes={}-'.format(written)
+                if validator is not None:
+                    headers['If-Range'] = validator
+
+            try:
+                async with session.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    if response.status != 206:
+                        # The whole file is being sent
+                        elt_file.seek(0)
+                        elt_file.truncate()
+                        written = 0
+                        validator = _validator(response)
+
+                        size = response.content_length
+                        if segments > 1 and validator is not None and \
+                                'Content-Encoding' not in response.headers \
+                                and size is not None and \
+                                size >= segment_threshold and \
+                                response.headers.get(
+                                    'Accept-Ranges') == 'bytes':
+                            elt_file.truncate(size)
+                            return await _download_segments(
+                                session, url, response, path, size,
+                                validator, segments, chunk_size,
+                                max_attempts, backoff)
+
+                    async for chunk in response.content.iter_chunked(
+                            chunk_size):
+                        elt_file.write(chunk)
+                        written += len(chunk)
+                    return written
+            except RESUMABLE_ERRORS:
+                if attempt + 1 == max_attempts:
+                    raise
+                await asyncio.sleep(backoff * 2 ** attempt)
@@ -0,0 +1,216 @@
+"""Persistent on-disk cache of downloaded ELTs, as binary ELT files."""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from .elts import AGGREGATE_DTYPE, ELT_FILE_SUFFIX
+
+# Default upper bound on the total size of the cached ELTs
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+
+class ELTCache(object):
+    """Size-bounded directory of downloaded ELTs, stored as binary ELT files
+    (see elts.write_elt_file()) so that each is only parsed once.
+
+    Entries are keyed by LossSet id and a digest of the LossSet's modified
+    timestamp and data reference, so a LossSet whose data changes gets a new
+    key and is downloaded again. When the cache grows beyond max_bytes,
+    evict() removes the least recently used entries.
+
+    The cache also holds the state of aggregated combines (see
+    put_combined()) and the event ids of event catalogs (see
+    put_event_ids()), which count towards its size in the same way.
+    """
+
+    suffix = ELT_FILE_SUFFIX
+    combined_suffix = '.npz'
+    event_ids_suffix = '.npy'
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key(loss_set):
+        """Returns the cache key of loss_set's current data."""
+        data = getattr(loss_set, 'data', None)
+        version = '|'.join([
+            str(getattr(loss_set, 'modified', '')),
+            str(getattr(data, 'ref_id', '')),
+            str(getattr(data, 'name', '')),
+        ])
+        digest = hashlib.sha1(version.encode('utf-8')).hexdigest()
+        return '{}-{}'.format(loss_set.id, digest[:16])
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Returns the path of the cached ELT for key, or None if it is not
+        cached. Marks the entry as recently used.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return path
+
+    def partial_path(self, key):
+        """Returns a unique path in the cache directory to write an entry
+        for key to before it is put().
+
+        Partial entries are not returned by get() and do not count towards
+        the size of the cache.
+        """
+        return '{}.{}.part'.format(self.path(key), uuid.uuid4().hex)
+
+    def put(self, key, elt_path):
+        """Moves the file at elt_path into the cache under key, replacing
+        any other cached versions of the same LossSet, and returns its new
+        path.
+        """
+        path = self.path(key)
+
+        # Move to a private name first so that other processes sharing the
+        # cache never see a partially written entry. Moving a partial_path()
+        # is only a rename.
+        partial_path = self.partial_path(key)
+        shutil.move(elt_path, partial_path)
+        os.rename(partial_path, path)
+        self._discard_other_versions(key, self.suffix)
+        return path
+
+    def _discard_other_versions(self, key, suffix):
+        """Removes the entries with suffix for other keys of the same
+        resource as key.
+        """
+        resource_id = key.rsplit('-', 1)[0]
+        for name in os.listdir(self.directory):
+            if name.startswith(resource_id + '-') and \
+                    name.endswith(suffix) and name != key + suffix:
+                self.discard(os.path.join(self.directory, name))
+
+    def combined_path(self, combined_id):
+        return os.path.join(self.directory, 'combined-{}{}'.format(
+            combined_id, self.combined_suffix))
+
+    def put_combined(self, combined_id, manifest, state):
+        """Stores the manifest (a JSON-serializable dict) and aggregated
+        state (an array of AGGREGATE_DTYPE records) of the combined LossSet
+        combined_id.
+        """
+        path = self.combined_path(combined_id)
+        partial_path = '{}.{}.part'.format(path, uuid.uuid4().hex)
+        try:
+            with open(partial_path, 'wb') as combined_file:
+                np.savez(combined_file, state=state,
+                         manifest=np.array(json.dumps(manifest)))
+            os.rename(partial_path, path)
+        except BaseException:
+            self.discard(partial_path)
+            raise
+
+    def get_combined(self, combined_id):
+        """Returns the (manifest, state) stored for the combined LossSet
+        combined_id, or None if there is none. Marks the entry as recently
+        used.
+        """
+        path = self.combined_path(combined_id)
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        with np.load(path, allow_pickle=False) as combined:
+            manifest = json.loads(str(combined['manifest']))
+            state = combined['state'].astype(AGGREGATE_DTYPE)
+        return manifest, state
+
+    def event_ids_path(self, key):
+        return os.path.join(self.directory, key + self.event_ids_suffix)
+
+    def put_event_ids(self, key, event_ids):
+        """Stores the sorted event ids of an event catalog under key (see
+        key()), replacing any other cached versions of the same catalog.
+        """
+        path = self.event_ids_path(key)
+        partial_path = '{}.{}.part'.format(path, uuid.uuid4().hex)
+        try:
+            with open(partial_path, 'wb') as event_ids_file:
+                np.save(event_ids_file, event_ids)
+            os.rename(partial_path, path)
+        except BaseException:
+            self.discard(partial_path)
+            raise
+        self._discard_other_versions(key, self.event_ids_suffix)
+
+    def get_event_ids(self, key):
+        """Returns the event ids stored under key, or None if there are
+        none. Marks the entry as recently used.
+        """
+        path = self.event_ids_path(key)
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return np.load(path, allow_pickle=False)
+
+    def _entries(self):
+        """Returns (mtime, size, path) for each cached ELT, combined state
+        and set of event ids, oldest first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith((self.suffix, self.combined_suffix,
+                                  self.event_ids_suffix)):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        """Returns the total size of the cache in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache is no larger
+        than max_bytes.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.discard(path)
+            total -= size
+
+    def discard(self, path):
+        """Removes the (possibly partial) cache file at path, if it exists."""
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,672 @@
+"""Columnar reading and writing of ELT (event loss table) CSV files.
+
+An ELT is held as a NumPy structured array of ELT_DTYPE records, giving
+typed EventId, Loss, STDDEVI, STDDEVC and EXPVALUE columns.
+"""
+import collections
+import csv
+import heapq
+import io
+import itertools
+import os
+import re
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+ELT_COLUMNS = ('EventId', 'Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE')
+
+ELT_DTYPE = np.dtype([
+    ('EventId', np.int64),
+    ('Loss', np.float64),
+    ('STDDEVI', np.float64),
+    ('STDDEVC', np.float64),
+    ('EXPVALUE', np.float64),
+])
+
+ELT_HEADER = ','.join(ELT_COLUMNS) + '\n'
+
+# Number of rows parsed or formatted at a time
+CHUNK_ROWS = 256 * 1024
+
+# Number of rows sorted in memory into each run file of an ELTMerger
+RUN_ROWS = 1024 * 1024
+
+# Number of rows read from each run file at a time when merging
+MERGE_BUFFER_ROWS = 64 * 1024
+
+# Layout of the records in binary ELT files: ELT_DTYPE, little-endian
+ELT_FILE_DTYPE = ELT_DTYPE.newbyteorder('<')
+
+# Extension of binary ELT files
+ELT_FILE_SUFFIX = '.elt'
+
+# repr() writes the shortest decimal that reads back as the same float, so
+# '10.5' is written back as '10.5' and no digits of a value are lost.
+_ROW_FORMAT = '%d,%r,%r,%r,%r\n'
+
+# np.loadtxt() parses integers exactly and handles quoted fields from NumPy
+# 1.23; before that it reads integers through floats.
+_LOADTXT_ROWS = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+# Rows with a quoted or empty field, which np.loadtxt() cannot parse and
+# which are not copied as they are by iter_elt_text()
+_IRREGULAR_ROW = re.compile(r'"|(?:^|,)[ \t]*(?:,|$)', re.MULTILINE)
+
+# Bytes appended to a block of CSV text by _copy_fields(), for the
+# delimiters and default fields of the rows it writes
+_COPY_SUFFIX = np.frombuffer(b',\n0.0', dtype=np.uint8)
+
+
+def _copy_fields(text, rows, indices, columns):
+    """Copies the fields of rows of CSV text (each with a trailing newline)
+    into ELT_COLUMNS order, filling in missing optional fields, without
+    parsing them. indices are the positions of the ELT_COLUMNS in each row,
+    as returned by _column_indices(), and columns is the number of fields
+    in each row.
+
+    The fields are gathered with NumPy for the whole block at once. Returns
+    None if a row does not have columns fields, or has a quoted or empty
+    field, so that the rows have to be read one at a time instead.
+    """
+    if '"' in text or ((' ' in text or '\t' in text) and
+                       _IRREGULAR_ROW.search(text)):
+        return None
+
+    data = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    separators = np.flatnonzero((data == ord(',')) | (data == ord('\n')))
+    if len(separators) != rows * columns:
+        return None
+    ends = separators.reshape(rows, columns)
+    if not (data[ends[:, -1]] == ord('\n')).all():
+        return None
+    starts = np.empty_like(ends)
+    starts.flat[0] = 0
+    starts.flat[1:] = separators[:-1] + 1
+    if (starts == ends).any():
+        return None
+
+    if columns == len(ELT_COLUMNS) and indices == list(range(columns)):
+        return text
+
+    # Each output row is made of ten segments, a field and the delimiter
+    # after it for each of the ELT_COLUMNS, which are either copied from
+    # the row or from _COPY_SUFFIX
+    comma, newline, default = len(data), len(data) + 1, len(data) + 2
+    segment_starts = np.empty((rows, 2 * len(ELT_COLUMNS)), dtype=np.intp)
+    segment_ends = np.empty_like(segment_starts)
+    indices = indices[:4] + [indices[1] if indices[4] is None else indices[4]]
+    for column, index in enumerate(indices):
+        if index is None:
+            segment_starts[:, 2 * column] = default
+            segment_ends[:, 2 * column] = default + 3
+        else:
+            segment_starts[:, 2 * column] = starts[:, index]
+            segment_ends[:, 2 * column] = ends[:, index]
+        delimiter = newline if column == len(ELT_COLUMNS) - 1 else comma
+        segment_starts[:, 2 * column + 1] = delimiter
+        segment_ends[:, 2 * column + 1] = delimiter + 1
+
+    lengths = (segment_ends - segment_starts).ravel()
+    offsets = np.cumsum(lengths) - lengths
+    gather = np.repeat(segment_starts.ravel() - offsets, lengths)
+    gather += np.arange(len(gather))
+    copied = np.concatenate([data, _COPY_SUFFIX])[gather]
+    return copied.tobytes().decode('utf-8')
+
+
+def _fieldnames(header_line):
+    return [name.strip() for name in next(csv.reader([header_line]))]
+
+
+def _column_indices(header_line):
+    """Returns the positions of the ELT_COLUMNS in header_line, with None
+    for optional columns that are not present.
+    """
+    fieldnames = _fieldnames(header_line)
+
+    event_column = 'EventId'
+    if 'EventId' not in fieldnames:
+        event_column = 'EventID'
+
+    for required in (event_column, 'Loss'):
+        if required not in fieldnames:
+            raise ValueError(
+                "ELT header '{}' has no {} column.".format(
+                    header_line.strip(), required))
+
+    names = (event_column,) + ELT_COLUMNS[1:]
+    return [fieldnames.index(name) if name in fieldnames else None
+            for name in names]
+
+
+def _ordered_fields(row, indices):
+    """Returns the fields of a CSV row (a list of strings) in ELT_COLUMNS
+    order, with missing or empty optional fields set to their defaults.
+    """
+    fields = [row[index].strip() if index is not None and index < len(row)
+              else '' for index in indices]
+    if not fields[2]:
+        fields[2] = '0.0'
+    if not fields[3]:
+        fields[3] = '0.0'
+    if not fields[4]:
+        fields[4] = fields[1]
+    return fields
+
+
+def _load_rows(lines, indices):
+    """Parses CSV lines into an array of ELT_DTYPE records with
+    np.loadtxt(), raising ValueError for rows it cannot parse.
+    """
+    names = [name for name, index in zip(ELT_COLUMNS, indices)
+             if index is not None]
+    values = np.loadtxt(
+        lines, delimiter=',', quotechar='"', comments=None, ndmin=1,
+        usecols=[index for index in indices if index is not None],
+        dtype=[(name, ELT_DTYPE[name]) for name in names])
+
+    elt = np.empty(len(values), dtype=ELT_DTYPE)
+    for name in names:
+        elt[name] = values[name]
+
+    # Defaults for the optional columns
+    if indices[2] is None:
+        elt['STDDEVI'] = 0.0
+    if indices[3] is None:
+        elt['STDDEVC'] = 0.0
+    if indices[4] is None:
+        elt['EXPVALUE'] = elt['Loss']
+
+    return elt
+
+
+def _read_rows(lines, indices):
+    """Parses CSV lines into an array of ELT_DTYPE records a row at a time,
+    allowing quoted fields and empty optional fields.
+    """
+    records = []
+    for row in csv.reader(lines):
+        fields = _ordered_fields(row, indices)
+        try:
+            event_id = int(fields[0])
+        except ValueError:
+            raise ValueError(
+                "ELT row '{}' has EventId '{}', which is not an "
+                "integer.".format(','.join(row), fields[0]))
+        try:
+            records.append((event_id,) + tuple(
+                float(field) for field in fields[1:]))
+        except ValueError:
+            raise ValueError(
+                "ELT row '{}' has a Loss, STDDEVI, STDDEVC or EXPVALUE that "
+                "is not a number.".format(','.join(row)))
+    return np.array(records, dtype=ELT_DTYPE)
+
+
+def _parse_rows(lines, indices):
+    """Parses CSV lines into an array of ELT_DTYPE records."""
+    if _LOADTXT_ROWS:
+        try:
+            return _load_rows(lines, indices)
+        except ValueError:
+            # Quoted or empty fields, or an invalid value that _read_rows()
+            # reports
+            pass
+    return _read_rows(lines, indices)
+
+
+def iter_elt_chunks(elt_file, chunk_rows=CHUNK_ROWS):
+    """Reads an ELT CSV from a text file object (or any iterable of lines)
+    and yields it as arrays of at most chunk_rows ELT_DTYPE records.
+
+    The event column may be named EventId or EventID. STDDEVI and STDDEVC
+    default to 0.0 and EXPVALUE defaults to Loss when absent. Columns other
+    than the ELT_COLUMNS are ignored.
+    """
+    lines = iter(elt_file)
+    header_line = next(lines, None)
+    if header_line is None:
+        return
+
+    indices = _column_indices(header_line)
+    while True:
+        chunk = [line for line in itertools.islice(lines, chunk_rows)
+                 if line.strip()]
+        if not chunk:
+            break
+        yield _parse_rows(chunk, indices)
+
+
+def iter_elt_text(elt_file, chunk_rows=CHUNK_ROWS):
+    """Reads an ELT CSV as iter_elt_chunks() does, but without parsing its
+    values: yields (text, rows) for blocks of at most chunk_rows rows, as
+    CSV text (without a header) with the columns in ELT_COLUMNS order.
+
+    Rows that are already in that order are copied as they are. Other rows
+    have their columns reordered (dropping any that are not ELT_COLUMNS)
+    and missing or empty optional fields filled in with their defaults, a
+    block at a time unless a row in the block has a quoted or empty field
+    or the wrong number of fields.
+    """
+    lines = iter(elt_file)
+    header_line = next(lines, None)
+    if header_line is None:
+        return
+
+    indices = _column_indices(header_line)
+    columns = len(_fieldnames(header_line))
+    while True:
+        chunk = [line.rstrip('\r\n')
+                 for line in itertools.islice(lines, chunk_rows)
+                 if line.strip()]
+        if not chunk:
+            break
+
+        text = _copy_fields('\n'.join(chunk) + '\n', len(chunk), indices,
+                            columns)
+        if text is None:
+            text = ''.join([','.join(_ordered_fields(row, indices)) + '\n'
+                            for row in csv.reader(chunk)])
+        yield text, len(chunk)
+
+
+def read_elt(elt_file):
+    """Reads a whole ELT CSV into one array of ELT_DTYPE records."""
+    chunks = list(iter_elt_chunks(elt_file))
+    if not chunks:
+        return np.empty(0, dtype=ELT_DTYPE)
+    return np.concatenate(chunks)
+
+
+def read_event_ids(catalog_file, chunk_rows=CHUNK_ROWS):
+    """Reads the EventId (or EventID) column of an event catalog CSV from a
+    text file object (or any iterable of lines), and returns the distinct
+    event ids as a sorted int64 array for filter_elt().
+    """
+    lines = iter(catalog_file)
+    header_line = next(lines, None)
+    chunks = [np.empty(0, dtype=np.int64)]
+    if header_line is None:
+        return chunks[0]
+
+    fieldnames = _fieldnames(header_line)
+    event_column = 'EventId'
+    if 'EventId' not in fieldnames:
+        event_column = 'EventID'
+    if event_column not in fieldnames:
+        raise ValueError(
+            "Event catalog header '{}' has no {} column.".format(
+                header_line.strip(), event_column))
+
+    usecols = [fieldnames.index(event_column)]
+    while True:
+        chunk = [line for line in itertools.islice(lines, chunk_rows)
+                 if line.strip()]
+        if not chunk:
+            break
+        chunks.append(np.loadtxt(chunk, delimiter=',', usecols=usecols,
+                                 dtype=np.int64, ndmin=1, comments=None))
+    return np.unique(np.concatenate(chunks))
+
+
+def filter_elt(elt, event_ids):
+    """Returns the records of elt whose EventId is in event_ids, a sorted
+    array of event ids such as read_event_ids() returns.
+
+    Each EventId is looked up by binary search, so the ELT is not sorted.
+    elt itself is returned if every record is kept.
+    """
+    if len(event_ids) == 0:
+        return elt[:0]
+    positions = np.searchsorted(event_ids, elt['EventId'])
+    np.minimum(positions, len(event_ids) - 1, out=positions)
+    keep = event_ids[positions] == elt['EventId']
+    if keep.all():
+        return elt
+    return elt[keep]
+
+
+def write_elt_file(elt_chunks, path):
+    """Writes arrays of ELT_DTYPE records to a binary ELT file at path: the
+    records laid out back to back as ELT_FILE_DTYPE, with no header.
+    """
+    with open(path, 'wb') as elt_file:
+        for elt in elt_chunks:
+            elt.astype(ELT_FILE_DTYPE, copy=False).tofile(elt_file)
+
+
+def convert_elt_csv(csv_path, path):
+    """Parses the ELT CSV at csv_path into a binary ELT file at path."""
+    with io.open(csv_path, encoding='utf-8') as csv_file:
+        write_elt_file(iter_elt_chunks(csv_file), path)
+
+
+def open_elt_file(path):
+    """Returns the records in the binary ELT file at path as a read-only
+    memory-mapped array, so that only the pages that are used are read.
+    """
+    if os.path.getsize(path) == 0:
+        # Empty files cannot be mapped
+        return np.empty(0, dtype=ELT_FILE_DTYPE)
+    return np.memmap(path, dtype=ELT_FILE_DTYPE, mode='r')
+
+
+def _parse_elt_file(elt_path):
+    """Process pool worker: parses the ELT CSV at elt_path.
+
+    The records are returned in a new shared memory block, as its name and
+    the number of records, so that they are not pickled back to the parent
+    process. Without shared memory the array itself is returned.
+    """
+    with io.open(elt_path, encoding='utf-8') as elt_file:
+        elt = read_elt(elt_file)
+    if shared_memory is None:
+        return elt
+
+    block = shared_memory.SharedMemory(create=True, size=max(elt.nbytes, 1))
+    try:
+        np.ndarray(len(elt), dtype=ELT_DTYPE, buffer=block.buf)[:] = elt
+    finally:
+        block.close()
+
+    # The parent process unlinks the block, so this process's resource
+    # tracker must not try to clean it up as well
+    if os.name == 'posix':
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block.name, len(elt)
+
+
+def _attach_elt(result):
+    """Returns the records a _parse_elt_file() worker returned, freeing
+    their shared memory block.
+    """
+    if shared_memory is None:
+        return result
+
+    name, rows = result
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        # One copy out of the block, so that it can be freed straight away
+        view = np.ndarray(rows, dtype=ELT_DTYPE, buffer=block.buf)
+        elt = view.copy()
+        del view
+    finally:
+        block.close()
+        block.unlink()
+    return elt
+
+
+def parse_elt_files(elt_paths, processes):
+    """Parses the ELT CSV files at elt_paths in a pool of processes and
+    yields each one as an array of ELT_DTYPE records, in order.
+
+    At most twice as many files as there are processes are parsed ahead of
+    the one being yielded, to bound the memory used.
+    """
+    elt_paths = iter(elt_paths)
+    with ProcessPoolExecutor(processes) as pool:
+        futures = collections.deque(
+            pool.submit(_parse_elt_file, elt_path)
+            for elt_path in itertools.islice(elt_paths, 2 * processes))
+        try:
+            while futures:
+                elt = _attach_elt(futures.popleft().result())
+                for elt_path in itertools.islice(elt_paths, 1):
+                    futures.append(pool.submit(_parse_elt_file, elt_path))
+                yield elt
+        finally:
+            # Free the blocks of files that were parsed but not yielded
+            for future in futures:
+                future.cancel()
+                if not future.cancelled() and future.exception() is None:
+                    _attach_elt(future.result())
+
+
+def format_elt(elt, chunk_rows=CHUNK_ROWS):
+    """Yields the ELT_DTYPE records in elt as CSV text (without a header),
+    chunk_rows rows at a time.
+    """
+    for start in range(0, len(elt), chunk_rows):
+        rows = elt[start:start + chunk_rows].tolist()
+        yield ''.join([_ROW_FORMAT % row for row in rows])
+
+
+def _reduce_by_event(elt):
+    """Sums the records in elt by EventId, returning them sorted by
+    EventId.
+    """
+    event_ids, inverse = np.unique(elt['EventId'], return_inverse=True)
+    inverse = inverse.ravel()
+
+    reduced = np.empty(len(event_ids), dtype=elt.dtype)
+    reduced['EventId'] = event_ids
+    for name in elt.dtype.names[1:]:
+        reduced[name] = np.bincount(inverse, weights=elt[name],
+                                    minlength=len(event_ids))
+    return reduced
+
+
+# Records of an ELTAggregator's state: ELT_DTYPE with the variance rather
+# than the standard deviation in STDDEVI, and the number of rows added for
+# each event.
+AGGREGATE_DTYPE = np.dtype(ELT_DTYPE.descr + [('Rows', np.float64)])
+
+
+def _aggregate_records(elt, multiplicity):
+    """Returns the records in elt, multiplicity times over, as
+    AGGREGATE_DTYPE records to be summed.
+    """
+    records = np.empty(len(elt), dtype=AGGREGATE_DTYPE)
+    for name in ELT_COLUMNS:
+        records[name] = elt[name]
+    records['STDDEVI'] **= 2
+    records['Rows'] = 1
+    if multiplicity != 1:
+        for name in AGGREGATE_DTYPE.names[1:]:
+            records[name] *= multiplicity
+    return records
+
+
+def aggregated_elt(state):
+    """Returns the ELT_DTYPE records of an aggregation state (an array of
+    AGGREGATE_DTYPE records, as returned by ELTAggregator.state()).
+    """
+    combined = np.empty(len(state), dtype=ELT_DTYPE)
+    for name in ELT_COLUMNS:
+        combined[name] = state[name]
+    # Removing ELTs can leave rounding errors below zero
+    combined['STDDEVI'] = np.sqrt(np.maximum(combined['STDDEVI'], 0))
+    return combined
+
+
+class ELTAggregator(object):
+    """Combines ELTs into a single ELT with one record per EventId.
+
+    Loss, EXPVALUE and STDDEVC are summed, and STDDEVI is added in
+    quadrature (its variances are summed). ELTs are added with add() and the
+    combined ELT, sorted by EventId, is returned by result().
+
+    Added records are reduced in batches, so memory use is bounded by the
+    number of distinct events plus the size of the unreduced batch rather
+    than by the total number of records added.
+
+    Adding an ELT with a negative multiplicity removes it again. state()
+    returns the sums so far, and passing them back in as state continues
+    the aggregation, e.g. to add or remove ELTs from a previous result.
+    """
+
+    def __init__(self, batch_rows=CHUNK_ROWS, state=None):
+        self._batch_rows = batch_rows
+        self._reduced = np.empty(0, dtype=AGGREGATE_DTYPE)
+        if state is not None:
+            self._reduced = np.array(state, dtype=AGGREGATE_DTYPE)
+        self._pending = []
+        self._pending_rows = 0
+
+    def add(self, elt, multiplicity=1):
+        """Adds the records in elt, multiplicity times over."""
+        pending = _aggregate_records(elt, multiplicity)
+        self._pending.append(pending)
+        self._pending_rows += len(pending)
+
+        # Reducing only once the batch outgrows the reduced ELT avoids
+        # re-sorting every distinct event for each small ELT added.
+        if self._pending_rows >= max(self._batch_rows, len(self._reduced)):
+            self._reduce()
+
+    def _reduce(self):
+        if self._pending:
+            reduced = _reduce_by_event(
+                np.concatenate([self._reduced] + self._pending))
+            # Drop events whose rows have all been removed again
+            self._reduced = reduced[reduced['Rows'] > 0.5]
+            self._pending = []
+            self._pending_rows = 0
+
+    def state(self):
+        """Returns the sums of the records added so far, as an array of
+        AGGREGATE_DTYPE records.
+        """
+        self._reduce()
+        return self._reduced.copy()
+
+    def result(self):
+        self._reduce()
+        return aggregated_elt(self._reduced)
+
+
+class ELTMerger(object):
+    """Combines ELTs into a single ELT sorted by EventId, in external memory.
+
+    Added records are collected into runs of run_rows records, which are
+    sorted by EventId and written to .npy files in directory. merge() then
+    yields the records of all the runs in EventId order, with a k-way merge
+    that reads buffer_rows records of each run at a time, so memory use is
+    bounded by run_rows and by the number of runs times buffer_rows rather
+    than by the size of the combined ELT.
+
+    If reduce is True, records with the same EventId are combined as they
+    are merged, in the same way as by ELTAggregator, and merge_state()
+    yields the sums as an ELTAggregator's state. Otherwise they are kept in
+    the order they were added.
+    """
+
+    def __init__(self, directory, reduce=False, run_rows=RUN_ROWS,
+                 buffer_rows=MERGE_BUFFER_ROWS):
+        self._directory = directory
+        self._reduce = reduce
+        self._dtype = AGGREGATE_DTYPE if reduce else ELT_DTYPE
+        self._run_rows = run_rows
+        self._buffer_rows = buffer_rows
+        self._runs = []
+        self._pending = []
+        self._pending_rows = 0
+
+    def add(self, elt, multiplicity=1):
+        """Adds the records in elt, multiplicity times over."""
+        if self._reduce:
+            self._pending.append(_aggregate_records(elt, multiplicity))
+        else:
+            self._pending.extend([elt] * multiplicity)
+        self._pending_rows += len(elt) * (1 if self._reduce else multiplicity)
+
+        if self._pending_rows >= self._run_rows:
+            self._write_run()
+
+    def _write_run(self):
+        if not self._pending_rows:
+            return
+
+        run = np.concatenate(self._pending)
+        run = run[np.argsort(run['EventId'], kind='stable')]
+        if self._reduce:
+            run = _reduce_by_event(run)
+        self._pending = []
+        self._pending_rows = 0
+
+        handle, path = tempfile.mkstemp(suffix='.npy', prefix='elt-run-',
+                                        dir=self._directory)
+        with os.fdopen(handle, 'wb') as run_file:
+            np.save(run_file, run)
+        self._runs.append(path)
+
+    def merge(self):
+        """Yields the combined ELT as arrays of ELT_DTYPE records, in
+        EventId order.
+        """
+        for merged in self._merged():
+            yield aggregated_elt(merged) if self._reduce else merged
+
+    def merge_state(self):
+        """Yields the combined ELT of an ELTMerger with reduce=True as
+        arrays of AGGREGATE_DTYPE records, in EventId order. Concatenated,
+        they are the state of an ELTAggregator to which the same ELTs have
+        been added.
+        """
+        if not self._reduce:
+            raise ValueError('Only a reducing ELTMerger has a state.')
+        return self._merged()
+
+    def _merged(self):
+        self._write_run()
+        runs = [np.load(path, mmap_mode='r') for path in self._runs]
+        positions = [0] * len(runs)
+        buffers = [np.empty(0, dtype=self._dtype) for _ in runs]
+
+        # Heap of (last EventId in buffer, run index) for runs that have not
+        # been read to the end. Every record before the smallest of these
+        # EventIds has been read from every run, so it can be written out.
+        heap = []
+
+        def refill(index):
+            start = positions[index]
+            if start < len(runs[index]):
+                end = start + self._buffer_rows
+                buffers[index] = np.concatenate(
+                    [buffers[index], runs[index][start:end]])
+                positions[index] = min(end, len(runs[index]))
+                heapq.heappush(heap, (buffers[index]['EventId'][-1], index))
+
+        for index in range(len(runs)):
+            refill(index)
+
+        while heap:
+            bound = heap[0][0]
+            emptied = []
+            while heap and heap[0][0] == bound:
+                emptied.append(heapq.heappop(heap)[1])
+
+            # Take the buffered records before bound, in run order so that
+            # the stable sort keeps the records of each event in the order
+            # they were added.
+            taken = []
+            for index, buffer in enumerate(buffers):
+                end = np.searchsorted(buffer['EventId'], bound, side='left')
+                taken.append(buffer[:end])
+                buffers[index] = buffer[end:]
+
+            for index in emptied:
+                refill(index)
+
+            merged = self._merge(taken)
+            if len(merged):
+                yield merged
+
+        merged = self._merge(buffers)
+        if len(merged):
+            yield merged
+
+    def _merge(self, elts):
+        merged = np.concatenate([np.empty(0, dtype=self._dtype)] + elts)
+        merged = merged[np.argsort(merged['EventId'], kind='stable')]
+        if self._reduce:
+            merged = _reduce_by_event(merged)
+        return merged
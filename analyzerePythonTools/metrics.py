@@ -0,0 +1,127 @@
+"""Timings, counts and progress events of the phases of an ELT combine."""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Span(object):
+    """A timed phase of a combine (e.g. 'download'), or a timed step within
+    one (e.g. 'download_elt', the download of a single ELT).
+
+    start is the time the span began, as returned by time.time(), and
+    seconds how long it lasted. attributes holds what the span worked on,
+    e.g. an 'elt_id', and counts of the work done, e.g. 'bytes' or 'rows'.
+    """
+
+    def __init__(self, name, start, seconds=None, **attributes):
+        self.name = name
+        self.start = start
+        self.seconds = seconds
+        self.attributes = attributes
+
+    def __repr__(self):
+        return 'Span({!r}, seconds={!r}, {})'.format(
+            self.name, self.seconds, ', '.join(
+                '{}={!r}'.format(key, value)
+                for key, value in sorted(self.attributes.items())))
+
+
+class CombineEvent(object):
+    """A step in the progress of a combine, e.g. 'download_finished'.
+
+    time is when it happened, as returned by time.time(), and attributes
+    describes it, e.g. the 'elt_id' and 'bytes' of a finished download.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.time = time.time()
+        self.attributes = attributes
+
+    def __repr__(self):
+        return 'CombineEvent({!r}, {})'.format(
+            self.name, ', '.join(
+                '{}={!r}'.format(key, value)
+                for key, value in sorted(self.attributes.items())))
+
+
+class CombineReport(object):
+    """The spans recorded during one combine, in the order they finished.
+
+    Spans nest: the 'upload' span includes the 'combine' span, as the
+    combined ELT is generated while it is uploaded, and that includes the
+    'parse_elt' spans of the ELTs read while combining. Likewise each
+    'download_elt' span includes the 'cache_elt' span of converting that ELT
+    into the cache, if there is one. Spans for steps that run concurrently
+    (such as 'download_elt') can add up to more than the span of their
+    phase.
+
+    If on_span is given, it is called with each Span as it finishes (from
+    whichever thread finished it), so that timings can be passed on to a
+    metrics or tracing system while the combine runs.
+    """
+
+    def __init__(self, on_span=None):
+        self.spans = []
+        self._on_span = on_span
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Times the body of a with statement as a span of name, which is
+        recorded even if the body raises. Yields the Span, so that counts
+        can be added to its attributes.
+        """
+        span = Span(name, time.time(), **attributes)
+        try:
+            yield span
+        finally:
+            span.seconds = time.time() - span.start
+            self.add(span)
+
+    def add(self, span):
+        """Records the finished span."""
+        with self._lock:
+            self.spans.append(span)
+        if self._on_span is not None:
+            self._on_span(span)
+
+    def totals(self):
+        """Returns an OrderedDict mapping each span name, in the order first
+        recorded, to a dict of the number of spans, their total seconds and
+        the totals of their numeric attributes.
+        """
+        totals = OrderedDict()
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span.name, {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += span.seconds
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)):
+                    total[key] = total.get(key, 0) + value
+        return totals
+
+    @property
+    def seconds(self):
+        """Wall time from the start of the first span to the end of the
+        last.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        if not spans:
+            return 0.0
+        return max(span.start + span.seconds for span in spans) - \
+            min(span.start for span in spans)
+
+    def __str__(self):
+        lines = ['{:<14} {:>6} {:>10} {:>14} {:>16}'.format(
+            'span', 'count', 'seconds', 'rows', 'bytes')]
+        for name, total in self.totals().items():
+            lines.append('{:<14} {:>6} {:>10.3f} {:>14} {:>16}'.format(
+                name, total['count'], total['seconds'],
+                '{:,}'.format(total['rows']) if 'rows' in total else '-',
+                '{:,}'.format(total['bytes']) if 'bytes' in total else '-'))
+        return '\n'.join(lines)
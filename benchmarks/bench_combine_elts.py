@@ -0,0 +1,365 @@
+"""Measures ELTCombiner.combine_elts_from_resources end to end against a
+local stand-in for the Analyze Re API.
+
+Usage:
+
+    python benchmarks/bench_combine_elts.py [--rows N [N ...]] [--elts E]
+        [--layers L] [--aggregate] [--sort] [--cache-dir DIR]
+        [--download-concurrency C] [--parse-processes P]
+        [--compress-upload]
+
+For each total size in --rows (10,000 to 50,000,000 rows is a sensible
+range), E synthetic ELTs of N / E rows each are written to a temporary
+directory and served by an HTTP server on localhost, along with the
+EventCatalog, Portfolio, Layer and LossSet JSON that refers to them and the
+upload endpoints the combined ELT is sent to. The ELTs are spread over L
+Layers of a single Portfolio, which is what is combined.
+
+Wall time, rows/s, MB/s and peak RSS are reported for each phase of the
+combiner's report: resolving the Portfolio to its ELTs, downloading them,
+combining them and uploading the result. The combined ELT is generated
+while it is uploaded, so the upload time includes the combine time.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import analyzere
+import numpy as np
+
+from analyzerePythonTools.combine_elts import ELTCombiner
+from analyzerePythonTools.elts import ELT_DTYPE, ELT_HEADER, format_elt
+
+# Rows generated and written at a time
+WRITE_ROWS = 1024 * 1024
+
+# Block size the server sends ELT files in
+SEND_SIZE = 1024 * 1024
+
+# Seconds between resident set size samples
+RSS_INTERVAL = 0.01
+
+# Spans of ELTCombiner.report that follow one another, for which the peak
+# RSS is reported
+PHASES = ('resolve', 'download', 'upload')
+
+
+def write_synthetic_elt(path, rows, seed=0):
+    """Writes an ELT of rows rows with all five columns, and returns its
+    size in bytes.
+    """
+    rng = np.random.RandomState(seed)
+    with io.open(path, 'w', encoding='utf-8') as elt_file:
+        elt_file.write(ELT_HEADER)
+        for start in range(0, rows, WRITE_ROWS):
+            count = min(WRITE_ROWS, rows - start)
+            elt = np.zeros(count, dtype=ELT_DTYPE)
+            elt['EventId'] = rng.randint(1, 1000000, count)
+            elt['Loss'] = np.round(rng.uniform(0.0, 1e7, count), 2)
+            elt['STDDEVI'] = np.round(elt['Loss'] * 0.1, 2)
+            elt['STDDEVC'] = np.round(elt['Loss'] * 0.2, 2)
+            elt['EXPVALUE'] = elt['Loss']
+            for text in format_elt(elt):
+                elt_file.write(text)
+    return os.path.getsize(path)
+
+
+class StandInAPI(object):
+    """The resources and ELT files served by the stand-in API server."""
+
+    def __init__(self, directory, rows, elts, layers):
+        self.directory = directory
+        self.resources = {}
+        self.elt_rows = 0
+        self.elt_bytes = 0
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+
+        self.catalog_id = str(uuid.uuid4())
+        self.resources['event_catalogs', self.catalog_id] = {
+            'id': self.catalog_id,
+        }
+
+        layer_ids = [str(uuid.uuid4()) for _ in range(layers)]
+        layer_loss_sets = dict((layer_id, []) for layer_id in layer_ids)
+        for i in range(elts):
+            loss_set_id = str(uuid.uuid4())
+            elt_rows = rows * (i + 1) // elts - rows * i // elts
+            filename = '{}.csv'.format(loss_set_id)
+            self.elt_bytes += write_synthetic_elt(
+                os.path.join(directory, filename), elt_rows, seed=i)
+            self.elt_rows += elt_rows
+
+            self.resources['loss_sets', loss_set_id] = {
+                '_type': 'ELTLossSet',
+                'id': loss_set_id,
+                'modified': '2019-03-09T18:38:04.801820Z',
+                'data': {'name': filename},
+            }
+            layer_loss_sets[layer_ids[i % layers]].append(loss_set_id)
+
+        for layer_id in layer_ids:
+            self.resources['layers', layer_id] = {
+                '_type': 'CatXL',
+                'id': layer_id,
+                'loss_sets': [self.reference('loss_sets', loss_set_id)
+                              for loss_set_id in layer_loss_sets[layer_id]],
+            }
+
+        self.portfolio_id = str(uuid.uuid4())
+        self.resources['portfolios', self.portfolio_id] = {
+            'id': self.portfolio_id,
+            'layers': [self.reference('layers', layer_id)
+                       for layer_id in layer_ids],
+        }
+
+    @staticmethod
+    def reference(collection, resource_id):
+        return {
+            'ref_id': resource_id,
+            'href': '{}/{}/{}'.format(analyzere.base_url.rstrip('/'),
+                                      collection, resource_id),
+        }
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Serves the StandInAPI that api is set to."""
+
+    daemon_threads = True
+    api = None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, SEND_SIZE)))
+        return length
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/uploads/files/'):
+            return self.send_elt(os.path.basename(path))
+        if path.endswith('/data/status'):
+            return self.send_json({'status': 'Processing Successful',
+                                   'commit_progress': 100})
+        if path.rstrip('/') == '/loss_sets':
+            return self.send_json([])
+
+        match = re.match(r'^/(\w+)/([\w-]+)$', path)
+        body = match and self.server.api.resources.get(match.groups())
+        if not body:
+            return self.send_json({'message': 'Not found'}, 404)
+        self.send_json(body)
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if path.rstrip('/') == '/loss_sets':
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            body['id'] = str(uuid.uuid4())
+            return self.send_json(body, 201)
+        self.read_body()
+        self.send_json({})
+
+    def do_PATCH(self):
+        length = self.read_body()
+        with self.server.api.lock:
+            self.server.api.uploaded_bytes += length
+        self.send_json({})
+
+    def send_elt(self, filename):
+        path = os.path.join(self.server.api.directory, filename)
+        if not os.path.exists(path):
+            return self.send_json({'message': 'Not found'}, 404)
+
+        size = os.path.getsize(path)
+        etag = '"{}-{}"'.format(filename, size)
+        start, end = 0, size
+        byte_range = re.match(r'^bytes=(\d+)-(\d*)$',
+                              self.headers.get('Range', ''))
+        if byte_range and self.headers.get('If-Range', etag) == etag:
+            start = int(byte_range.group(1))
+            if byte_range.group(2):
+                end = min(size, int(byte_range.group(2)) + 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        with open(path, 'rb') as elt_file:
+            elt_file.seek(start)
+            remaining = end - start
+            try:
+                while remaining:
+                    data = elt_file.read(min(remaining, SEND_SIZE))
+                    self.wfile.write(data)
+                    remaining -= len(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # Segmented downloads drop the first connection early
+                self.close_connection = True
+
+
+class RSSSampler(object):
+    """Samples the resident set size of this process in a background
+    thread, keeping the peak since the last reset().
+
+    Uses /proc/self/statm where it exists, and the lifetime peak from
+    getrusage() otherwise.
+    """
+
+    def __init__(self):
+        self._peak = 0
+        self._stop = threading.Event()
+        self._page_size = resource.getpagesize()
+        self._statm = os.path.exists('/proc/self/statm')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def rss(self):
+        if self._statm:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * self._page_size
+        # Kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.wait(RSS_INTERVAL):
+            self._peak = max(self._peak, self.rss())
+
+    def reset(self):
+        self._peak = self.rss()
+
+    def peak(self):
+        return max(self._peak, self.rss())
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run(args, rows, directory, server):
+    api = server.api = StandInAPI(directory, rows, args.elts, args.layers)
+
+    sampler = RSSSampler()
+    peaks = {}
+
+    def on_span(span):
+        if span.name in PHASES:
+            peaks[span.name] = sampler.peak()
+            sampler.reset()
+
+    try:
+        with ELTCombiner(
+                cache_dir=args.cache_dir,
+                download_concurrency=args.download_concurrency,
+                parse_processes=args.parse_processes,
+                compress_upload=args.compress_upload,
+                on_span=on_span) as elt_combiner:
+            sampler.reset()
+            elt_combiner.combine_elts_from_resources(
+                [api.portfolio_id], api.catalog_id,
+                uuid_type='Portfolio',
+                aggregate=args.aggregate,
+                sort=args.sort)
+    finally:
+        sampler.close()
+
+    report = elt_combiner.report
+    totals = report.totals()
+
+    print('{:,} rows in {} ELTs ({:.1f} MB)'.format(
+        api.elt_rows, args.elts, api.elt_bytes / 1e6))
+    print('{:>10} {:>10} {:>14} {:>10} {:>14}'.format(
+        'phase', 'seconds', 'rows/s', 'MB/s', 'peak RSS MB'))
+
+    def row(name, seconds, rows, bytes, peak):
+        print('{:>10} {:>10.3f} {:>14} {:>10} {:>14.1f}'.format(
+            name, seconds,
+            '{:,.0f}'.format(rows / seconds) if rows else '-',
+            '{:.1f}'.format(bytes / seconds / 1e6) if bytes else '-',
+            peak / 1e6))
+
+    # Combining happens during the upload, so it shares the upload's peak
+    row('resolve', totals['resolve']['seconds'], 0, 0, peaks['resolve'])
+    row('download', totals['download']['seconds'], api.elt_rows,
+        api.elt_bytes, peaks['download'])
+    row('combine', totals['combine']['seconds'], api.elt_rows, 0,
+        peaks['upload'])
+    row('upload', totals['upload']['seconds'], 0, api.uploaded_bytes,
+        peaks['upload'])
+    row('total', report.seconds, api.elt_rows, api.elt_bytes,
+        max(peaks.values()))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--elts', type=int, default=8)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--aggregate', action='store_true')
+    parser.add_argument('--sort', action='store_true')
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--download-concurrency', type=int, default=16)
+    parser.add_argument('--parse-processes', type=int, default=1)
+    parser.add_argument('--compress-upload', action='store_true')
+    args = parser.parse_args()
+
+    # Resources refer to each other by href, so the API's address is set
+    # before any are made
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    analyzere.base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+    analyzere.upload_poll_interval = 0.01
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        for rows in args.rows:
+            directory = tempfile.mkdtemp(prefix='bench-combine-elts-')
+            try:
+                run(args, rows, directory, server)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Compares ELT parsing throughput of the NumPy parser in
+analyzerePythonTools.elts against the previous csv.DictReader path and the
+text pass-through used when ELTs are only concatenated.
+
+Usage:
+
+    python benchmarks/bench_elt_parser.py [--rows N] [--repeat R]
+
+Synthetic ELTs with all five columns, and with only the EventId and Loss
+columns, are written to temporary files and each path is timed reading
+them and producing combined ELT rows.
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import io
+import os
+import random
+import tempfile
+import time
+
+from analyzerePythonTools.elts import (
+    format_elt,
+    iter_elt_chunks,
+    iter_elt_text,
+    read_elt,
+)
+
+
+def write_synthetic_elt(path, rows, optional_columns=True, seed=0):
+    rng = random.Random(seed)
+    with io.open(path, 'w', encoding='utf-8') as elt_file:
+        if optional_columns:
+            elt_file.write(u'EventId,Loss,STDDEVI,STDDEVC,EXPVALUE\n')
+        else:
+            elt_file.write(u'EventId,Loss\n')
+        for _ in range(rows):
+            loss = rng.uniform(0.0, 1e7)
+            if optional_columns:
+                elt_file.write(u'{},{:.2f},{:.2f},{:.2f},{:.2f}\n'.format(
+                    rng.randint(1, 1000000), loss, loss * 0.1, loss * 0.2,
+                    loss))
+            else:
+                elt_file.write(u'{},{:.2f}\n'.format(
+                    rng.randint(1, 1000000), loss))
+
+
+def dictreader_combine(path):
+    """The per-row combine loop that ELTCombiner used before NumPy."""
+    rows = 0
+    with io.open(path, encoding='utf-8', newline='') as elt_file:
+        reader = csv.DictReader(elt_file)
+
+        event_column = 'EventId'
+        if 'EventId' not in reader.fieldnames:
+            event_column = 'EventID'
+
+        for row in reader:
+            eventid = row[event_column]
+            loss = row['Loss']
+            stdevi = row.get('STDDEVI', '0.0')
+            stdevc = row.get('STDDEVC', '0.0')
+            expval = row.get('EXPVALUE', loss)
+            ','.join([eventid, loss, stdevi, stdevc, expval])
+            rows += 1
+    return rows
+
+
+def numpy_parse(path):
+    with io.open(path, encoding='utf-8') as elt_file:
+        return len(read_elt(elt_file))
+
+
+def numpy_combine(path):
+    rows = 0
+    with io.open(path, encoding='utf-8') as elt_file:
+        for elt in iter_elt_chunks(elt_file):
+            for _ in format_elt(elt):
+                pass
+            rows += len(elt)
+    return rows
+
+
+def text_combine(path):
+    rows = 0
+    with io.open(path, encoding='utf-8') as elt_file:
+        for _, chunk_rows in iter_elt_text(elt_file):
+            rows += chunk_rows
+    return rows
+
+
+def best_of(func, path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        rows = func(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        print('{:>14} {:>28} {:>12} {:>14}'.format(
+            'columns', 'path', 'seconds', 'rows/s'))
+        for columns, optional_columns in [('all', True),
+                                          ('EventId,Loss', False)]:
+            write_synthetic_elt(path, args.rows, optional_columns)
+            for name, func in [('csv.DictReader combine', dictreader_combine),
+                               ('numpy parse', numpy_parse),
+                               ('numpy parse + format', numpy_combine),
+                               ('text pass-through', text_combine)]:
+                rows, elapsed = best_of(func, path, args.repeat)
+                print('{:>14} {:>28} {:>12.3f} {:>14,.0f}'.format(
+                    columns, name, elapsed, rows / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,9 @@ with open(path.join(here, 'requirements', 'install.txt'),
             packages = [line[:index_of_semicolon].strip()]
             extras_require[condition] = packages
 
+# Reading YAML job manifests with the analyzere-extras command
+extras_require['yaml'] = ['PyYAML>=3.12']
+
 setup(
     name='analyzerePythonTools',
     version='0.1.5',
@@ -36,10 +39,9 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
 
         'Topic :: Software Development :: Libraries :: Python Modules',
@@ -47,6 +49,12 @@ setup(
     packages=[
         'analyzerePythonTools',
     ],
+    python_requires='>=3.6',
     install_requires=install_requires,
-    extras_require=extras_require
+    extras_require=extras_require,
+    entry_points={
+        'console_scripts': [
+            'analyzere-extras=analyzerePythonTools.cli:main',
+        ],
+    },
 )
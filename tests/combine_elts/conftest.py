@@ -1,6 +1,278 @@
+import gzip
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import analyzere
 import pytest
 
+from analyzere import EventCatalog, LossSet
 from analyzere.base_resources import convert_to_analyzere_object
+from analyzere_extras.elts import read_elt
+
+
+class ELTFileRequestHandler(BaseHTTPRequestHandler):
+    """Serves the files in server.files at /uploads/files/<name>."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        name = self.path.rsplit('/', 1)[-1]
+
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.connections.add(self.client_address)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            truncate = server.truncate > 0
+            if truncate:
+                server.truncate -= 1
+            stall = server.stall > 0
+            if stall:
+                server.stall -= 1
+
+        try:
+            time.sleep(server.delay)
+
+            data = server.files.get(name)
+            if data is None:
+                self.send_error(404)
+                return
+
+            etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+            start, end = 0, len(data) - 1
+            byte_range = self.headers.get('Range')
+            if server.ranges and byte_range and \
+                    self.headers.get('If-Range', etag) == etag:
+                first, last = byte_range[len('bytes='):].split('-')
+                start = int(first)
+                if last:
+                    end = min(int(last), end)
+
+            if byte_range and start <= end and \
+                    (start, end) != (0, len(data) - 1):
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, end, len(data)))
+            else:
+                self.send_response(200)
+            body = data[start:end + 1]
+            if server.compress and body is data and 'gzip' in \
+                    self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(data)
+                etag = '"{}-gzip"'.format(etag.strip('"'))
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            if server.ranges:
+                self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            if truncate or stall:
+                # Promise the whole body but hang up half way through
+                body = body[:len(body) // 2]
+                self.close_connection = True
+            with server.lock:
+                server.bytes_sent += len(body)
+            try:
+                self._write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading
+                self.close_connection = True
+            if stall:
+                # Stop sending for a while before hanging up
+                time.sleep(server.stall_seconds)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _write(self, body):
+        """Writes body, at no more than server.rate bytes per second if it
+        is set.
+        """
+        rate = self.server.rate
+        if not rate:
+            self.wfile.write(body)
+            return
+
+        block_size = 64 * 1024
+        for start in range(0, len(body), block_size):
+            block = body[start:start + block_size]
+            self.wfile.write(block)
+            time.sleep(len(block) / rate)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ELTFileServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server (http.server.ThreadingHTTPServer needs Python
+    3.7).
+    """
+
+    daemon_threads = True
+
+
+@pytest.fixture
+def elt_server(monkeypatch):
+    """A local stand-in for the Analyze Re file server.
+
+    ELT files are served from elt_server.files (name -> bytes). Every request
+    is recorded in elt_server.requests, the client address of each
+    connection in elt_server.connections, the next elt_server.truncate
+    responses are cut short, Range requests are honoured unless
+    elt_server.ranges is False, whole files are gzip compressed for clients
+    that accept it if elt_server.compress is True, the bytes of response
+    bodies are counted in elt_server.bytes_sent, and each response is delayed
+    by elt_server.delay seconds and sent at no more than elt_server.rate
+    bytes per second. The next elt_server.stall responses stop sending half
+    way through for elt_server.stall_seconds.
+    """
+    server = ELTFileServer(('127.0.0.1', 0), ELTFileRequestHandler)
+    server.files = {}
+    server.requests = []
+    server.connections = set()
+    server.truncate = 0
+    server.stall = 0
+    server.stall_seconds = 0
+    server.ranges = True
+    server.compress = False
+    server.bytes_sent = 0
+    server.delay = 0
+    server.rate = None
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.lock = threading.Lock()
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    monkeypatch.setattr(analyzere, 'base_url', 'http://127.0.0.1:{}'.format(
+        server.server_address[1]))
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+class RecombineTestAPI():
+    """Mocked Analyze Re API serving ELTLossSets with versioned data from
+    an elt_server, with helpers for combining them.
+    """
+
+    loss_set_ids = [
+        '3a9f9ad0-0c4b-4a0e-9b0f-6f1e2a3b4c50',
+        '3a9f9ad0-0c4b-4a0e-9b0f-6f1e2a3b4c51',
+        '3a9f9ad0-0c4b-4a0e-9b0f-6f1e2a3b4c52',
+        '3a9f9ad0-0c4b-4a0e-9b0f-6f1e2a3b4c53',
+    ]
+    catalog_id = 'e8b6e4d1-1c0f-4d2e-8a8b-2b6f1f0e9c71'
+
+    def __init__(self, elt_server):
+        self.elt_server = elt_server
+        # LossSet id -> (data version, data file name)
+        self.versions = {}
+        self.uploads = {}
+        self.saved = []
+        self.searches = []
+        # Status of uploaded LossSets once their data has been processed
+        self.upload_status = 'processing_succeeded'
+        self.lock = threading.Lock()
+
+    def retrieve(self, uuid):
+        """Mocked 'LossSet.retrieve()' function."""
+        version, name = self.versions[uuid]
+        return convert_to_analyzere_object({
+            '_type': 'ELTLossSet',
+            'type': 'ELTLossSet',
+            'id': uuid,
+            'modified': 'version {}'.format(version),
+            'data': {'name': name},
+        }, LossSet)
+
+    def retrieve_catalog(self, uuid):
+        """Mocked 'EventCatalog.retrieve()' function."""
+        return convert_to_analyzere_object({
+            'id': uuid,
+            'data': {'name': 'catalog-{}.csv'.format(uuid)},
+        }, EventCatalog)
+
+    def save(self, loss_set):
+        """Mocked 'LossSet.save()' function."""
+        with self.lock:
+            self.saved.append(loss_set)
+            saved = len(self.saved)
+        response = loss_set.to_dict()
+        response['id'] = 'combined-{}'.format(saved)
+        response['status'] = 'processing'
+        loss_set.clear()
+        loss_set.update(convert_to_analyzere_object(response))
+        return loss_set
+
+    def upload_data(self, loss_set, file_like_obj):
+        """Mocked 'LossSet.upload_data()' function."""
+        self.uploads[loss_set.id] = file_like_obj.read()
+        loss_set.status = self.upload_status
+        return loss_set
+
+    def list(self, search=None, offset=0, limit=None):
+        """Mocked 'LossSet.list()' function, which (like the API's full text
+        search, which ignores meta_data) returns the page of saved LossSets
+        whose descriptions contain search.
+        """
+        self.searches.append(search)
+        loss_sets = [loss_set for loss_set in self.saved
+                     if search is None or search in loss_set.description]
+        end = None if limit is None else offset + limit
+        return loss_sets[offset:end]
+
+    def serve(self, loss_set_id, version, elt_response, name=None):
+        """Serves elt_response as version of loss_set_id's data, from the
+        file name (by default '<loss_set_id>-<version>.csv').
+        """
+        if name is None:
+            name = '{}-{}.csv'.format(loss_set_id, version)
+        self.versions[loss_set_id] = version, name
+        self.elt_server.files[name] = \
+            ('\n'.join(elt_response[1]) + '\n').encode('utf-8')
+
+    def combine(self, elt_combiner, loss_set_ids, **kwargs):
+        """Aggregates the ELTs of loss_set_ids with elt_combiner."""
+        return elt_combiner.combine_elts_from_resources(
+            loss_set_ids, self.catalog_id, uuid_type='LossSet',
+            aggregate=True, **kwargs)
+
+    def uploaded_elt(self, combined_loss_set):
+        """Returns the ELT uploaded for combined_loss_set."""
+        return read_elt(self.uploads[combined_loss_set.id].splitlines())
+
+    @staticmethod
+    def assert_same_elt(elt, expected):
+        assert elt['EventId'].tolist() == expected['EventId'].tolist()
+        for name in ['Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE']:
+            assert elt[name].tolist() == pytest.approx(
+                expected[name].tolist())
+
+
+@pytest.fixture
+def recombine_api(elt_server, monkeypatch):
+    """A RecombineTestAPI serving ELTs from elt_server, patched in place of
+    the LossSet and EventCatalog API methods that combines use.
+    """
+    api = RecombineTestAPI(elt_server)
+    monkeypatch.setattr(LossSet, 'retrieve', api.retrieve)
+    monkeypatch.setattr(LossSet, 'list', api.list)
+    monkeypatch.setattr(LossSet, 'save',
+                        lambda loss_set: api.save(loss_set))
+    monkeypatch.setattr(LossSet, 'upload_data',
+                        lambda loss_set, file_like_obj: api.upload_data(
+                            loss_set, file_like_obj))
+    monkeypatch.setattr(EventCatalog, 'retrieve', api.retrieve_catalog)
+    return api
 
 
 @pytest.fixture(scope='session')
@@ -0,0 +1,85 @@
+import csv
+from collections import OrderedDict
+
+import pytest
+from mock import patch
+
+from analyzere_extras import cli
+from analyzere_extras.combine_elts import ELTCombiner
+
+
+class TestReadManifest:
+
+    def test_csv(self, tmpdir):
+        manifest = tmpdir.join('jobs.csv')
+        manifest.write('name, uuid\n'
+                       'east,a\n'
+                       'west,b\n'
+                       'east,c\n')
+
+        assert cli.read_manifest(str(manifest)) == OrderedDict([
+            ('east', ['a', 'c']), ('west', ['b'])])
+
+    def test_csv_without_columns(self, tmpdir):
+        manifest = tmpdir.join('jobs.csv')
+        manifest.write('job,id\neast,a\n')
+
+        with pytest.raises(ValueError) as e:
+            cli.read_manifest(str(manifest))
+        assert "'name' and 'uuid' columns" in str(e.value)
+
+    def test_yaml(self, tmpdir):
+        pytest.importorskip('yaml')
+        manifest = tmpdir.join('jobs.yaml')
+        manifest.write('east: [a, c]\n'
+                       'west:\n'
+                       '  - b\n')
+
+        assert cli.read_manifest(str(manifest)) == OrderedDict([
+            ('east', ['a', 'c']), ('west', ['b'])])
+
+
+class TestCombine:
+
+    def test_partial_failure(self, tmpdir, capsys):
+        manifest = tmpdir.join('jobs.csv')
+        manifest.write('name,uuid\neast,a\nwest,b\n')
+        output = tmpdir.join('results.csv')
+
+        class LossSet:
+            id = 'combined-east'
+
+        def combine_batch(self, jobs, catalog_id, **kwargs):
+            assert list(jobs) == ['east', 'west']
+            assert catalog_id == 'catalog'
+            assert kwargs['upload_concurrency'] == 2
+            assert kwargs['return_exceptions']
+            self._emit('upload_finished', loss_set_id='combined-east',
+                       seconds=1.5, bytes=100)
+            return OrderedDict([('east', LossSet()),
+                                ('west', ValueError('No ELTs found'))])
+
+        with patch.object(ELTCombiner, 'combine_batch', combine_batch):
+            status = cli.main(['combine', str(manifest),
+                               '--catalog-id', 'catalog',
+                               '--upload-concurrency', '2',
+                               '--output', str(output)])
+
+        assert status == 1
+        out, err = capsys.readouterr()
+        assert out.splitlines() == ['east\tcombined-east\t1.500',
+                                    'west\tFAILED\tNo ELTs found']
+        assert '1 of 2 jobs combined' in err
+
+        with output.open() as output_file:
+            assert list(csv.reader(output_file)) == [
+                ['name', 'loss_set_id', 'upload_seconds', 'error'],
+                ['east', 'combined-east', '1.500', ''],
+                ['west', '', '', 'No ELTs found']]
+
+    def test_missing_manifest(self, tmpdir, capsys):
+        status = cli.main(['combine', str(tmpdir.join('missing.csv')),
+                           '--catalog-id', 'catalog'])
+
+        assert status == 1
+        assert 'missing.csv' in capsys.readouterr().err
@@ -0,0 +1,107 @@
+import pytest
+
+from analyzere_extras.combine_elts import ELTCombiner
+from analyzere_extras.elts import read_elt
+
+
+def combine_hash(combined_loss_set):
+    return combined_loss_set.meta_data.analyzere_extras_combine_hash
+
+
+class TestCombineBatch:
+
+    def test_shared_elts_are_downloaded_once(
+            self, elt_server, recombine_api, elt_response_1, elt_response_2,
+            elt_response_3):
+        a, b, c = recombine_api.loss_set_ids[:3]
+        catalog_id = recombine_api.catalog_id
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_2)
+        recombine_api.serve(c, 1, elt_response_3)
+        jobs = {'x': [a, b], 'y': [b, c, b], 'z': [c, 'not-a-uuid']}
+
+        with ELTCombiner() as elt_combiner:
+            results = elt_combiner.combine_batch(
+                jobs, catalog_id, uuid_type='LossSet', aggregate=True,
+                multiplicity='reference', upload_concurrency=2,
+                return_exceptions=True)
+            assert list(results) == ['x', 'y', 'z']
+            assert str(results['z']) == "'not-a-uuid' is not a valid UUID."
+            assert sorted(path for path, _ in elt_server.requests) == \
+                sorted('/uploads/files/{}-1.csv'.format(loss_set_id)
+                       for loss_set_id in (a, b, c))
+            assert results['x'].description == \
+                'analyzere-python-extras: Combined ELT x (combine {})'.format(
+                    combine_hash(results['x'])[:16])
+
+            # Each output is the same as when it is combined on its own
+            for name in ['x', 'y']:
+                expected = elt_combiner.combine_elts_from_resources(
+                    jobs[name], catalog_id, uuid_type='LossSet',
+                    aggregate=True, multiplicity='reference')
+                recombine_api.assert_same_elt(
+                    recombine_api.uploaded_elt(results[name]),
+                    recombine_api.uploaded_elt(expected))
+
+    def test_shared_data_is_downloaded_once(self, elt_server, recombine_api,
+                                            elt_response_1):
+        a, b = recombine_api.loss_set_ids[:2]
+        recombine_api.serve(a, 1, elt_response_1, name='shared.csv')
+        recombine_api.serve(b, 1, elt_response_1, name='shared.csv')
+
+        with ELTCombiner() as elt_combiner:
+            results = elt_combiner.combine_batch(
+                {'x': [a], 'y': [b]}, recombine_api.catalog_id,
+                uuid_type='LossSet')
+
+        assert [path for path, _ in elt_server.requests] == [
+            '/uploads/files/shared.csv']
+        for name in ['x', 'y']:
+            recombine_api.assert_same_elt(
+                recombine_api.uploaded_elt(results[name]),
+                read_elt(elt_response_1[1]))
+
+    def test_invalid_uuids_fail_before_downloading(
+            self, elt_server, recombine_api, elt_response_1):
+        a = recombine_api.loss_set_ids[0]
+        recombine_api.serve(a, 1, elt_response_1)
+
+        with ELTCombiner() as elt_combiner:
+            with pytest.raises(ValueError) as value_error:
+                elt_combiner.combine_batch(
+                    {'x': [a], 'y': ['not-a-uuid']},
+                    recombine_api.catalog_id, uuid_type='LossSet')
+
+        assert str(value_error.value) == "'not-a-uuid' is not a valid UUID."
+        assert elt_server.requests == []
+
+    def test_identical_outputs_are_reused(self, elt_server, recombine_api,
+                                          elt_response_1, elt_response_2):
+        a, b = recombine_api.loss_set_ids[:2]
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_2)
+
+        with ELTCombiner() as elt_combiner:
+            first = elt_combiner.combine_batch(
+                {'x': [a], 'y': [a, b]}, recombine_api.catalog_id)
+            elt_server.requests = []
+            second = elt_combiner.combine_batch(
+                {'y': [b, a], 'z': [b]}, recombine_api.catalog_id,
+                reuse=True)
+
+        assert second['y'] is first['y']
+        assert [path for path, _ in elt_server.requests] == [
+            '/uploads/files/{}-1.csv'.format(b)]
+
+    def test_description_with_other_braces(self, recombine_api,
+                                           elt_response_1):
+        a = recombine_api.loss_set_ids[0]
+        recombine_api.serve(a, 1, elt_response_1)
+
+        with ELTCombiner() as elt_combiner:
+            results = elt_combiner.combine_batch(
+                {'x': [a]}, recombine_api.catalog_id,
+                description='{name} {0} {other} {')
+
+        assert results['x'].description == \
+            'x {0} {other} { (combine ' + combine_hash(results['x'])[:16] + ')'
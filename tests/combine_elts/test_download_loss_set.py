@@ -0,0 +1,321 @@
+import gc
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from mock import patch
+
+from analyzere import LossSet
+from analyzere.base_resources import convert_to_analyzere_object
+from analyzere_extras.combine_elts import ELTCombiner
+from analyzere_extras.elts import open_elt_file, read_elt
+
+
+class RecordingProcessPool(ProcessPoolExecutor):
+    """ProcessPoolExecutor that records how many pools are started and the
+    functions submitted to them.
+    """
+
+    started = 0
+    submitted = []
+
+    def __init__(self, *args, **kwargs):
+        RecordingProcessPool.started += 1
+        super(RecordingProcessPool, self).__init__(*args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        RecordingProcessPool.submitted.append(fn.__name__)
+        return super(RecordingProcessPool, self).submit(fn, *args, **kwargs)
+
+
+def make_loss_set(loss_set_id):
+    return convert_to_analyzere_object({
+        '_type': 'ELTLossSet',
+        'id': loss_set_id,
+        'modified': '2019-03-09T18:38:04.801820Z',
+        'data': {'name': '{}.csv'.format(loss_set_id)},
+    }, LossSet)
+
+
+def elt_data(elt_response):
+    return ('\n'.join(elt_response[1]) + '\n').encode('utf-8')
+
+
+def download(elt_combiner, loss_set_ids):
+    for loss_set_id in loss_set_ids:
+        elt_combiner._loss_sets[loss_set_id] = make_loss_set(loss_set_id)
+    elt_combiner._event_loop.run(elt_combiner._download_elts(loss_set_ids))
+
+
+class TestDownloadLossSet:
+
+    loss_set_id = 'c054b33f-45df-4007-94f1-13d24935524d'
+
+    def test_download_is_spooled_to_disk(self, tmpdir, elt_server,
+                                         elt_response_1):
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = \
+            elt_data(elt_response_1)
+
+        with ELTCombiner() as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, [self.loss_set_id])
+
+        elt_path = elt_combiner._downloaded_elts[self.loss_set_id]
+        assert elt_path == str(tmpdir.join(
+            '{}.csv'.format(self.loss_set_id)))
+        with open(elt_path, 'rb') as elt_file:
+            assert elt_file.read() == elt_data(elt_response_1)
+
+        assert [path for path, _ in elt_server.requests] == [
+            '/uploads/files/{}.csv'.format(self.loss_set_id)]
+
+    def test_download_is_cached(self, tmpdir, elt_server, elt_response_1):
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = \
+            elt_data(elt_response_1)
+
+        cache_dir = str(tmpdir.join('cache'))
+        requests_made = []
+        for spool in ['spool1', 'spool2']:
+            elt_server.requests = []
+            with ELTCombiner(cache_dir=cache_dir) as elt_combiner:
+                elt_combiner._spool = str(tmpdir.mkdir(spool))
+                download(elt_combiner, [self.loss_set_id])
+
+            # The ELT is cached parsed, and the downloaded CSV is removed
+            elt_path = elt_combiner._downloaded_elts[self.loss_set_id]
+            assert elt_path.startswith(cache_dir)
+            assert open_elt_file(elt_path).tolist() == \
+                read_elt(elt_response_1[1]).tolist()
+            assert os.listdir(elt_combiner._spool) == []
+
+            requests_made.append(len(elt_server.requests))
+            spans = elt_combiner.report.spans
+
+        # The second combiner is served from the cache
+        assert requests_made == [1, 0]
+        assert [span.name for span in spans] == ['download_elt']
+        assert spans[0].attributes == {
+            'elt_id': self.loss_set_id, 'bytes': 0, 'cached': True}
+
+    def test_download_is_cached_in_processes(self, tmpdir, elt_server,
+                                             elt_response_1):
+        loss_set_ids = ['loss-set-{}'.format(i) for i in range(3)]
+        for loss_set_id in loss_set_ids:
+            elt_server.files['{}.csv'.format(loss_set_id)] = \
+                elt_data(elt_response_1)
+        RecordingProcessPool.started = 0
+        RecordingProcessPool.submitted = []
+
+        with patch('analyzere_extras.combine_elts.ProcessPoolExecutor',
+                   RecordingProcessPool):
+            with ELTCombiner(cache_dir=str(tmpdir.join('cache')),
+                             parse_processes=2) as elt_combiner:
+                elt_combiner._spool = str(tmpdir.mkdir('spool'))
+                download(elt_combiner, loss_set_ids)
+
+                assert RecordingProcessPool.started == 1
+                assert RecordingProcessPool.submitted == \
+                    ['convert_elt_csv'] * 3
+                assert elt_combiner._convert_pool is None
+                for loss_set_id in loss_set_ids:
+                    assert open_elt_file(
+                        elt_combiner._downloaded_elts[loss_set_id]
+                    ).tolist() == read_elt(elt_response_1[1]).tolist()
+
+                # No pool is started when every ELT is already cached
+                download(elt_combiner, loss_set_ids)
+
+        assert RecordingProcessPool.started == 1
+
+    def test_download_is_reported(self, tmpdir, elt_server, elt_response_1):
+        data = elt_data(elt_response_1)
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = data
+
+        with ELTCombiner(cache_dir=str(tmpdir.join('cache'))) as \
+                elt_combiner:
+            elt_combiner._spool = str(tmpdir.mkdir('spool'))
+            download(elt_combiner, [self.loss_set_id])
+
+        # The ELT is parsed into the cache as part of its download
+        cache_elt, download_elt = elt_combiner.report.spans
+        assert cache_elt.name == 'cache_elt'
+        assert cache_elt.attributes == {
+            'elt_id': self.loss_set_id, 'rows': len(elt_response_1[1]) - 1}
+        assert download_elt.name == 'download_elt'
+        assert download_elt.attributes == {
+            'elt_id': self.loss_set_id, 'bytes': len(data), 'cached': False}
+        assert cache_elt.seconds <= download_elt.seconds
+
+    def test_truncated_download_is_resumed(self, tmpdir, elt_server,
+                                           elt_response_1):
+        data = elt_data(elt_response_1)
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = data
+        elt_server.truncate = 2
+
+        with ELTCombiner() as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, [self.loss_set_id])
+
+        with open(elt_combiner._downloaded_elts[self.loss_set_id],
+                  'rb') as elt_file:
+            assert elt_file.read() == data
+
+        # Each retry asks only for the bytes not yet received
+        received = len(data) // 2
+        received += (len(data) - received) // 2
+        assert [headers.get('Range') for _, headers in
+                elt_server.requests] == [
+            None,
+            'bytes={}-'.format(len(data) // 2),
+            'bytes={}-'.format(received),
+        ]
+        assert elt_server.requests[1][1]['If-Range'].startswith('"')
+
+    def test_truncated_download_restarts_without_ranges(
+            self, tmpdir, elt_server, elt_response_1):
+        data = elt_data(elt_response_1)
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = data
+        elt_server.truncate = 1
+        elt_server.ranges = False
+
+        with ELTCombiner() as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, [self.loss_set_id])
+
+        with open(elt_combiner._downloaded_elts[self.loss_set_id],
+                  'rb') as elt_file:
+            assert elt_file.read() == data
+        assert len(elt_server.requests) == 2
+
+    def test_truncated_downloads_give_up(self, tmpdir, elt_server,
+                                         elt_response_1):
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = \
+            elt_data(elt_response_1)
+        elt_server.truncate = 3
+
+        cache_dir = str(tmpdir.join('cache'))
+        with ELTCombiner(cache_dir=cache_dir) as elt_combiner:
+            elt_combiner._spool = str(tmpdir.mkdir('spool'))
+            with pytest.raises(RuntimeError) as runtime_error:
+                download(elt_combiner, [self.loss_set_id])
+
+        assert str(runtime_error.value) == \
+            '3 IncompleteRead errors received for LossSet {}'.format(
+                self.loss_set_id)
+        # No partial download is left in the cache
+        assert os.listdir(cache_dir) == []
+
+    def test_download_concurrency(self, tmpdir, elt_server, elt_response_1):
+        loss_set_ids = ['loss-set-{}'.format(i) for i in range(12)]
+        for loss_set_id in loss_set_ids:
+            elt_server.files['{}.csv'.format(loss_set_id)] = \
+                elt_data(elt_response_1)
+        elt_server.delay = 0.05
+
+        with ELTCombiner(download_concurrency=3) as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, loss_set_ids)
+
+        assert sorted(elt_combiner._downloaded_elts) == sorted(loss_set_ids)
+        assert len(elt_server.requests) == len(loss_set_ids)
+        assert 1 < elt_server.max_in_flight <= 3
+
+    def test_connections_are_reused(self, tmpdir, elt_server,
+                                    elt_response_1):
+        loss_set_ids = ['loss-set-{}'.format(i) for i in range(10)]
+        for loss_set_id in loss_set_ids:
+            elt_server.files['{}.csv'.format(loss_set_id)] = \
+                elt_data(elt_response_1)
+
+        with ELTCombiner(download_concurrency=2) as elt_combiner:
+            # Two combines share the combiner's connection pool
+            for half in (loss_set_ids[:5], loss_set_ids[5:]):
+                elt_combiner._spool = str(tmpdir)
+                download(elt_combiner, half)
+
+        assert elt_combiner._session is None
+        assert len(elt_server.requests) == len(loss_set_ids)
+        assert len(elt_server.connections) <= 2
+
+    def test_unclosed_combiner_is_closed(self, tmpdir, elt_server,
+                                         elt_response_1):
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = \
+            elt_data(elt_response_1)
+
+        elt_combiner = ELTCombiner()
+        elt_combiner._spool = str(tmpdir)
+        download(elt_combiner, [self.loss_set_id])
+        session = elt_combiner._session
+        thread = elt_combiner._event_loop._thread
+        assert thread.is_alive()
+
+        del elt_combiner
+        gc.collect()
+
+        assert session.closed
+        assert not thread.is_alive()
+
+    def test_compressed_download(self, tmpdir, elt_server, elt_response_1):
+        data = elt_data(elt_response_1) * 50
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = data
+        elt_server.compress = True
+
+        with ELTCombiner() as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, [self.loss_set_id])
+
+        # The ELT is stored uncompressed
+        with open(elt_combiner._downloaded_elts[self.loss_set_id],
+                  'rb') as elt_file:
+            assert elt_file.read() == data
+        assert elt_server.requests[0][1]['Accept-Encoding'] == \
+            'gzip, deflate'
+        assert elt_server.bytes_sent < len(data) / 5
+
+    def test_compressed_download_is_resumed(self, tmpdir, elt_server,
+                                            elt_response_1):
+        data = elt_data(elt_response_1) * 50
+        elt_server.files['{}.csv'.format(self.loss_set_id)] = data
+        elt_server.compress = True
+        elt_server.truncate = 1
+
+        with ELTCombiner() as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, [self.loss_set_id])
+
+        with open(elt_combiner._downloaded_elts[self.loss_set_id],
+                  'rb') as elt_file:
+            assert elt_file.read() == data
+
+        # The rest of the file is requested uncompressed
+        headers = elt_server.requests[1][1]
+        assert headers['Accept-Encoding'] == 'identity'
+        assert headers['Range'].startswith('bytes=')
+
+    def test_download_events(self, tmpdir, elt_server, elt_response_1):
+        loss_set_ids = ['loss-set-{}'.format(i) for i in range(3)]
+        data = elt_data(elt_response_1)
+        for loss_set_id in loss_set_ids:
+            elt_server.files['{}.csv'.format(loss_set_id)] = data
+
+        events = queue.Queue()
+        with ELTCombiner(on_event=events) as elt_combiner:
+            elt_combiner._spool = str(tmpdir)
+            download(elt_combiner, loss_set_ids)
+
+        events = [events.get_nowait() for _ in range(events.qsize())]
+        started = [event.attributes['elt_id'] for event in events
+                   if event.name == 'download_started']
+        finished = [event for event in events
+                    if event.name == 'download_finished']
+        assert sorted(started) == loss_set_ids
+        assert sorted(event.attributes['elt_id'] for event in finished) == \
+            loss_set_ids
+        assert [event.attributes['downloaded'] for event in finished] == \
+            [1, 2, 3]
+        for event in finished:
+            assert event.attributes['total'] == 3
+            assert event.attributes['bytes'] == len(data)
+            assert event.attributes['seconds'] >= 0
+            assert not event.attributes['cached']
@@ -0,0 +1,134 @@
+import os
+import time
+
+import aiohttp
+import analyzere
+
+from analyzere_extras.downloads import (
+    EventLoopThread,
+    download_file,
+    download_timeout,
+)
+
+
+def download(path, segments, segment_threshold=1024, timeout=None):
+    url = '{}/uploads/files/large.csv'.format(analyzere.base_url)
+
+    async def run():
+        async with aiohttp.ClientSession(
+                timeout=timeout or download_timeout()) as session:
+            return await download_file(session, url, path,
+                                       chunk_size=16 * 1024,
+                                       segments=segments,
+                                       segment_threshold=segment_threshold)
+
+    event_loop = EventLoopThread()
+    try:
+        return event_loop.run(run())
+    finally:
+        event_loop.close()
+
+
+def large_elt(rows):
+    return b'EventId,Loss\n' + b''.join(
+        '{},{}.5\n'.format(i, i * 7).encode('utf-8') for i in range(rows))
+
+
+class TestSegmentedDownload:
+
+    def test_segments_are_reassembled(self, tmpdir, elt_server):
+        data = large_elt(10001)
+        elt_server.files['large.csv'] = data
+        path = str(tmpdir.join('large.csv'))
+
+        assert download(path, segments=4) == len(data)
+
+        with open(path, 'rb') as elt_file:
+            assert elt_file.read() == data
+        ranges = sorted(headers.get('Range', '')
+                        for _, headers in elt_server.requests)
+        assert len(ranges) == 4
+        assert ranges[0] == ''
+        assert all(byte_range.startswith('bytes=')
+                   for byte_range in ranges[1:])
+
+    def test_truncated_segments_are_resumed(self, tmpdir, elt_server):
+        data = large_elt(10001)
+        elt_server.files['large.csv'] = data
+        # The first response and one of the ranges are cut short
+        elt_server.truncate = 2
+        path = str(tmpdir.join('large.csv'))
+
+        download(path, segments=4)
+
+        with open(path, 'rb') as elt_file:
+            assert elt_file.read() == data
+        assert len(elt_server.requests) == 5
+
+    def test_small_files_are_not_segmented(self, tmpdir, elt_server):
+        data = large_elt(100)
+        elt_server.files['large.csv'] = data
+        path = str(tmpdir.join('large.csv'))
+
+        download(path, segments=4, segment_threshold=len(data) + 1)
+
+        with open(path, 'rb') as elt_file:
+            assert elt_file.read() == data
+        assert len(elt_server.requests) == 1
+
+    def test_unranged_server_is_not_segmented(self, tmpdir, elt_server):
+        data = large_elt(10001)
+        elt_server.files['large.csv'] = data
+        elt_server.ranges = False
+        path = str(tmpdir.join('large.csv'))
+
+        download(path, segments=4)
+
+        with open(path, 'rb') as elt_file:
+            assert elt_file.read() == data
+        assert len(elt_server.requests) == 1
+
+    def test_throughput_scales_with_connections(self, tmpdir, elt_server):
+        data = os.urandom(1024 * 1024)
+        elt_server.files['large.csv'] = data
+        # Each connection is limited to 2 MiB/s
+        elt_server.rate = 2 * 1024 * 1024
+        path = str(tmpdir.join('large.csv'))
+
+        durations = {}
+        for segments in (1, 4):
+            start = time.time()
+            download(path, segments=segments)
+            durations[segments] = time.time() - start
+
+            with open(path, 'rb') as elt_file:
+                assert elt_file.read() == data
+
+        # 0.5s over one connection, about 0.125s over four
+        assert durations[4] < durations[1] / 2
+
+
+class TestDownloadTimeouts:
+
+    def test_downloads_have_no_total_timeout(self):
+        timeout = download_timeout()
+        assert timeout.total is None
+        assert timeout.sock_read > 0
+
+    def test_stalled_download_is_resumed(self, tmpdir, elt_server):
+        data = large_elt(1001)
+        elt_server.files['large.csv'] = data
+        elt_server.stall = 1
+        elt_server.stall_seconds = 2
+        path = str(tmpdir.join('large.csv'))
+
+        start = time.time()
+        assert download(path, segments=1, timeout=aiohttp.ClientTimeout(
+            total=None, sock_read=0.2)) == len(data)
+
+        # The stalled response is abandoned rather than waited for
+        assert time.time() - start < 2
+        with open(path, 'rb') as elt_file:
+            assert elt_file.read() == data
+        assert len(elt_server.requests) == 2
+        assert elt_server.requests[1][1]['Range'].startswith('bytes=')
@@ -0,0 +1,122 @@
+import os
+import time
+
+import numpy as np
+
+from analyzere import LossSet
+from analyzere.base_resources import convert_to_analyzere_object
+from analyzere_extras.elt_cache import ELTCache
+from analyzere_extras.elts import AGGREGATE_DTYPE
+
+
+def make_loss_set(uuid, modified,
+                  ref_id='a7a5ff0b-4a54-4a4c-9b43-3e9b2b6c6a9e'):
+    return convert_to_analyzere_object({
+        '_type': 'ELTLossSet',
+        'id': uuid,
+        'modified': modified,
+        'data': {'ref_id': ref_id},
+    }, LossSet)
+
+
+def make_elt(tmpdir, name, size):
+    elt_file = tmpdir.join(name)
+    elt_file.write('x' * size)
+    return str(elt_file)
+
+
+class TestELTCache:
+
+    loss_set_id = 'c054b33f-45df-4007-94f1-13d24935524d'
+
+    def test_key_changes_with_version(self):
+        key = ELTCache.key(make_loss_set(
+            self.loss_set_id, '2019-03-09T18:38:04.801820Z'))
+
+        assert key.startswith(self.loss_set_id + '-')
+        assert key == ELTCache.key(make_loss_set(
+            self.loss_set_id, '2019-03-09T18:38:04.801820Z'))
+        assert key != ELTCache.key(make_loss_set(
+            self.loss_set_id, '2019-03-10T09:00:00.000000Z'))
+        assert key != ELTCache.key(make_loss_set(
+            self.loss_set_id, '2019-03-09T18:38:04.801820Z',
+            ref_id='0b4a9a3e-1c51-4d5e-8a3b-5d5a8e1f6c2b'))
+
+    def test_get_and_put(self, tmpdir):
+        cache = ELTCache(str(tmpdir.join('cache')))
+        key = ELTCache.key(make_loss_set(self.loss_set_id, 'v1'))
+
+        assert cache.get(key) is None
+
+        elt_path = make_elt(tmpdir, 'download.csv', 10)
+        cached_path = cache.put(key, elt_path)
+
+        assert not os.path.exists(elt_path)
+        assert cache.get(key) == cached_path
+        assert cache.size() == 10
+
+    def test_put_replaces_other_versions(self, tmpdir):
+        cache = ELTCache(str(tmpdir.join('cache')))
+        old_key = ELTCache.key(make_loss_set(self.loss_set_id, 'v1'))
+        new_key = ELTCache.key(make_loss_set(self.loss_set_id, 'v2'))
+
+        cache.put(old_key, make_elt(tmpdir, 'old.csv', 10))
+        cache.put(new_key, make_elt(tmpdir, 'new.csv', 20))
+
+        assert cache.get(old_key) is None
+        assert cache.get(new_key) is not None
+        assert cache.size() == 20
+
+    def test_evict_least_recently_used(self, tmpdir):
+        cache = ELTCache(str(tmpdir.join('cache')), max_bytes=25)
+        keys = ['{}-0'.format(uuid) for uuid in [
+            '97fcab1e-1afd-40ca-b439-5b0bab3cd576',
+            'c48bcda4-8ba5-4366-9c95-1904beb0d19e',
+            '5489f16a-dbcf-42e6-a5c6-3b0ea05b293a']]
+
+        now = time.time()
+        for age, key in zip([30, 20, 10], keys):
+            path = cache.put(key, make_elt(tmpdir, key, 10))
+            os.utime(path, (now - age, now - age))
+
+        # Using the oldest entry makes the second one least recently used
+        assert cache.get(keys[0]) is not None
+        cache.evict()
+
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) is not None
+        assert cache.size() == 20
+
+    def test_get_and_put_combined(self, tmpdir):
+        cache = ELTCache(str(tmpdir))
+        assert cache.get_combined('combined-1') is None
+
+        state = np.zeros(2, dtype=AGGREGATE_DTYPE)
+        state['EventId'] = [3, 7]
+        state['Loss'] = [1.5, 2.5]
+        state['Rows'] = [1, 2]
+        manifest = {'sources': {'a': {'version': 'a-1', 'multiplicity': 1}}}
+        cache.put_combined('combined-1', manifest, state)
+
+        assert cache.get_combined('combined-1')[0] == manifest
+        assert cache.get_combined('combined-1')[1].tolist() == state.tolist()
+        # Combined states are evicted like cached ELTs
+        assert cache.size() == os.path.getsize(
+            cache.combined_path('combined-1'))
+
+    def test_get_and_put_event_ids(self, tmpdir):
+        cache = ELTCache(str(tmpdir))
+        catalog_id = 'e8b6e4d1-1c0f-4d2e-8a8b-2b6f1f0e9c71'
+        keys = ['{}-1'.format(catalog_id), '{}-2'.format(catalog_id)]
+        assert cache.get_event_ids(keys[0]) is None
+
+        cache.put_event_ids(keys[0], np.array([3, 7], dtype=np.int64))
+        assert cache.get_event_ids(keys[0]).tolist() == [3, 7]
+
+        # A new version of the catalog replaces the old one
+        cache.put_event_ids(keys[1], np.array([3, 8], dtype=np.int64))
+        assert cache.get_event_ids(keys[0]) is None
+        assert cache.get_event_ids(keys[1]).tolist() == [3, 8]
+        assert cache.size() == os.path.getsize(
+            cache.event_ids_path(keys[1]))
@@ -0,0 +1,415 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from analyzere_extras.elts import (
+    ELT_DTYPE,
+    ELTAggregator,
+    ELTMerger,
+    convert_elt_csv,
+    filter_elt,
+    format_elt,
+    iter_elt_chunks,
+    iter_elt_text,
+    open_elt_file,
+    parse_elt_files,
+    read_elt,
+    read_event_ids,
+    write_elt_file,
+)
+
+
+class TestReadELT:
+
+    def test_default_columns(self, elt_response_1):
+        elt = read_elt(elt_response_1[1])
+
+        assert elt.dtype == ELT_DTYPE
+        assert elt['EventId'].tolist() == [1000, 1001, 1003]
+        assert elt['Loss'].tolist() == [10.5, 400.0, 200.0]
+        assert elt['STDDEVI'].tolist() == [0.0, 0.0, 0.0]
+        assert elt['STDDEVC'].tolist() == [0.0, 0.0, 0.0]
+        assert elt['EXPVALUE'].tolist() == elt['Loss'].tolist()
+
+    def test_additional_columns(self, elt_response_additional_columns_1):
+        elt = read_elt(elt_response_additional_columns_1[1])
+
+        assert elt.tolist() == [
+            (2, 100.5, 4.0, 5.7, 99.0),
+            (1, 40.0, 0.0, 0.0, 0.0),
+            (3000, 23300.0, 4.0, 5.0, 234.0),
+        ]
+
+    def test_event_id_column_name(self, elt_response_EventID):
+        elt = read_elt(elt_response_EventID[1])
+        assert elt['EventId'].tolist() == [6454, 6201]
+
+    def test_column_order_and_unknown_columns(self):
+        elt = read_elt(io.StringIO(
+            u'Region,EXPVALUE,Loss,EventId\r\n'
+            u'US,1.5,2.5,7\r\n'
+            u'\r\n'))
+
+        assert elt.tolist() == [(7, 2.5, 0.0, 0.0, 1.5)]
+
+    def test_missing_loss_column(self):
+        with pytest.raises(ValueError) as value_error:
+            read_elt(['EventId,Mean', '1,2.0'])
+
+        assert str(value_error.value) == \
+            "ELT header 'EventId,Mean' has no Loss column."
+
+    def test_header_only(self):
+        assert len(read_elt(['EventId,Loss'])) == 0
+        assert len(read_elt([])) == 0
+
+    def test_empty_optional_fields(self):
+        elt = read_elt(['EventId,Loss,STDDEVI,STDDEVC,EXPVALUE',
+                        '1,10.5,,,', '2,3.0,1.0,,'])
+
+        assert elt.tolist() == [(1, 10.5, 0.0, 0.0, 10.5),
+                                (2, 3.0, 1.0, 0.0, 3.0)]
+
+    def test_quoted_fields(self):
+        elt = read_elt(['"EventId","Loss"', '"1","10.5"'])
+
+        assert elt.tolist() == [(1, 10.5, 0.0, 0.0, 10.5)]
+
+    def test_event_ids_are_exact(self):
+        elt = read_elt(['EventId,Loss', '9007199254740993,1.0'])
+
+        assert elt['EventId'].tolist() == [9007199254740993]
+
+    def test_non_integer_event_id(self):
+        with pytest.raises(ValueError) as value_error:
+            read_elt(['EventId,Loss', '1,2.0', '1.7,2.0'])
+
+        assert str(value_error.value) == \
+            "ELT row '1.7,2.0' has EventId '1.7', which is not an integer."
+
+    def test_chunks(self, elt_response_3):
+        chunks = list(iter_elt_chunks(elt_response_3[1], chunk_rows=3))
+
+        assert [len(chunk) for chunk in chunks] == [3, 1]
+        assert np.concatenate(chunks).tolist() == \
+            read_elt(elt_response_3[1]).tolist()
+
+
+class TestParseELTFiles:
+
+    def test_parse_in_processes(self, tmpdir, elt_response_dict):
+        elt_paths = []
+        for name, elt_response in sorted(elt_response_dict.items()):
+            elt_file = tmpdir.join('{}.csv'.format(name))
+            elt_file.write('\n'.join(elt_response[1]) + '\n')
+            elt_paths.append(str(elt_file))
+
+        elts = list(parse_elt_files(elt_paths, processes=2))
+
+        assert len(elts) == len(elt_paths)
+        for elt_path, elt in zip(elt_paths, elts):
+            with io.open(elt_path, encoding='utf-8') as elt_file:
+                assert elt.tolist() == read_elt(elt_file).tolist()
+
+    def test_stop_early(self, tmpdir, elt_response_1):
+        elt_file = tmpdir.join('elt.csv')
+        elt_file.write('\n'.join(elt_response_1[1]) + '\n')
+
+        elts = parse_elt_files([str(elt_file)] * 10, processes=2)
+        assert len(next(elts)) == 3
+        # Closing frees the files that were parsed ahead
+        elts.close()
+
+
+class TestELTFile:
+
+    def test_round_trip(self, tmpdir, elt_response_additional_columns_1):
+        elt = read_elt(elt_response_additional_columns_1[1])
+        path = str(tmpdir.join('elt.elt'))
+        write_elt_file([elt[:1], elt[1:]], path)
+
+        mapped = open_elt_file(path)
+        assert isinstance(mapped, np.memmap)
+        assert mapped.tolist() == elt.tolist()
+        # 8 bytes for each of the 5 columns, with no header
+        assert os.path.getsize(path) == 40 * len(elt)
+
+    def test_convert_csv(self, tmpdir, elt_response_EventID):
+        csv_file = tmpdir.join('elt.csv')
+        csv_file.write('\n'.join(elt_response_EventID[1]) + '\n')
+        path = str(tmpdir.join('elt.elt'))
+
+        convert_elt_csv(str(csv_file), path)
+
+        assert open_elt_file(path).tolist() == \
+            read_elt(elt_response_EventID[1]).tolist()
+
+    def test_empty(self, tmpdir):
+        path = str(tmpdir.join('elt.elt'))
+        write_elt_file([], path)
+        assert len(open_elt_file(path)) == 0
+
+
+class TestEventIds:
+
+    def test_read_event_ids(self):
+        catalog = ['Rate,EventID,Region', '0.1,7,EU', '0.2,3,US', '',
+                   '0.1,7,EU', '0.3,12,JP']
+        event_ids = read_event_ids(catalog, chunk_rows=2)
+
+        assert event_ids.dtype == np.int64
+        assert event_ids.tolist() == [3, 7, 12]
+
+    def test_missing_event_column(self):
+        with pytest.raises(ValueError) as value_error:
+            read_event_ids(['Rate,Region', '0.1,EU'])
+        assert str(value_error.value) == \
+            "Event catalog header 'Rate,Region' has no EventID column."
+
+    def test_filter_elt(self, elt_response_3):
+        elt = read_elt(elt_response_3[1])
+        event_ids = np.array([1, 3000, 3002, 10 ** 9], dtype=np.int64)
+
+        filtered = filter_elt(elt, event_ids)
+        assert filtered.tolist() == [
+            record for record in elt.tolist()
+            if record[0] in (3000, 3002)]
+
+        # Nothing is copied when every event is in the catalog
+        assert filter_elt(elt, np.unique(elt['EventId'])) is elt
+        assert len(filter_elt(elt, np.empty(0, dtype=np.int64))) == 0
+
+
+class TestELTText:
+
+    def test_rows_in_order_are_copied(self):
+        lines = ['EventId,Loss,STDDEVI,STDDEVC,EXPVALUE\r\n',
+                 '02,0.1234567890123456789,0,0,1e3\r\n', '\r\n',
+                 '3,4.50,1,2,3\r\n']
+
+        assert list(iter_elt_text(lines)) == [
+            ('02,0.1234567890123456789,0,0,1e3\n3,4.50,1,2,3\n', 2)]
+
+    def test_columns_are_reordered(self):
+        lines = ['Region,Loss,EventID', 'US,"2.50",7', 'EU,1,8']
+
+        assert list(iter_elt_text(lines, chunk_rows=1)) == [
+            ('7,2.50,0.0,0.0,2.50\n', 1), ('8,1,0.0,0.0,1\n', 1)]
+
+    def test_columns_present_are_kept(self):
+        lines = ['EXPVALUE,EventId,Loss,STDDEVC', '4.5,1,2,3', '0,2,1e3,0']
+
+        assert list(iter_elt_text(lines)) == [
+            ('1,2,0.0,3,4.5\n2,1e3,0.0,0,0\n', 2)]
+
+    def test_rows_with_the_wrong_number_of_fields(self):
+        lines = ['EventId,Loss,STDDEVI,STDDEVC,EXPVALUE', '1,2,3,4',
+                 '5,6,7,8,9,10']
+
+        assert list(iter_elt_text(lines)) == [
+            ('1,2,3,4,2\n5,6,7,8,9\n', 2)]
+
+    def test_empty_optional_fields_are_filled_in(self):
+        lines = ['EventId,Loss,STDDEVI,STDDEVC,EXPVALUE', '1,10.5,,,',
+                 '2,3,1,2,3']
+
+        assert list(iter_elt_text(lines)) == [
+            ('1,10.5,0.0,0.0,10.5\n2,3,1,2,3\n', 2)]
+
+    def test_short_rows_are_filled_in(self):
+        lines = ['EventId,Loss,STDDEVI,STDDEVC,EXPVALUE', '1,10.5',
+                 '2,3,1,2,3', '3, 4 ,1,2,']
+
+        assert list(iter_elt_text(lines)) == [
+            ('1,10.5,0.0,0.0,10.5\n2,3,1,2,3\n3,4,1,2,4\n', 3)]
+
+
+class TestFormatELT:
+
+    def test_round_trip(self, elt_response_additional_columns_3):
+        elt = read_elt(elt_response_additional_columns_3[1])
+        text = ''.join(format_elt(elt, chunk_rows=3))
+
+        assert text.splitlines()[0] == '3000,105.5,0.0,0.0,0.0'
+        assert read_elt(['EventId,Loss,STDDEVI,STDDEVC,EXPVALUE'] +
+                        text.splitlines()).tolist() == elt.tolist()
+
+    def test_values_are_not_rounded(self):
+        elt = read_elt(['EventId,Loss', '9007199254740993,0.1234567890123456'])
+        text = ''.join(format_elt(elt))
+
+        assert text == ('9007199254740993,0.1234567890123456,0.0,0.0,'
+                        '0.1234567890123456\n')
+
+
+class TestELTAggregator:
+
+    def test_sums_by_event(self, elt_response_additional_columns_1,
+                           elt_response_additional_columns_3):
+        aggregator = ELTAggregator()
+        aggregator.add(read_elt(elt_response_additional_columns_1[1]))
+        aggregator.add(read_elt(elt_response_additional_columns_3[1]))
+        combined = aggregator.result()
+
+        assert combined['EventId'].tolist() == [1, 2, 1420, 3000, 11420]
+        assert combined['Loss'].tolist() == pytest.approx(
+            [40.0, 3250.5, 120.0, 23405.5, 30400.1])
+        assert combined['STDDEVC'].tolist() == pytest.approx(
+            [0.0, 13.7, 1.0, 5.0, 0.4])
+        assert combined['EXPVALUE'].tolist() == pytest.approx(
+            [0.0, 121.0, 1.0, 234.0, 0.3])
+        # Independent standard deviations add in quadrature
+        assert combined['STDDEVI'].tolist() == pytest.approx(
+            [0.0, np.sqrt(4 ** 2 + 0.9 ** 2), 1.0, 4.0, 0.5])
+
+    def test_batches(self, elt_response_1, elt_response_2, elt_response_3):
+        batched = ELTAggregator(batch_rows=1)
+        unbatched = ELTAggregator()
+        for elt_response in [elt_response_1, elt_response_2, elt_response_3]:
+            for elt in iter_elt_chunks(elt_response[1], chunk_rows=2):
+                batched.add(elt)
+                unbatched.add(elt)
+
+        assert batched.result().tolist() == unbatched.result().tolist()
+        assert batched.result()['EventId'].tolist() == [
+            1000, 1001, 1003, 2100, 3000, 3002]
+
+    def test_multiplicity(self, elt_response_additional_columns_2):
+        elt = read_elt(elt_response_additional_columns_2[1])
+
+        repeated = ELTAggregator()
+        for _ in range(3):
+            repeated.add(elt)
+        multiplied = ELTAggregator()
+        multiplied.add(elt, multiplicity=3)
+
+        assert multiplied.result()['EventId'].tolist() == [3, 1000]
+        for name in ['Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE']:
+            assert multiplied.result()[name].tolist() == pytest.approx(
+                repeated.result()[name].tolist())
+
+    def test_remove_and_continue(self, elt_response_additional_columns_1,
+                                 elt_response_additional_columns_2,
+                                 elt_response_additional_columns_3):
+        elt_1 = read_elt(elt_response_additional_columns_1[1])
+        elt_2 = read_elt(elt_response_additional_columns_2[1])
+        elt_3 = read_elt(elt_response_additional_columns_3[1])
+
+        previous = ELTAggregator()
+        previous.add(elt_1)
+        previous.add(elt_2, multiplicity=2)
+
+        continued = ELTAggregator(state=previous.state())
+        continued.add(elt_2, multiplicity=-2)
+        continued.add(elt_3)
+
+        expected = ELTAggregator()
+        expected.add(elt_1)
+        expected.add(elt_3)
+
+        # Events only in elt_2 are dropped
+        assert continued.result()['EventId'].tolist() == \
+            expected.result()['EventId'].tolist()
+        for name in ['Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE']:
+            assert continued.result()[name].tolist() == pytest.approx(
+                expected.result()[name].tolist())
+
+    def test_empty(self):
+        assert len(ELTAggregator().result()) == 0
+
+
+def random_elts(count, rows, events, seed=0):
+    random = np.random.RandomState(seed)
+    elts = []
+    for _ in range(count):
+        elt = np.zeros(rows, dtype=ELT_DTYPE)
+        elt['EventId'] = random.randint(0, events, rows)
+        elt['Loss'] = random.randint(1, 1000, rows)
+        elt['STDDEVI'] = random.randint(0, 10, rows)
+        elt['STDDEVC'] = random.randint(0, 10, rows)
+        elt['EXPVALUE'] = random.randint(0, 100, rows)
+        elts.append(elt)
+    return elts
+
+
+class TestELTMerger:
+
+    def merge(self, merger):
+        chunks = list(merger.merge())
+        if not chunks:
+            return np.empty(0, dtype=ELT_DTYPE)
+        return np.concatenate(chunks)
+
+    def test_sorts_by_event(self, tmpdir):
+        elts = random_elts(5, rows=300, events=200)
+        merger = ELTMerger(str(tmpdir), run_rows=250, buffer_rows=16)
+        for elt in elts:
+            merger.add(elt)
+        merged = self.merge(merger)
+
+        # Several runs were merged, and records of the same event are kept
+        # in the order they were added
+        assert len(tmpdir.listdir()) > 1
+        expected = np.concatenate(elts)
+        expected = expected[np.argsort(expected['EventId'], kind='stable')]
+        assert merged.tolist() == expected.tolist()
+
+    def test_reduce(self, tmpdir):
+        elts = random_elts(5, rows=300, events=200)
+        merger = ELTMerger(str(tmpdir), reduce=True, run_rows=250,
+                           buffer_rows=16)
+        aggregator = ELTAggregator()
+        for elt in elts:
+            merger.add(elt)
+            aggregator.add(elt)
+        merged = self.merge(merger)
+        expected = aggregator.result()
+
+        assert merged['EventId'].tolist() == expected['EventId'].tolist()
+        for name in ['Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE']:
+            assert merged[name].tolist() == pytest.approx(
+                expected[name].tolist())
+
+    def test_merge_state(self, tmpdir):
+        elts = random_elts(5, rows=300, events=200)
+        merger = ELTMerger(str(tmpdir), reduce=True, run_rows=250,
+                           buffer_rows=16)
+        aggregator = ELTAggregator()
+        for multiplicity, elt in enumerate(elts, 1):
+            merger.add(elt, multiplicity)
+            aggregator.add(elt, multiplicity)
+        state = np.concatenate(list(merger.merge_state()))
+        expected = aggregator.state()
+
+        assert state['EventId'].tolist() == expected['EventId'].tolist()
+        for name in ['Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE', 'Rows']:
+            assert state[name].tolist() == pytest.approx(
+                expected[name].tolist())
+
+        with pytest.raises(ValueError):
+            ELTMerger(str(tmpdir)).merge_state()
+
+    @pytest.mark.parametrize('reduce', [False, True])
+    def test_multiplicity(self, tmpdir, reduce):
+        elt = random_elts(1, rows=100, events=50)[0]
+
+        repeated = ELTMerger(str(tmpdir.mkdir('repeated')), reduce=reduce,
+                             run_rows=64, buffer_rows=8)
+        for _ in range(3):
+            repeated.add(elt)
+        multiplied = ELTMerger(str(tmpdir.mkdir('multiplied')),
+                               reduce=reduce, run_rows=64, buffer_rows=8)
+        multiplied.add(elt, multiplicity=3)
+
+        repeated = self.merge(repeated)
+        multiplied = self.merge(multiplied)
+        assert multiplied['EventId'].tolist() == \
+            repeated['EventId'].tolist()
+        for name in ['Loss', 'STDDEVI', 'STDDEVC', 'EXPVALUE']:
+            assert multiplied[name].tolist() == pytest.approx(
+                repeated[name].tolist())
+
+    def test_empty(self, tmpdir):
+        assert len(self.merge(ELTMerger(str(tmpdir)))) == 0
@@ -0,0 +1,47 @@
+import warnings
+
+from analyzere_extras.combine_elts import ELTCombiner
+
+
+class TestFilterEvents:
+
+    def test_events_not_in_catalog_are_filtered(
+            self, tmpdir, elt_server, recombine_api, elt_response_1,
+            elt_response_3):
+        a, b = recombine_api.loss_set_ids[:2]
+        catalog_id = recombine_api.catalog_id
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_3)
+        elt_server.files['catalog-{}.csv'.format(catalog_id)] = \
+            b'EventId,Rate\n2100,0.2\n1000,0.1\n1003,0.1\n'
+
+        cache_dir = str(tmpdir.join('cache'))
+        with ELTCombiner(cache_dir=cache_dir) as elt_combiner:
+            with warnings.catch_warnings(record=True) as caught:
+                combined = recombine_api.combine(elt_combiner, [a, b],
+                                                 filter_events=True)
+
+            assert str(caught[-1].message) == (
+                'Rows for events that are not in EventCatalog {} were left '
+                'out of the combined ELT: 1 rows of LossSet {}, 2 rows of '
+                'LossSet {}.'.format(catalog_id, a, b))
+            elt = recombine_api.uploaded_elt(combined)
+            assert elt['EventId'].tolist() == [1000, 1003, 2100]
+            assert elt['Loss'].tolist() == [10.5, 1400.0, 3150.0]
+
+            # Without filtering the combine is different, so not reused
+            unfiltered = recombine_api.combine(elt_combiner, [a, b],
+                                               reuse=True)
+            assert len(recombine_api.uploaded_elt(unfiltered)) == 6
+
+        # The catalog's event ids are cached with the ELTs
+        elt_server.requests = []
+        with ELTCombiner(cache_dir=cache_dir) as elt_combiner:
+            with warnings.catch_warnings(record=True):
+                again = recombine_api.combine(elt_combiner, [a, b],
+                                              filter_events=True)
+            span = elt_combiner.report.totals()['event_index']
+
+        assert elt_server.requests == []
+        assert span['cached'] == 1 and span['events'] == 3
+        recombine_api.assert_same_elt(recombine_api.uploaded_elt(again), elt)
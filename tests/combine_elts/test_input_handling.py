@@ -1,3 +1,6 @@
+import threading
+import time
+
 import pytest
 
 from analyzere_extras.combine_elts import ELTCombiner
@@ -10,6 +13,7 @@ from analyzere import (
     EventCatalog,
     InvalidRequestError,
 )
+from analyzere.base_resources import convert_to_analyzere_object
 from requests import ConnectionError
 from mock import patch
 
@@ -190,6 +194,59 @@ class TestAddELTLossSets:
             'are ignored.'.format(non_elt_loss_set[0]))
 
 
+def make_elt_loss_set(uuid, data_ref_id):
+    return convert_to_analyzere_object({
+        '_type': 'ELTLossSet',
+        'id': uuid,
+        'data': {'ref_id': data_ref_id},
+    }, LossSet)
+
+
+class TestPlanDownloads:
+
+    loss_set_1 = make_elt_loss_set('6a9bf278-4edc-4d28-b4bb-59f2283dbcb0',
+                                   'd99999e4-d66e-4c0a-a6ba-554a8598fea5')
+    loss_set_2 = make_elt_loss_set('a3bbebae-d25d-493e-8c02-fa4305e7dbd0',
+                                   '3f4dbb5e-5f4a-4d4e-a0e4-1c2b0e8f4a11')
+    # Shares loss_set_1's data file
+    loss_set_3 = make_elt_loss_set('5c468e85-3716-4abb-87b2-bcd39f6d6afd',
+                                   'd99999e4-d66e-4c0a-a6ba-554a8598fea5')
+
+    def plan(self, multiplicity):
+        elt_combiner = ELTCombiner()
+        elt_combiner._multiplicity = multiplicity
+        for loss_set in [self.loss_set_1, self.loss_set_2, self.loss_set_1,
+                         self.loss_set_3, self.loss_set_1]:
+            elt_combiner._add_elt_loss_set(loss_set)
+        return list(elt_combiner._plan_downloads().items())
+
+    @pytest.mark.parametrize('multiplicity, expected_counts', [
+        ('loss_set', [2, 1]),
+        ('reference', [4, 1]),
+        ('data', [1, 1]),
+    ])
+    def test_each_file_downloaded_once(self, multiplicity, expected_counts):
+        assert self.plan(multiplicity) == list(zip(
+            [self.loss_set_1.id, self.loss_set_2.id], expected_counts))
+
+    def test_unplanned_loss_set_ids(self):
+        elt_combiner = ELTCombiner()
+        elt_combiner._elt_loss_sets = [self.loss_set_2.id, self.loss_set_2.id]
+
+        assert list(elt_combiner._plan_downloads().items()) == [
+            (self.loss_set_2.id, 1)]
+
+    def test_invalid_multiplicity(self):
+        elt_combiner = ELTCombiner()
+        with pytest.raises(ValueError) as value_error:
+            elt_combiner.combine_elts_from_resources(
+                [self.loss_set_1.id], 'fake catalog', multiplicity='twice')
+
+        assert str(value_error.value) == (
+            "'twice' is not a valid multiplicity. Valid options are: "
+            "loss_set, reference, data.")
+
+
 class TestProcessUUID:
 
     def test_invalid_uuid(self):
@@ -406,6 +463,180 @@ class TestProcessUUID:
         assert str(value_error.value) == '\n'.join(expected_messages)
 
 
+class ProbedRetrieveAPI():
+    """Mocked '<Resource>.retrieve()' functions where only LayerView UUIDs
+    exist, and Portfolio lookups are slow to fail.
+    """
+
+    retrieved = []
+    release_portfolio = threading.Event()
+
+    @classmethod
+    def portfolio_retrieve(self, uuid):
+        ProbedRetrieveAPI.retrieved.append('Portfolio')
+        ProbedRetrieveAPI.release_portfolio.wait(5)
+        raise InvalidRequestError
+
+    @classmethod
+    def retrieve(self, uuid):
+        raise InvalidRequestError
+
+    @classmethod
+    def layer_view_retrieve(self, uuid):
+        ProbedRetrieveAPI.retrieved.append('LayerView')
+        return 'LayerView {}'.format(uuid)
+
+
+class TestRetrieveAnyType:
+
+    uuid = '874f0b1f-b00d-49b3-ab78-c7a626e3addf'
+
+    @patch.object(Portfolio, 'retrieve', ProbedRetrieveAPI.portfolio_retrieve)
+    @patch.object(PortfolioView, 'retrieve', ProbedRetrieveAPI.retrieve)
+    @patch.object(Layer, 'retrieve', ProbedRetrieveAPI.retrieve)
+    @patch.object(LayerView, 'retrieve', ProbedRetrieveAPI.layer_view_retrieve)
+    @patch.object(LossSet, 'retrieve', ProbedRetrieveAPI.retrieve)
+    def test_types_are_probed_concurrently(self):
+        ProbedRetrieveAPI.retrieved = []
+        ProbedRetrieveAPI.release_portfolio.clear()
+
+        elt_combiner = ELTCombiner()
+        start = time.time()
+        try:
+            resource_type, resource = elt_combiner._retrieve_any_type(
+                self.uuid)
+        finally:
+            ProbedRetrieveAPI.release_portfolio.set()
+
+        # The LayerView is found without waiting for the Portfolio lookup
+        assert time.time() - start < 5
+        assert resource_type is LayerView
+        assert resource == 'LayerView {}'.format(self.uuid)
+
+        # The type is remembered, so later lookups take a single request
+        ProbedRetrieveAPI.retrieved = []
+        assert elt_combiner._retrieve_any_type(self.uuid)[0] is LayerView
+        assert ProbedRetrieveAPI.retrieved == ['LayerView']
+
+
+class SlowLossSetAPI():
+    """Mocked 'LossSet.retrieve()' where earlier UUIDs take longest."""
+
+    uuids = [
+        'd4678873-85fa-42f3-aae6-7f9cd541a66a',
+        '874f0b1f-b00d-49b3-ab78-c7a626e3addf',
+        '279c6c55-94fe-4738-8d34-f0cf4d92e759',
+        '6a9bf278-4edc-4d28-b4bb-59f2283dbcb0',
+    ]
+
+    @classmethod
+    def retrieve(self, uuid):
+        time.sleep(0.05 * (len(SlowLossSetAPI.uuids) -
+                           SlowLossSetAPI.uuids.index(uuid)))
+        return make_elt_loss_set(uuid, uuid)
+
+
+class TestProcessUUIDs:
+
+    @patch.object(LossSet, 'retrieve', SlowLossSetAPI.retrieve)
+    def test_results_in_uuid_list_order(self):
+        uuid_list = [SlowLossSetAPI.uuids[0], 'invalid1',
+                     SlowLossSetAPI.uuids[1], SlowLossSetAPI.uuids[2],
+                     'invalid2', SlowLossSetAPI.uuids[3]]
+
+        elt_combiner = ELTCombiner(resolve_concurrency=4)
+        errors = elt_combiner._process_uuids(
+            elt_combiner._process_loss_set_uuid, uuid_list)
+
+        assert elt_combiner._elt_loss_sets == SlowLossSetAPI.uuids
+        assert [str(error) for error in errors] == [
+            "'invalid1' is not a valid UUID.",
+            "'invalid2' is not a valid UUID."]
+
+
+class ReferencedPortfolioAPI():
+    """Mocked 'Layer.retrieve()' and 'LossSet.retrieve()' for a portfolio
+    whose layers, and their loss sets, are References. Every layer shares
+    the first loss set.
+    """
+
+    layer_ids = ['layer-{}'.format(i) for i in range(8)]
+    lock = threading.Lock()
+    retrieved = []
+    running = 0
+    max_running = 0
+
+    @classmethod
+    def portfolio(self):
+        return convert_to_analyzere_object({
+            '_type': 'StaticPortfolio',
+            'id': 'portfolio',
+            'layers': [{'href': 'https://api/layers/{}'.format(layer_id)}
+                       for layer_id in ReferencedPortfolioAPI.layer_ids],
+        }, Portfolio)
+
+    @classmethod
+    def _retrieve(self, uuid):
+        with ReferencedPortfolioAPI.lock:
+            ReferencedPortfolioAPI.retrieved.append(uuid)
+            ReferencedPortfolioAPI.running += 1
+            ReferencedPortfolioAPI.max_running = max(
+                ReferencedPortfolioAPI.max_running,
+                ReferencedPortfolioAPI.running)
+        time.sleep(0.05)
+        with ReferencedPortfolioAPI.lock:
+            ReferencedPortfolioAPI.running -= 1
+
+    @classmethod
+    def layer_retrieve(self, uuid):
+        ReferencedPortfolioAPI._retrieve(uuid)
+        return convert_to_analyzere_object({
+            '_type': 'CatXL',
+            'id': uuid,
+            'loss_sets': [{'href': 'https://api/loss_sets/shared'},
+                          {'href': 'https://api/loss_sets/ls-' + uuid}],
+        }, Layer)
+
+    @classmethod
+    def loss_set_retrieve(self, uuid):
+        ReferencedPortfolioAPI._retrieve(uuid)
+        return make_elt_loss_set(uuid, uuid)
+
+
+class TestRetrieveReferences:
+
+    @patch.object(Layer, 'retrieve', ReferencedPortfolioAPI.layer_retrieve)
+    @patch.object(LossSet, 'retrieve',
+                  ReferencedPortfolioAPI.loss_set_retrieve)
+    def test_portfolio_is_retrieved_by_level(self):
+        ReferencedPortfolioAPI.retrieved = []
+        ReferencedPortfolioAPI.max_running = 0
+
+        with ELTCombiner(resolve_concurrency=4) as elt_combiner:
+            elt_combiner._add_portfolio_elts(
+                ReferencedPortfolioAPI.portfolio())
+
+        layer_ids = ReferencedPortfolioAPI.layer_ids
+        assert elt_combiner._elt_loss_sets == [
+            loss_set_id for layer_id in layer_ids
+            for loss_set_id in ['shared', 'ls-' + layer_id]]
+
+        # All the layers are retrieved, then all the distinct loss sets,
+        # each once and resolve_concurrency at a time.
+        retrieved = ReferencedPortfolioAPI.retrieved
+        assert sorted(retrieved[:len(layer_ids)]) == layer_ids
+        assert sorted(retrieved[len(layer_ids):]) == sorted(
+            ['shared'] + ['ls-' + layer_id for layer_id in layer_ids])
+        assert ReferencedPortfolioAPI.max_running == 4
+
+    def test_resources_are_not_retrieved(self, portfolio):
+        elt_combiner = ELTCombiner()
+        layers = list(portfolio[2].layers)
+
+        assert elt_combiner._retrieve_references(layers) == layers
+        assert elt_combiner._references_executor is None
+
+
 class TestConnectionError:
 
     def test_connection_error_thrown(self):
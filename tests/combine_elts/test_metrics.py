@@ -0,0 +1,44 @@
+import pytest
+
+from analyzere_extras.metrics import CombineReport, Span
+
+
+class TestCombineReport:
+
+    def test_span_is_timed_and_reported(self):
+        finished = []
+        report = CombineReport(on_span=finished.append)
+
+        with report.span('download_elt', elt_id='a', bytes=0) as span:
+            span.attributes['bytes'] = 100
+
+        assert finished == report.spans == [span]
+        assert span.name == 'download_elt'
+        assert span.seconds >= 0
+        assert span.attributes == {'elt_id': 'a', 'bytes': 100}
+
+    def test_span_is_recorded_on_error(self):
+        report = CombineReport()
+
+        with pytest.raises(RuntimeError):
+            with report.span('upload'):
+                raise RuntimeError('upload failed')
+
+        assert [span.name for span in report.spans] == ['upload']
+
+    def test_totals(self):
+        report = CombineReport()
+        report.add(Span('download_elt', 10.0, 2.0, elt_id='a', bytes=100,
+                        cached=False))
+        report.add(Span('download_elt', 10.5, 1.0, elt_id='b', bytes=50,
+                        cached=True))
+        report.add(Span('upload', 13.0, 4.0, bytes=75))
+
+        totals = report.totals()
+        assert list(totals) == ['download_elt', 'upload']
+        assert totals['download_elt'] == {
+            'count': 2, 'seconds': 3.0, 'bytes': 150, 'cached': 1}
+        assert totals['upload'] == {'count': 1, 'seconds': 4.0, 'bytes': 75}
+        assert report.seconds == 7.0
+        assert str(report).splitlines()[1].split() == [
+            'download_elt', '2', '3.000', '-', '150']
@@ -0,0 +1,163 @@
+import warnings
+
+import pytest
+
+from analyzere_extras.combine_elts import ELTCombiner
+from analyzere_extras.elts import read_elt
+from mock import patch
+
+
+class TestRecombine:
+
+    def test_recombine_downloads_only_changes(
+            self, tmpdir, elt_server, recombine_api,
+            elt_response_additional_columns_1,
+            elt_response_additional_columns_2,
+            elt_response_additional_columns_3):
+        a, b, c, d = recombine_api.loss_set_ids
+        recombine_api.serve(a, 1, elt_response_additional_columns_1)
+        recombine_api.serve(b, 1, elt_response_additional_columns_2)
+        recombine_api.serve(c, 1, elt_response_additional_columns_3)
+
+        cache_dir = str(tmpdir.join('cache'))
+        with ELTCombiner(cache_dir=cache_dir) as elt_combiner:
+            first = recombine_api.combine(elt_combiner, [a, b, c])
+
+            # b is modified, c is removed and d is added
+            recombine_api.serve(b, 2, elt_response_additional_columns_3)
+            recombine_api.serve(d, 1, elt_response_additional_columns_2)
+            elt_server.requests = []
+            second = recombine_api.combine(elt_combiner, [a, b, d],
+                                           previous=first)
+
+            assert sorted(path for path, _ in elt_server.requests) == [
+                '/uploads/files/{}-2.csv'.format(b),
+                '/uploads/files/{}-1.csv'.format(d),
+            ]
+
+        with ELTCombiner(cache_dir=str(tmpdir.join('other'))) as \
+                elt_combiner:
+            expected = recombine_api.combine(elt_combiner, [a, b, d])
+
+        recombine_api.assert_same_elt(recombine_api.uploaded_elt(second),
+                                      recombine_api.uploaded_elt(expected))
+
+    def test_removed_events_are_dropped(
+            self, tmpdir, recombine_api, elt_response_1, elt_response_2):
+        a, b = recombine_api.loss_set_ids[:2]
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_2)
+
+        with ELTCombiner(cache_dir=str(tmpdir)) as elt_combiner:
+            first = recombine_api.combine(elt_combiner, [a, b])
+            second = recombine_api.combine(elt_combiner, [a],
+                                           previous=first.id)
+
+        recombine_api.assert_same_elt(recombine_api.uploaded_elt(second),
+                                      read_elt(elt_response_1[1]))
+
+    def test_previous_not_cached(self, tmpdir, recombine_api,
+                                 elt_response_1):
+        a = recombine_api.loss_set_ids[0]
+        recombine_api.serve(a, 1, elt_response_1)
+
+        with ELTCombiner(cache_dir=str(tmpdir)) as elt_combiner:
+            with warnings.catch_warnings(record=True) as caught:
+                combined = recombine_api.combine(
+                    elt_combiner, [a], previous='combined-unknown')
+
+        assert 'combining all ELTs again' in str(caught[-1].message)
+        recombine_api.assert_same_elt(recombine_api.uploaded_elt(combined),
+                                      read_elt(elt_response_1[1]))
+
+    def test_recombine_sorted(self, tmpdir, elt_server, recombine_api,
+                              elt_response_1, elt_response_2):
+        a, b = recombine_api.loss_set_ids[:2]
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_2)
+
+        with ELTCombiner(cache_dir=str(tmpdir)) as elt_combiner:
+            first = recombine_api.combine(elt_combiner, [a, b], sort=True)
+            elt_server.requests = []
+            with warnings.catch_warnings(record=True) as caught:
+                second = recombine_api.combine(elt_combiner, [a], sort=True,
+                                               previous=first)
+
+        assert caught == []
+        assert elt_server.requests == []
+        recombine_api.assert_same_elt(recombine_api.uploaded_elt(second),
+                                      read_elt(elt_response_1[1]))
+
+    def test_failed_upload_is_not_stored(self, tmpdir, recombine_api,
+                                         elt_response_1):
+        a = recombine_api.loss_set_ids[0]
+        recombine_api.serve(a, 1, elt_response_1)
+
+        with ELTCombiner(cache_dir=str(tmpdir)) as elt_combiner:
+            recombine_api.upload_status = 'processing_failed'
+            failed = recombine_api.combine(elt_combiner, [a])
+            recombine_api.upload_status = 'processing_succeeded'
+            with warnings.catch_warnings(record=True) as caught:
+                recombine_api.combine(elt_combiner, [a], previous=failed)
+
+        assert 'combining all ELTs again' in str(caught[-1].message)
+
+    def test_previous_requires_cache(self, recombine_api):
+        with ELTCombiner() as elt_combiner:
+            with pytest.raises(ValueError) as value_error:
+                recombine_api.combine(elt_combiner, [],
+                                      previous='combined-1')
+
+        assert str(value_error.value) == (
+            'Combining from a previous combine requires a cache_dir and '
+            'aggregate=True.')
+
+    def test_identical_combine_is_reused(
+            self, elt_server, recombine_api, elt_response_1,
+            elt_response_2):
+        a, b = recombine_api.loss_set_ids[:2]
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_2)
+
+        with ELTCombiner() as elt_combiner:
+            first = recombine_api.combine(elt_combiner, [a, b])
+            # The search is not needed without reuse=True
+            assert recombine_api.searches == []
+
+            elt_server.requests = []
+            reused = recombine_api.combine(elt_combiner, [b, a], reuse=True)
+            assert reused is first
+            assert elt_server.requests == []
+            assert list(elt_combiner.report.totals()) == ['resolve']
+            assert recombine_api.searches == [
+                first.meta_data.analyzere_extras_combine_hash[:16]]
+
+            # A different option, or a modified ELT, is combined again
+            sorted_combine = recombine_api.combine(
+                elt_combiner, [a, b], reuse=True, sort=True)
+            recombine_api.serve(b, 2, elt_response_1)
+            modified = recombine_api.combine(elt_combiner, [a, b],
+                                             reuse=True)
+
+        assert len({first.id, sorted_combine.id, modified.id}) == 3
+
+    def test_reused_combine_is_searched_for_page_by_page(
+            self, recombine_api, elt_response_1, elt_response_2):
+        a, b = recombine_api.loss_set_ids[:2]
+        recombine_api.serve(a, 1, elt_response_1)
+        recombine_api.serve(b, 1, elt_response_2)
+
+        with ELTCombiner() as elt_combiner:
+            recombine_api.combine(elt_combiner, [b])
+            failed = recombine_api.combine(elt_combiner, [a, b])
+            failed.status = 'processing_failed'
+            first = recombine_api.combine(elt_combiner, [a, b])
+
+            with patch('analyzere_extras.combine_elts.SEARCH_PAGE_SIZE', 1):
+                reused = recombine_api.combine(elt_combiner, [a, b],
+                                               reuse=True)
+
+        # Only the combines of a and b are found, one page at a time
+        assert reused is first
+        assert recombine_api.searches == [
+            first.meta_data.analyzere_extras_combine_hash[:16]] * 2
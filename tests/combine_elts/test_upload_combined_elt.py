@@ -1,7 +1,14 @@
+import gzip
+
 import pytest
 
 from analyzere import LossSet
-from analyzere_extras.combine_elts import ELTCombiner
+from analyzere_extras.combine_elts import (
+    ELTCombiner,
+    StreamReader,
+    gzip_chunks,
+)
+from analyzere_extras.elts import convert_elt_csv
 from mock import patch
 
 
@@ -20,13 +27,79 @@ class AnalyzeReLossSetTestAPI():
 
     @classmethod
     def upload_data(self, file_like_obj):
-        """Mocked 'LossSet.upload_data()' function."""
+        """Mocked 'LossSet.upload_data()' function.
+
+        Reads the data in small chunks, the way the real upload does.
+        """
         self.status = 'processing_succeeded'
         self.status_message = None
-        AnalyzeReLossSetTestAPI.upload_data_input = file_like_obj
+        chunks = []
+        while True:
+            chunk = file_like_obj.read(7)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        AnalyzeReLossSetTestAPI.upload_data_input = chunks[0][:0].join(
+            chunks)
         return self
 
 
+def spool_elt(tmpdir, elt_response):
+    """Writes a mocked ELT response to tmpdir as _download_loss_set would."""
+    elt_file = tmpdir.join('{}.csv'.format(elt_response[0]))
+    elt_file.write('\n'.join(elt_response[1]) + '\n')
+    return str(elt_file)
+
+
+def elt_rows(lines):
+    """Parses ELT CSV rows so they can be compared by value, for combined
+    ELTs that are aggregated or sorted, whose rows are formatted from their
+    parsed values rather than copied (e.g. '02' is uploaded as '2').
+    """
+    rows = []
+    for line in lines:
+        fields = line.split(',')
+        rows.append(tuple([int(fields[0])] +
+                          [float(field) for field in fields[1:]]))
+    return rows
+
+
+class TestStreamReader:
+
+    def test_read_in_chunks(self):
+        rows = ['EventId,Loss\n', '1,2.5\n', '', '10,200.0\n']
+        reader = StreamReader(rows)
+
+        chunks = list(iter(lambda: reader.read(4), ''))
+        assert all(len(chunk) == 4 for chunk in chunks[:-1])
+        assert ''.join(chunks) == ''.join(rows)
+
+    def test_read_all(self):
+        reader = StreamReader(['EventId,Loss\n', '1,2.5\n'])
+        assert reader.read(3) == 'Eve'
+        assert reader.read() == 'ntId,Loss\n1,2.5\n'
+        assert reader.read() == ''
+
+    def test_read_bytes(self):
+        reader = StreamReader([b'EventId,Loss\n', b'1,2.5\n'])
+        assert reader.read(3) == b'Eve'
+        assert reader.read() == b'ntId,Loss\n1,2.5\n'
+        assert not reader.read()
+
+    def test_gzip_chunks(self):
+        rows = ['EventId,Loss\n'] + ['{},2.5\n'.format(i)
+                                     for i in range(1000)]
+        reader = StreamReader(gzip_chunks(rows))
+
+        compressed = b''.join(iter(lambda: reader.read(7), b''))
+        assert gzip.decompress(compressed).decode('utf-8') == ''.join(rows)
+
+    def test_not_seekable(self):
+        # LossSet.upload_data() measures the length of seekable objects up
+        # front, which would defeat streaming.
+        assert not hasattr(StreamReader([]), 'seek')
+
+
 class TestUploadCombinedELT:
 
     test_description = 'test description'
@@ -39,7 +112,7 @@ class TestUploadCombinedELT:
         ['elt_response_EventId', 'elt_response_EventID']
     )
     def test_event_id_column_names(
-            self, elt_response_key, elt_response_dict):
+            self, tmpdir, elt_response_key, elt_response_dict):
 
         elt_combiner = ELTCombiner()
 
@@ -47,7 +120,8 @@ class TestUploadCombinedELT:
 
         assert len(elt_combiner._downloaded_elts) == 0
         elt_combiner._downloaded_elts = {}
-        elt_combiner._downloaded_elts[elt_response[0]] = elt_response[1]
+        elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+            tmpdir, elt_response)
         elt_combiner._description = TestUploadCombinedELT.test_description
         elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
 
@@ -73,13 +147,14 @@ class TestUploadCombinedELT:
     @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
     @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
     def test_uploaded_elt_has_proper_column_names(
-            self, elt_response_1):
+            self, tmpdir, elt_response_1):
 
         elt_combiner = ELTCombiner()
 
         assert len(elt_combiner._downloaded_elts) == 0
         elt_combiner._downloaded_elts = {}
-        elt_combiner._downloaded_elts[elt_response_1[0]] = elt_response_1[1]
+        elt_combiner._downloaded_elts[elt_response_1[0]] = spool_elt(
+            tmpdir, elt_response_1)
         elt_combiner._description = TestUploadCombinedELT.test_description
         elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
 
@@ -94,7 +169,7 @@ class TestUploadCombinedELT:
     @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
     @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
     def test_upload_combined_elt(
-            self, elt_response_1, elt_response_2, elt_response_3):
+            self, tmpdir, elt_response_1, elt_response_2, elt_response_3):
 
         elt_combiner = ELTCombiner()
         elt_combiner._description = TestUploadCombinedELT.test_description
@@ -102,9 +177,11 @@ class TestUploadCombinedELT:
 
         assert len(elt_combiner._downloaded_elts) == 0
 
+        elt_responses = {}
         for elt_response in [elt_response_1, elt_response_2, elt_response_3]:
-            elt_combiner._downloaded_elts[elt_response[0]] = \
-                elt_response[1]
+            elt_responses[elt_response[0]] = elt_response[1]
+            elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                tmpdir, elt_response)
 
         assert len(elt_combiner._downloaded_elts) == 3
 
@@ -121,8 +198,8 @@ class TestUploadCombinedELT:
         # Get appending order
         # (depends on dict elt_combiner._downloaded_elts items())
         elt_response_order = []
-        for elt_id, elt_response in elt_combiner._downloaded_elts.items():
-            elt_response_order.append(elt_response)
+        for elt_id in elt_combiner._downloaded_elts:
+            elt_response_order.append(elt_responses[elt_id])
 
         expected_uploaded_data = []
         for elt_response in elt_response_order:
@@ -137,7 +214,7 @@ class TestUploadCombinedELT:
     @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
     @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
     def test_upload_combined_elt_with_optional_columns(
-            self,
+            self, tmpdir,
             elt_response_additional_columns_1,
             elt_response_additional_columns_2,
             elt_response_additional_columns_3):
@@ -148,10 +225,13 @@ class TestUploadCombinedELT:
 
         assert len(elt_combiner._downloaded_elts) == 0
 
+        elt_responses = {}
         for elt_response in [elt_response_additional_columns_1,
                              elt_response_additional_columns_2,
                              elt_response_additional_columns_3]:
-            elt_combiner._downloaded_elts[elt_response[0]] = elt_response[1]
+            elt_responses[elt_response[0]] = elt_response[1]
+            elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                tmpdir, elt_response)
 
         assert len(elt_combiner._downloaded_elts) == 3
 
@@ -168,8 +248,8 @@ class TestUploadCombinedELT:
         # Get appending order
         # (depends on dict elt_combiner._downloaded_elts items())
         elt_response_order = []
-        for elt_id, elt_response in elt_combiner._downloaded_elts.items():
-            elt_response_order.append(elt_response)
+        for elt_id in elt_combiner._downloaded_elts:
+            elt_response_order.append(elt_responses[elt_id])
 
         expected_uploaded_data = []
         for elt_response in elt_response_order:
@@ -177,3 +257,211 @@ class TestUploadCombinedELT:
                 expected_uploaded_data.append(row)
 
         assert upload_data == '\n'.join(expected_uploaded_data) + '\n'
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_concatenated_values_are_exact(self, tmpdir):
+        elt_combiner = ELTCombiner()
+        elt_combiner._description = TestUploadCombinedELT.test_description
+        elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+
+        elt_combiner._downloaded_elts['a'] = spool_elt(tmpdir, ('a', [
+            'EventId,Loss,STDDEVI,STDDEVC,EXPVALUE',
+            '9007199254740993,0.1234567890123456789,0,0,1e3']))
+        elt_combiner._downloaded_elts['b'] = spool_elt(tmpdir, ('b', [
+            'Loss,EventID,STDDEVC', '"2.50",02,']))
+
+        elt_combiner._upload_combined_elt()
+
+        assert AnalyzeReLossSetTestAPI.upload_data_input == (
+            'EventId,Loss,STDDEVI,STDDEVC,EXPVALUE\n'
+            '9007199254740993,0.1234567890123456789,0,0,1e3\n'
+            '02,2.50,0.0,0.0,2.50\n')
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_aggregated_elt(
+            self, tmpdir, elt_response_1, elt_response_2, elt_response_3):
+
+        elt_combiner = ELTCombiner()
+        elt_combiner._description = TestUploadCombinedELT.test_description
+        elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+        elt_combiner._aggregate = True
+
+        for elt_response in [elt_response_1, elt_response_2, elt_response_3]:
+            elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                tmpdir, elt_response)
+
+        elt_combiner._upload_combined_elt()
+
+        upload_data = AnalyzeReLossSetTestAPI.upload_data_input.replace(
+            'EventId,Loss,STDDEVI,STDDEVC,EXPVALUE\n', '')
+
+        assert elt_rows(upload_data.splitlines()) == [
+            (1000, 610.5, 0.0, 0.0, 610.5),
+            (1001, 400.0, 0.0, 0.0, 400.0),
+            (1003, 1400.0, 0.0, 0.0, 1400.0),
+            (2100, 3170.25, 0.0, 0.0, 3170.25),
+            (3000, 10.5, 0.0, 0.0, 10.5),
+            (3002, 3000.1, 0.0, 0.0, 3000.1),
+        ]
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_compressed(self, tmpdir, elt_response_1, elt_response_2):
+        uploads = []
+        for compress_upload in (False, True):
+            elt_combiner = ELTCombiner(compress_upload=compress_upload)
+            elt_combiner._description = TestUploadCombinedELT.test_description
+            elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+            for elt_response in [elt_response_1, elt_response_2]:
+                elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                    tmpdir, elt_response)
+
+            elt_combiner._upload_combined_elt()
+            uploads.append(AnalyzeReLossSetTestAPI.upload_data_input)
+
+        assert gzip.decompress(uploads[1]).decode('utf-8') == uploads[0]
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    @pytest.mark.parametrize('aggregate', [False, True])
+    def test_upload_sorted_elt(self, tmpdir, aggregate, elt_response_1,
+                               elt_response_2, elt_response_3):
+        uploads = []
+        for sort in (False, True):
+            elt_combiner = ELTCombiner()
+            elt_combiner._description = TestUploadCombinedELT.test_description
+            elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+            elt_combiner._spool = str(tmpdir)
+            elt_combiner._aggregate = aggregate
+            elt_combiner._sort = sort
+            for elt_response in [elt_response_1, elt_response_2,
+                                 elt_response_3]:
+                elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                    tmpdir, elt_response)
+
+            elt_combiner._upload_combined_elt()
+            uploads.append(elt_rows(
+                AnalyzeReLossSetTestAPI.upload_data_input.splitlines()[1:]))
+
+        unsorted, merged = uploads
+        assert merged == sorted(unsorted, key=lambda row: row[0])
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_parsed_in_processes(self, tmpdir, elt_response_1,
+                                        elt_response_2, elt_response_3):
+        uploads = []
+        for parse_processes in (1, 2):
+            elt_combiner = ELTCombiner(parse_processes=parse_processes)
+            elt_combiner._description = TestUploadCombinedELT.test_description
+            elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+            for elt_response in [elt_response_1, elt_response_2,
+                                 elt_response_3]:
+                elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                    tmpdir, elt_response)
+            elt_combiner._elt_multiplicity = {elt_response_2[0]: 2}
+
+            elt_combiner._upload_combined_elt()
+            uploads.append(AnalyzeReLossSetTestAPI.upload_data_input)
+
+        assert uploads[0] == uploads[1]
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    @pytest.mark.parametrize('parse_processes', [1, 2])
+    def test_upload_cached_binary_elts(self, tmpdir, parse_processes,
+                                       elt_response_1, elt_response_2,
+                                       elt_response_3):
+        uploads = []
+        for binary in (False, True):
+            elt_combiner = ELTCombiner(parse_processes=parse_processes)
+            elt_combiner._description = TestUploadCombinedELT.test_description
+            elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+            for elt_response in [elt_response_1, elt_response_2,
+                                 elt_response_3]:
+                elt_path = spool_elt(tmpdir, elt_response)
+                if binary and elt_response is not elt_response_2:
+                    # As if elt_responses 1 and 3 had been cached
+                    csv_path, elt_path = elt_path, elt_path + '.elt'
+                    convert_elt_csv(csv_path, elt_path)
+                elt_combiner._downloaded_elts[elt_response[0]] = elt_path
+
+            elt_combiner._upload_combined_elt()
+            uploads.append(AnalyzeReLossSetTestAPI.upload_data_input)
+
+        assert uploads[0] == uploads[1]
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_is_reported(self, tmpdir, elt_response_1,
+                                elt_response_2):
+        spans = []
+        elt_combiner = ELTCombiner(on_span=spans.append)
+        elt_combiner._description = TestUploadCombinedELT.test_description
+        elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+        for elt_response in [elt_response_1, elt_response_2]:
+            elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                tmpdir, elt_response)
+        elt_combiner._elt_multiplicity = {elt_response_2[0]: 2}
+
+        elt_combiner._upload_combined_elt()
+
+        upload_data = AnalyzeReLossSetTestAPI.upload_data_input
+        assert [span.name for span in spans] == [
+            'parse_elt', 'parse_elt', 'combine', 'upload']
+        assert [(span.attributes['elt_id'], span.attributes['rows'])
+                for span in spans[:2]] == [
+            (elt_response_1[0], len(elt_response_1[1]) - 1),
+            (elt_response_2[0], len(elt_response_2[1]) - 1)]
+        assert spans[2].attributes == {
+            'rows': len(upload_data.splitlines()) - 1,
+            'bytes': len(upload_data)}
+        assert spans[3].attributes == {'bytes': len(upload_data)}
+        assert spans[2].seconds <= spans[3].seconds
+        assert elt_combiner.report.spans == spans
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_events(self, tmpdir, elt_response_1, elt_response_2):
+        events = []
+        elt_combiner = ELTCombiner(on_event=events.append)
+        elt_combiner._description = TestUploadCombinedELT.test_description
+        elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+        for elt_response in [elt_response_1, elt_response_2]:
+            elt_combiner._downloaded_elts[elt_response[0]] = spool_elt(
+                tmpdir, elt_response)
+
+        combined_loss_set = elt_combiner._upload_combined_elt()
+
+        upload_length = len(AnalyzeReLossSetTestAPI.upload_data_input)
+        combined = [event.attributes for event in events
+                    if event.name == 'elt_combined']
+        assert [(attributes['elt_id'], attributes['rows'],
+                 attributes['combined'], attributes['total'])
+                for attributes in combined] == [
+            (elt_response_1[0], len(elt_response_1[1]) - 1, 1, 2),
+            (elt_response_2[0], len(elt_response_2[1]) - 1, 2, 2)]
+
+        progress = [event.attributes['bytes'] for event in events
+                    if event.name == 'upload_progress']
+        assert progress == sorted(progress)
+        assert progress[-1] == upload_length
+
+        assert events[-1].name == 'upload_finished'
+        assert events[-1].attributes['loss_set_id'] == combined_loss_set.id
+        assert events[-1].attributes['bytes'] == upload_length
+
+    @patch.object(LossSet, 'upload_data', AnalyzeReLossSetTestAPI.upload_data)
+    @patch.object(LossSet, 'save', AnalyzeReLossSetTestAPI.save)
+    def test_upload_is_silent(self, tmpdir, capsys, elt_response_1):
+        elt_combiner = ELTCombiner()
+        elt_combiner._description = TestUploadCombinedELT.test_description
+        elt_combiner._catalog = TestUploadCombinedELT.fake_catalog
+        elt_combiner._downloaded_elts[elt_response_1[0]] = spool_elt(
+            tmpdir, elt_response_1)
+
+        elt_combiner._upload_combined_elt()
+
+        assert capsys.readouterr() == ('', '')